@@ -1,27 +1,97 @@
+import base64
+import functools
+import json
+import logging
+import os
+import time
+import uuid
 from datetime import datetime
 from enum import Enum
 
 import dash
 import dash_bootstrap_components as dbc
-from dash import callback_context, dcc, html
+import diskcache
+import flask
+import numpy as np
+import psutil
+import pyarrow as pa
+from dash import (
+    DiskcacheManager,
+    Patch,
+    callback_context,
+    dcc,
+    html,
+    no_update,
+    set_props,
+)
 from dash.dependencies import Input, Output, State
 from dash_ag_grid import AgGrid
 
+from src import metrics
 from src.aggrid_utils import datestring_cell, numeric_cell, select_cell
-from src.bond import bond_dict_to_obj, create_default_bond
-from src.price import calculate_key_rate_duration, update_price
+from src.bond import Portfolio, cached_bond, create_default_bond
+from src.cache import BatchCache
+from src.metrics import instrument
+from src.portfolio_io import file_format, read_portfolio, write_portfolio
+from src.price import (
+    KRD_CHUNK_SIZE,
+    RESULT_CACHE,
+    TAYLOR_THRESHOLD,
+    iter_key_rate_duration,
+    update_price,
+)
 from src.rates import (
     RATE_TENOR_LABELS,
+    curve_hash,
+    get_curve_store,
     get_rates_for_date,
-    plot_rates,
+    rate_figure,
+    rate_ranges,
     rates_table,
 )
+from src.row_model import query, query_columns
+from src.scenarios import (
+    historical_var,
+    scenario_prices,
+    scenario_report,
+    standard_scenarios,
+)
+from src.store import PORTFOLIOS, SessionExpiredError
+
+logger = logging.getLogger(__name__)
 
 # Constant for default pricing date
 DEFAULT_PRICING_DATE = datetime(2024, 1, 2)
 
-# Fetch default rate data dynamically for the default pricing date
-DEFAULT_RATE_DATA = get_rates_for_date(DEFAULT_PRICING_DATE)
+# Opt-in: reprice rate edits from stored sensitivities, up to a threshold move
+FAST_RATE_UPDATE = os.environ.get("FAST_RATE_UPDATE", "0") == "1"
+FAST_RATE_UPDATE_THRESHOLD = float(
+    os.environ.get("FAST_RATE_UPDATE_THRESHOLD", str(TAYLOR_THRESHOLD))
+)
+
+# Row model of the bond table: "clientSide" sends every row to the browser,
+# "infinite" sends only the blocks in view, sorted, filtered and priced on
+# the server
+GRID_ROW_MODEL = os.environ.get("GRID_ROW_MODEL", "clientSide")
+INFINITE_GRID = GRID_ROW_MODEL == "infinite"
+
+# Grid options of the infinite row model
+INFINITE_GRID_OPTIONS = {
+    "cacheBlockSize": int(os.environ.get("GRID_BLOCK_SIZE", "100")),
+    "maxBlocksInCache": 20,
+}
+
+# Disk cache of the background jobs and of the reports they compute, shared
+# by the server and the job processes
+JOB_CACHE_DIR = os.environ.get("JOB_CACHE_DIR", os.path.join("data", "jobs"))
+JOB_CACHE = diskcache.Cache(JOB_CACHE_DIR)
+
+# Seconds a Key Rate Duration Report, and the portfolio snapshot it is
+# computed from, are kept in the job cache
+KRD_RESULT_EXPIRE = int(os.environ.get("KRD_RESULT_EXPIRE", "3600"))
+
+# Most updates of the KRD progress bar and table per report
+KRD_PROGRESS_STEPS = 20
 
 HEATMAP_STYLE = {
     "styleConditions": [
@@ -42,11 +112,27 @@ HEATMAP_STYLE = {
 }
 
 
+# Function to ask for a reload when a callback finds that its session has
+# expired, instead of failing. Other errors are raised again
+def callback_error(err):
+    if not isinstance(err, SessionExpiredError):
+        raise err
+    set_props(
+        "session-status",
+        {
+            "children": "Your session has expired, reload the page",
+            "is_open": True,
+        },
+    )
+
+
 # Initialize the Dash app
 app = dash.Dash(
     __name__,
     external_stylesheets=[dbc.themes.BOOTSTRAP],
     suppress_callback_exceptions=True,
+    background_callback_manager=DiskcacheManager(JOB_CACHE),
+    on_error=callback_error,
 )
 
 
@@ -68,6 +154,9 @@ column_defs = [
         "field": "Menu",
         "cellRenderer": "rowMenu",
         "width": 100,
+        # The menu has no values to sort or filter on the server
+        "sortable": False,
+        "filter": False,
     },
     {"headerName": "Bond", "field": "Bond", "editable": False, "width": 100},
     select_cell("Currency", ["USD", "EUR"]),
@@ -76,244 +165,651 @@ column_defs = [
     datestring_cell("Maturity"),
     numeric_cell("Frequency"),
     numeric_cell("Notional"),
-    {"headerName": "Price", "field": "Price", "editable": False, "width": 100},
-    {
-        "headerName": "Duration",
-        "field": "Duration",
-        "editable": False,
-        "width": 100,
-    },
-    {
-        "headerName": "Convexity",
-        "field": "Convexity",
-        "editable": False,
-        "width": 100,
-    },
+    numeric_cell("Price", editable=False, value_format="$.6f"),
+    numeric_cell("Duration", editable=False, value_format=".6f"),
+    numeric_cell("Convexity", editable=False, value_format=".6f"),
 ]
 
-# Layout of the app
-app.layout = html.Div(
-    [
-        html.Button(
-            "Add Bond",
-            id="add-bond-button",
-            n_clicks=0,
-            style={"margin-top": "20px"},
-        ),
-        dcc.DatePickerSingle(
-            id="pricing-datetime-picker",
-            date=DEFAULT_PRICING_DATE,
-            display_format="YYYY-MM-DD",
-            style={"margin-top": "20px"},
-        ),
-        html.Button(
-            "Rate Editor",
-            id="rate-editor-button",
-            n_clicks=0,
-            style={"margin-top": "20px"},
-        ),
+
+# Function to add the debug metrics panel, when metrics are enabled
+def metrics_controls():
+    if not metrics.ENABLED:
+        return []
+    return [
         html.Button(
-            "Show Key Rate Duration",
-            id="show-krd-button",
+            "Metrics",
+            id="metrics-button",
             n_clicks=0,
             style={"margin-top": "20px"},
         ),
-        AgGrid(
-            id="bond-table",
-            rowData=generate_initial_data(DEFAULT_PRICING_DATE),
-            columnDefs=column_defs,
-            defaultColDef={
-                "sortable": True,
-                "filter": True,
-                "resizable": True,
-                "editable": True,
-            },
-            dashGridOptions={
-                "editable": True,
-                "rowSelection": "single",
-                "animateRows": True,
-            },
-            style={"height": "80vh", "width": "100%"},
-        ),
-        dcc.Store(
-            id="bond-store", data=generate_initial_data(DEFAULT_PRICING_DATE)
-        ),
-        dbc.Offcanvas(
-            dcc.Markdown(id="timetable-content"),
-            id="offcanvas-timetable",
-            title="Bond Timetable",
-            is_open=False,
-            placement="end",
-            backdrop=True,
-        ),
         dbc.Offcanvas(
-            html.Div(
-                [
-                    dcc.Graph(id="rate-graph"),
-                    AgGrid(
-                        id="rate-editor",
-                        rowData=DEFAULT_RATE_DATA,
-                        columnDefs=[
-                            numeric_cell("Year", editable=False),
-                            numeric_cell("Rate"),
-                        ],
-                        defaultColDef={
-                            "sortable": True,
-                            "filter": True,
-                            "resizable": True,
-                            "editable": True,
-                        },
-                        dashGridOptions={
-                            "editable": True,
-                            "rowSelection": "single",
-                            "animateRows": True,
-                        },
-                        style={"flex": 1, "width": "100%"},
-                    ),
-                ]
+            AgGrid(
+                id="metrics-table",
+                defaultColDef={"sortable": True, "resizable": True},
+                style={"height": "80vh", "width": "100%"},
             ),
-            id="offcanvas-rate-editor",
-            title="Rate Editor",
+            id="offcanvas-metrics",
+            title="Callback Metrics",
             is_open=False,
             placement="end",
             backdrop=True,
-            style={"width": "30%"},
+            style={"width": "60%"},
         ),
-        dbc.Offcanvas(
+    ]
+
+
+# Layout of the app, with a new server side portfolio for each page load
+def serve_layout():
+    log_startup()
+    session_id = str(uuid.uuid4())
+    session = PORTFOLIOS.create(
+        session_id, generate_initial_data(DEFAULT_PRICING_DATE)
+    )
+    return html.Div(
+        [
+            dcc.Store(id="session-id", data=session_id),
+            dbc.Alert(id="session-status", color="warning", is_open=False),
+            html.Button(
+                "Add Bond",
+                id="add-bond-button",
+                n_clicks=0,
+                style={"margin-top": "20px"},
+            ),
+            dcc.DatePickerSingle(
+                id="pricing-datetime-picker",
+                date=DEFAULT_PRICING_DATE,
+                display_format="YYYY-MM-DD",
+                style={"margin-top": "20px"},
+            ),
+            html.Span(id="curve-status", style={"margin-left": "10px"}),
+            html.Button(
+                "Rate Editor",
+                id="rate-editor-button",
+                n_clicks=0,
+                style={"margin-top": "20px"},
+            ),
+            html.Button(
+                "Show Key Rate Duration",
+                id="show-krd-button",
+                n_clicks=0,
+                style={"margin-top": "20px"},
+            ),
+            dcc.Store(id="krd-job"),
+            html.Button(
+                "Scenario Report",
+                id="show-scenario-button",
+                n_clicks=0,
+                style={"margin-top": "20px"},
+            ),
+            html.Button(
+                "VaR Report",
+                id="show-var-button",
+                n_clicks=0,
+                style={"margin-top": "20px"},
+            ),
+            dcc.Upload(
+                html.Button("Upload Portfolio"),
+                id="upload-portfolio",
+                accept=".csv,.parquet",
+                style={"display": "inline-block", "margin-top": "20px"},
+            ),
+            html.Button(
+                "Download CSV",
+                id="download-csv-button",
+                n_clicks=0,
+                style={"margin-top": "20px"},
+            ),
+            html.Button(
+                "Download Parquet",
+                id="download-parquet-button",
+                n_clicks=0,
+                style={"margin-top": "20px"},
+            ),
+            dcc.Download(id="download-portfolio"),
+            *metrics_controls(),
+            html.Div(id="upload-status"),
+            dcc.Store(id="bond-table-refresh"),
             AgGrid(
-                id="krd-report-table",
-                columnDefs=[
-                    {"headerName": "Bond", "field": "Bond"},
-                    {
-                        "headerName": "Maturity (Years)",
-                        "field": "Maturity (Years)",
-                    },
-                ]
-                + [
-                    {
-                        "headerName": label,
-                        "field": label,
-                        "editable": False,
-                        "cellStyle": HEATMAP_STYLE,
-                    }
-                    for label in RATE_TENOR_LABELS
-                ],
-                dashGridOptions={"suppressMovableColumns": True},
+                id="bond-table",
+                rowModelType=GRID_ROW_MODEL,
+                # The infinite row model requests its rows with get_bond_rows
+                **({} if INFINITE_GRID else {"rowData": session.rows()}),
+                getRowId="params.data.id",
+                columnDefs=column_defs,
                 defaultColDef={
                     "sortable": True,
                     "filter": True,
                     "resizable": True,
-                    "width": 88,
+                    "editable": True,
+                },
+                dashGridOptions={
+                    "editable": True,
+                    "rowSelection": "single",
+                    "animateRows": True,
+                    **(INFINITE_GRID_OPTIONS if INFINITE_GRID else {}),
                 },
-                style={"height": "60vh", "width": "100%"},
+                style={"height": "80vh", "width": "100%"},
             ),
-            id="offcanvas-krd-report",
-            title="Key Rate Duration Report",
-            is_open=False,
-            placement="end",
-            backdrop=True,
-            style={"width": "80%"},
-        ),
-    ]
-)
+            dbc.Offcanvas(
+                dcc.Markdown(id="timetable-content"),
+                id="offcanvas-timetable",
+                title="Bond Timetable",
+                is_open=False,
+                placement="end",
+                backdrop=True,
+            ),
+            dbc.Offcanvas(
+                html.Div(
+                    [
+                        dcc.Graph(id="rate-graph", figure=rate_figure()),
+                        AgGrid(
+                            id="rate-editor",
+                            # Filled in by update_rate_editor_data once loaded
+                            rowData=[],
+                            columnDefs=[
+                                numeric_cell("Year", editable=False),
+                                numeric_cell("Rate"),
+                            ],
+                            defaultColDef={
+                                "sortable": True,
+                                "filter": True,
+                                "resizable": True,
+                                "editable": True,
+                            },
+                            dashGridOptions={
+                                "editable": True,
+                                "rowSelection": "single",
+                                "animateRows": True,
+                            },
+                            style={"flex": 1, "width": "100%"},
+                        ),
+                    ]
+                ),
+                id="offcanvas-rate-editor",
+                title="Rate Editor",
+                is_open=False,
+                placement="end",
+                backdrop=True,
+                style={"width": "30%"},
+            ),
+            dbc.Offcanvas(
+                html.Div(
+                    [
+                        dbc.Progress(
+                            id="krd-progress",
+                            value=0,
+                            max=1,
+                            style={"margin-bottom": "10px"},
+                        ),
+                        html.Button(
+                            "Cancel",
+                            id="cancel-krd-button",
+                            n_clicks=0,
+                            disabled=True,
+                        ),
+                        html.Div(id="krd-status"),
+                        AgGrid(
+                            id="krd-report-table",
+                            columnDefs=[
+                                {"headerName": "Bond", "field": "Bond"},
+                                {
+                                    "headerName": "Maturity (Years)",
+                                    "field": "Maturity (Years)",
+                                },
+                            ]
+                            + [
+                                {
+                                    "headerName": label,
+                                    "field": label,
+                                    "editable": False,
+                                    "cellStyle": HEATMAP_STYLE,
+                                }
+                                for label in RATE_TENOR_LABELS
+                            ],
+                            dashGridOptions={"suppressMovableColumns": True},
+                            defaultColDef={
+                                "sortable": True,
+                                "filter": True,
+                                "resizable": True,
+                                "width": 88,
+                            },
+                            style={"height": "60vh", "width": "100%"},
+                        ),
+                    ]
+                ),
+                id="offcanvas-krd-report",
+                title="Key Rate Duration Report",
+                is_open=False,
+                placement="end",
+                backdrop=True,
+                style={"width": "80%"},
+            ),
+            dbc.Offcanvas(
+                AgGrid(
+                    id="scenario-report-table",
+                    columnDefs=[
+                        {"headerName": "Scenario", "field": "Scenario"},
+                        numeric_cell(
+                            "Value", editable=False, value_format="$,.2f"
+                        ),
+                        {
+                            **numeric_cell(
+                                "P&L", editable=False, value_format="$,.2f"
+                            ),
+                            "cellStyle": HEATMAP_STYLE,
+                        },
+                        numeric_cell(
+                            "P&L %", editable=False, value_format=".4f"
+                        ),
+                    ],
+                    defaultColDef={
+                        "sortable": True,
+                        "resizable": True,
+                        "width": 150,
+                    },
+                    style={"height": "60vh", "width": "100%"},
+                ),
+                id="offcanvas-scenario-report",
+                title="Scenario Report",
+                is_open=False,
+                placement="end",
+                backdrop=True,
+                style={"width": "50%"},
+            ),
+            dbc.Offcanvas(
+                html.Div(
+                    [
+                        dcc.Markdown(id="var-summary"),
+                        AgGrid(
+                            id="var-pnl-table",
+                            columnDefs=[
+                                {"headerName": "Date", "field": "Date"},
+                                {
+                                    **numeric_cell(
+                                        "P&L",
+                                        editable=False,
+                                        value_format="$,.2f",
+                                    ),
+                                    "cellStyle": HEATMAP_STYLE,
+                                    "sort": "asc",
+                                },
+                            ],
+                            defaultColDef={
+                                "sortable": True,
+                                "resizable": True,
+                                "width": 150,
+                            },
+                            style={"height": "50vh", "width": "100%"},
+                        ),
+                    ]
+                ),
+                id="offcanvas-var-report",
+                title="Historical VaR Report",
+                is_open=False,
+                placement="end",
+                backdrop=True,
+                style={"width": "40%"},
+            ),
+        ]
+    )
+
 
+app.layout = serve_layout
 
-# Callback to update the bond store data
+# Cold start time, from the start of the process with its imports until the
+# layout can be served
+STARTUP_SECONDS = time.time() - psutil.Process().create_time()
+
+
+# Function to log the cold start time once, on the first page load, after
+# logging is configured
+@functools.cache
+def log_startup():
+    logger.info("App layout ready in %.2f s", STARTUP_SECONDS)
+
+
+# Callback to apply changes to the server side portfolio, and send only
+# the changed rows to the bond table. With the infinite row model, the grid
+# is told to request the blocks in view again instead
 @app.callback(
-    Output("bond-store", "data"),
+    [
+        Output("bond-table", "rowTransaction"),
+        Output("bond-table-refresh", "data"),
+    ],
     [
         Input("add-bond-button", "n_clicks"),
         Input("bond-table", "cellValueChanged"),
         Input("bond-table", "cellRendererData"),
         Input("rate-editor", "cellValueChanged"),
+        Input("rate-editor", "rowData"),
         Input("pricing-datetime-picker", "date"),
     ],
-    State("bond-store", "data"),
+    State("session-id", "data"),
 )
+@instrument
 def update_bond_data(
-    n_clicks_add, cell_change, menu_data, _rate_change, pricing_datetime, data
+    n_clicks_add,
+    cell_change,
+    menu_data,
+    _rate_change,
+    rate_data,
+    pricing_datetime,
+    session_id,
 ):
     ctx = callback_context
 
     if not ctx.triggered:
-        return data
+        return no_update, no_update
 
     trigger = ctx.triggered[0]["prop_id"]
+    # Changes to the bonds keep the session from being evicted by page loads
+    session = PORTFOLIOS.get(
+        session_id,
+        activate=trigger.startswith(("add-bond-button.", "bond-table.")),
+    )
 
-    # Handle Add Bond
-    if trigger == "add-bond-button.n_clicks" and n_clicks_add > 0:
-        new_index = len(data) + 1
-        new_bond = create_default_bond(
-            index=new_index,
-            pricing_datetime=datetime.fromisoformat(pricing_datetime),
-        )
-        data.append(new_bond)
-
-    # Handle Delete Bond from Row Menu
-    elif trigger == "bond-table.cellRendererData":
-        if menu_data and menu_data.get("value") == MenuAction.DELETE.value:
-            row = menu_data.get("rowIndex")
-            if row < len(data):
-                del data[row]
-
-    # Handle Cell Value Change
-    elif trigger == "bond-table.cellValueChanged" and cell_change:
-        if isinstance(cell_change, list):
+    with session.lock:
+        # Handle Add Bond
+        if trigger == "add-bond-button.n_clicks" and n_clicks_add > 0:
+            new_bond = create_default_bond(
+                index=len(session) + 1,
+                pricing_datetime=datetime.fromisoformat(pricing_datetime),
+            )
+            session.add([new_bond])
+            changed = [len(session) - 1]
+            key = "add"
+
+        # Handle Delete Bond from Row Menu
+        elif trigger == "bond-table.cellRendererData":
+            if not (
+                menu_data and menu_data.get("value") == MenuAction.DELETE.value
+            ):
+                return no_update, no_update
+            row_id = menu_row_id(menu_data, session)
+            if row_id is None:
+                return no_update, no_update
+            try:
+                session.remove(row_id)
+            except KeyError:
+                logger.warning("Cannot delete the unknown bond %s", row_id)
+                return no_update, no_update
+            if INFINITE_GRID:
+                return grid_refresh()
+            return {"remove": [{"id": row_id}], "async": False}, no_update
+
+        # Handle Cell Value Change
+        elif trigger == "bond-table.cellValueChanged" and cell_change:
+            changed = []
             for change in cell_change:
-                row_id = int(change.get("rowIndex", -1))
-                field = change.get("colId", "")
-                new_value = change.get("value", "")
-                if row_id >= 0 and field in data[0]:
-                    data[row_id][field] = new_value
-                    data[row_id]["Price"] = (
-                        None  # Set Price to None to trigger recalculation
+                if change.get("colId") not in Portfolio.COLUMNS:
+                    continue
+                try:
+                    changed.append(
+                        session.edit(
+                            change["rowId"], change["colId"], change["value"]
+                        )
+                    )
+                except KeyError:
+                    logger.warning(
+                        "Cannot edit the unknown bond %s", change["rowId"]
                     )
+            if not changed:
+                return no_update, no_update
+            changed = np.unique(changed)
+            key = "update"
+
+        # Invalidate all prices when the rates or the pricing date change
+        elif trigger in (
+            "rate-editor.cellValueChanged",
+            "rate-editor.rowData",
+            "pricing-datetime-picker.date",
+        ):
+            session.portfolio.invalidate()
+            changed = np.arange(len(session))
+            key = "update"
+
+        else:
+            return no_update, no_update
+
+        # The infinite row model prices the rows when it requests them
+        if INFINITE_GRID:
+            return grid_refresh()
+
+        # Price the changed rows, once the rate editor is filled in
+        if rate_data:
+            update_price(
+                session.portfolio,
+                rate_data=rate_data,
+                pricing_datetime=datetime.fromisoformat(pricing_datetime),
+                method="taylor" if FAST_RATE_UPDATE else "analytic",
+                threshold=FAST_RATE_UPDATE_THRESHOLD,
+            )
+
+        return {key: session.rows(changed), "async": False}, no_update
 
-    elif trigger == "rate-editor.cellValueChanged":
-        # Invalidate all prices when the rate data is updated
-        for bond in data:
-            bond["Price"] = None
 
-    return data
+# Function to have the bond table request its rows again, with the infinite
+# row model
+def grid_refresh():
+    return no_update, uuid.uuid4().hex
 
 
-# Callback to update the bond table data
+# Function to find the row id of a row menu click, by index if the grid
+# did not send it
+def menu_row_id(menu_data, session):
+    row_id = menu_data.get("rowId")
+    if row_id is None:
+        row_index = menu_data.get("rowIndex", -1)
+        if 0 <= row_index < len(session):
+            row_id = session.portfolio["id"][row_index]
+    return row_id
+
+
+# Callback to replace the portfolio with an uploaded CSV or Parquet file
 @app.callback(
-    Output("bond-table", "rowData"),
-    Input("bond-store", "data"),
-    Input("pricing-datetime-picker", "date"),
-    State("rate-editor", "rowData"),
+    [
+        Output("bond-table", "rowData"),
+        Output("upload-status", "children"),
+        Output("bond-table-refresh", "data", allow_duplicate=True),
+    ],
+    Input("upload-portfolio", "contents"),
+    [
+        State("upload-portfolio", "filename"),
+        State("rate-editor", "rowData"),
+        State("pricing-datetime-picker", "date"),
+        State("session-id", "data"),
+    ],
+    prevent_initial_call=True,
 )
-def update_table(data, pricing_datetime, rate_data):
-    update_price(
-        data,
-        rate_data=rate_data,
-        pricing_datetime=datetime.fromisoformat(pricing_datetime),
-    )
-    return data
+@instrument
+def upload_portfolio(
+    contents, filename, rate_data, pricing_datetime, session_id
+):
+    _, content_string = contents.split(",", 1)
+    try:
+        portfolio = read_portfolio(
+            pa.BufferReader(base64.b64decode(content_string)),
+            file_format(filename),
+        )
+    except ValueError as e:
+        return no_update, str(e), no_update
 
+    # Prices in the file may be for another curve, so reprice them, before
+    # the file replaces the portfolio, so that a book the curve cannot
+    # price is reported and the session keeps its bonds
+    portfolio.invalidate()
+    if rate_data:
+        try:
+            update_price(
+                portfolio,
+                rate_data=rate_data,
+                pricing_datetime=datetime.fromisoformat(pricing_datetime),
+            )
+        except ValueError as e:
+            return no_update, f"Cannot price {filename}: {e}", no_update
 
-# Callback to update the rate editor data dynamically based on the selected pricing date
+    status = f"Loaded {len(portfolio)} bonds from {filename}"
+    session = PORTFOLIOS.get(session_id, activate=True)
+    with session.lock:
+        session.load(portfolio)
+        if INFINITE_GRID:
+            _, refresh = grid_refresh()
+            return no_update, status, refresh
+        return session.rows(), status, no_update
+
+
+# Callback to serve a block of rows of the bond table with the infinite row
+# model, sorted, filtered and paged on the server. Only the bonds of the
+# block are priced, unless the grid sorts or filters on a risk column
 @app.callback(
-    Output("rate-editor", "rowData"),
+    Output("bond-table", "getRowsResponse"),
+    Input("bond-table", "getRowsRequest"),
+    [
+        State("rate-editor", "rowData"),
+        State("pricing-datetime-picker", "date"),
+        State("session-id", "data"),
+    ],
+    prevent_initial_call=True,
+)
+@instrument
+def get_bond_rows(request, rate_data, pricing_datetime, session_id):
+    if not request:
+        return no_update
+
+    sort_model = request.get("sortModel")
+    filter_model = request.get("filterModel")
+    pricing = {
+        "rate_data": rate_data,
+        "pricing_datetime": datetime.fromisoformat(pricing_datetime),
+        "method": "taylor" if FAST_RATE_UPDATE else "analytic",
+        "threshold": FAST_RATE_UPDATE_THRESHOLD,
+    }
+    session = PORTFOLIOS.get(session_id)
+    with session.lock:
+        risk_query = query_columns(sort_model, filter_model) & set(
+            Portfolio.RISK_COLUMNS
+        )
+        if rate_data and risk_query:
+            update_price(session.portfolio, **pricing)
+
+        try:
+            order = query(session.portfolio, sort_model, filter_model)
+        except ValueError as e:
+            logger.warning("Cannot query the bond table: %s", e)
+            return {"rowData": [], "rowCount": 0}
+
+        block = order[request["startRow"] : request["endRow"]]
+        if rate_data:
+            update_price(session.portfolio, index=block, **pricing)
+        return {"rowData": session.rows(block), "rowCount": len(order)}
+
+
+# Callback in the browser to have the bond table request the blocks in
+# view again, once the server side portfolio has changed
+app.clientside_callback(
+    """
+    function (refresh) {
+        dash_ag_grid.getApiAsync("bond-table").then(
+            (api) => api.refreshInfiniteCache()
+        );
+    }
+    """,
+    Input("bond-table-refresh", "data"),
+    prevent_initial_call=True,
+)
+
+
+# Callback to download the portfolio and its results
+@app.callback(
+    Output("download-portfolio", "data"),
+    [
+        Input("download-csv-button", "n_clicks"),
+        Input("download-parquet-button", "n_clicks"),
+    ],
+    [
+        State("session-id", "data"),
+        State("rate-editor", "rowData"),
+        State("pricing-datetime-picker", "date"),
+    ],
+    prevent_initial_call=True,
+)
+@instrument
+def download_portfolio(
+    _csv_clicks, _parquet_clicks, session_id, rate_data, pricing_datetime
+):
+    trigger = callback_context.triggered[0]["prop_id"]
+    fmt = "csv" if trigger == "download-csv-button.n_clicks" else "parquet"
+    session = PORTFOLIOS.get(session_id)
+    with session.lock:
+        # The infinite row model leaves the bonds never shown unpriced
+        if rate_data:
+            update_price(
+                session.portfolio,
+                rate_data=rate_data,
+                pricing_datetime=datetime.fromisoformat(pricing_datetime),
+            )
+        return dcc.send_bytes(
+            lambda buffer: write_portfolio(session.portfolio, buffer, fmt),
+            f"portfolio.{fmt}",
+        )
+
+
+# Callback to update the rate editor data dynamically based on the selected
+# pricing date, and to say when no curve is stored near that date. Curves
+# ingested or dropped in the source file since they were loaded are picked
+# up on the next page load or date change
+@app.callback(
+    [
+        Output("rate-editor", "rowData"),
+        Output("curve-status", "children"),
+    ],
     Input("pricing-datetime-picker", "date"),
 )
+@instrument
 def update_rate_editor_data(pricing_datetime):
     if pricing_datetime is None:
         pricing_datetime = DEFAULT_PRICING_DATE
+    if isinstance(pricing_datetime, str):
+        pricing_datetime = datetime.fromisoformat(pricing_datetime)
+    get_curve_store().reload()
     rate_data = get_rates_for_date(pricing_datetime)
-    return rate_data
 
+    status = ""
+    curve_date = get_curve_store().stale_curve_date(pricing_datetime)
+    if curve_date is not None:
+        status = (
+            f"No curve stored near {pricing_datetime:%Y-%m-%d}, using the "
+            f"curve of {curve_date:%Y-%m-%d}"
+        )
+    return rate_data, status
 
-# Callback to update the rate graph instantly when rates are edited
+
+# Callback to update the rate graph instantly when rates are edited, by
+# patching the data of the figure. Rate edits keep the time grid, so only
+# a new curve sends the times
 @app.callback(
     Output("rate-graph", "figure"),
     Input("rate-editor", "cellValueChanged"),
-    State("rate-editor", "rowData"),
+    Input("rate-editor", "rowData"),
 )
+@instrument
 def update_rate_graph(_rate_change, rate_data):
+    if not rate_data:
+        return no_update
+
     rates_df = rates_table(rate_data)
-    return plot_rates(rates_df)
+    x_range, y_range = rate_ranges(rates_df)
+    figure = Patch()
+    triggered = [t["prop_id"] for t in callback_context.triggered]
+    if triggered != ["rate-editor.cellValueChanged"]:
+        times = rates_df["Time"].to_numpy()
+        figure["data"][0]["x"] = times
+        figure["data"][1]["x"] = times
+        figure["layout"]["xaxis"]["range"] = x_range
+    figure["data"][0]["y"] = rates_df["Term Rate"].to_numpy()
+    figure["data"][1]["y"] = rates_df["Fwd Rate"].to_numpy()
+    figure["layout"]["yaxis"]["range"] = y_range
+    return figure
 
 
 # Callback to show timetable in the off-canvas
@@ -323,13 +819,15 @@ def update_rate_graph(_rate_change, rate_data):
         Output("offcanvas-timetable", "is_open"),
     ],
     Input("bond-table", "cellRendererData"),
-    State("bond-store", "data"),
+    State("session-id", "data"),
 )
-def show_timetable(menu_data, data):
+@instrument
+def show_timetable(menu_data, session_id):
     if menu_data and menu_data.get("value") == MenuAction.SHOW_TIMETABLE.value:
-        row_index = menu_data.get("rowIndex", -1)
-        if row_index >= 0 and row_index < len(data):
-            bond_obj, _ = bond_dict_to_obj(data[row_index])
+        session = PORTFOLIOS.get(session_id)
+        row_id = menu_row_id(menu_data, session)
+        if row_id is not None:
+            bond_obj, _ = cached_bond(session.row(row_id))
             full_text = f"```\n{bond_obj.to_string()}\n```"
             return full_text, True
 
@@ -342,32 +840,213 @@ def show_timetable(menu_data, data):
     Input("rate-editor-button", "n_clicks"),
     [State("offcanvas-rate-editor", "is_open")],
 )
+@instrument
 def toggle_rate_editor(n_clicks, is_open):
     if n_clicks:
         return not is_open
     return is_open
 
 
-# Callback to handle Key Rate Duration Report Off-canvas
+# Function to key a Key Rate Duration Report by the content of its inputs
+def krd_report_key(content_hash, rate_data, pricing_datetime):
+    return (
+        "krd-report",
+        content_hash,
+        json.dumps(rate_data, sort_keys=True),
+        pricing_datetime,
+    )
+
+
+# Callback to start a Key Rate Duration Report. The job process does not
+# share the memory of the server, so a snapshot of the portfolio is put in
+# the job cache, keyed by its content, for the job to read
+@app.callback(
+    Output("krd-job", "data"),
+    Input("show-krd-button", "n_clicks"),
+    State("session-id", "data"),
+    State("rate-editor", "rowData"),
+    prevent_initial_call=True,
+)
+@instrument
+def start_krd_report(_n_clicks, session_id, rate_data):
+    if not rate_data:
+        return no_update  # The curve is not loaded yet
+
+    session = PORTFOLIOS.get(session_id)
+    with session.lock:
+        content_hash = session.portfolio.content_hash()
+        key = ("krd-portfolio", content_hash)
+        if not JOB_CACHE.touch(key, expire=KRD_RESULT_EXPIRE):
+            JOB_CACHE.set(key, session.portfolio, expire=KRD_RESULT_EXPIRE)
+    # A new job id starts the report again, even for the same portfolio
+    return {"portfolio": content_hash, "job": uuid.uuid4().hex}
+
+
+# Callback to calculate the Key Rate Duration Report as a background job,
+# streaming the rows into the table as each chunk of bonds finishes. It is
+# not instrumented, since its metrics would stay in the job process
 @app.callback(
     [
         Output("krd-report-table", "rowData"),
-        Output("offcanvas-krd-report", "is_open"),
+        Output("krd-status", "children"),
     ],
-    Input("show-krd-button", "n_clicks"),
-    State("bond-store", "data"),
+    Input("krd-job", "data"),
     State("rate-editor", "rowData"),
     State("pricing-datetime-picker", "date"),
+    background=True,
+    running=[
+        (Output("show-krd-button", "disabled"), True, False),
+        (Output("cancel-krd-button", "disabled"), False, True),
+        (Output("offcanvas-krd-report", "is_open"), True, True),
+    ],
+    cancel=[Input("cancel-krd-button", "n_clicks")],
+    progress=[
+        Output("krd-progress", "value"),
+        Output("krd-progress", "max"),
+        Output("krd-report-table", "rowData", allow_duplicate=True),
+    ],
+    prevent_initial_call=True,
 )
-def show_krd_report(n_clicks, data, rate_data, pricing_datetime):
+def show_krd_report(set_progress, krd_job, rate_data, pricing_datetime):
+    portfolio = JOB_CACHE.get(("krd-portfolio", krd_job["portfolio"]))
+    if portfolio is None:
+        return [], "The portfolio has expired, show the report again"
+
+    key = krd_report_key(krd_job["portfolio"], rate_data, pricing_datetime)
+    krd_data = JOB_CACHE.get(key)
+    if krd_data is None:
+        # The KRD of each bond on this curve are kept for the next report,
+        # which then only computes the bonds that changed
+        results_key = ("krd-results", curve_hash(rate_data), pricing_datetime)
+        results = BatchCache(
+            JOB_CACHE.get(results_key), maxsize=RESULT_CACHE.maxsize
+        )
+        krd_data = []
+        chunks = iter_key_rate_duration(
+            portfolio,
+            rate_data,
+            datetime.fromisoformat(pricing_datetime),
+            chunk_size=max(
+                KRD_CHUNK_SIZE, -(-len(portfolio) // KRD_PROGRESS_STEPS)
+            ),
+            cache=results,
+        )
+        for done, krd_rows in chunks:
+            krd_data.extend(krd_rows)
+            set_progress((done, len(portfolio), krd_data))
+        if results.changed:
+            JOB_CACHE.set(
+                results_key, results.save(), expire=KRD_RESULT_EXPIRE
+            )
+        JOB_CACHE.set(key, krd_data, expire=KRD_RESULT_EXPIRE)
+    else:
+        set_progress((len(portfolio), len(portfolio), krd_data))
+
+    return krd_data, f"{len(krd_data)} bonds"
+
+
+# Callback to reprice the portfolio under the standard curve scenarios
+@app.callback(
+    [
+        Output("scenario-report-table", "rowData"),
+        Output("offcanvas-scenario-report", "is_open"),
+    ],
+    Input("show-scenario-button", "n_clicks"),
+    State("session-id", "data"),
+    State("rate-editor", "rowData"),
+    State("pricing-datetime-picker", "date"),
+)
+@instrument
+def show_scenario_report(n_clicks, session_id, rate_data, pricing_datetime):
     if n_clicks == 0:
         return [], False
+    if not rate_data:
+        return no_update, no_update  # The curve is not loaded yet
+
+    names, shifts = standard_scenarios([rate["Year"] for rate in rate_data])
+    session = PORTFOLIOS.get(session_id)
+    with session.lock:
+        base, prices = scenario_prices(
+            session.portfolio,
+            rate_data,
+            datetime.fromisoformat(pricing_datetime),
+            shifts,
+        )
+    return scenario_report(names, base, prices), True
+
+
+# Callback to show the historical VaR of the portfolio, from the daily
+# curve changes up to the pricing date
+@app.callback(
+    [
+        Output("var-summary", "children"),
+        Output("var-pnl-table", "rowData"),
+        Output("offcanvas-var-report", "is_open"),
+    ],
+    Input("show-var-button", "n_clicks"),
+    State("session-id", "data"),
+    State("rate-editor", "rowData"),
+    State("pricing-datetime-picker", "date"),
+)
+@instrument
+def show_var_report(n_clicks, session_id, rate_data, pricing_datetime):
+    if n_clicks == 0:
+        return "", [], False
+    if not rate_data:
+        return no_update, no_update, no_update  # The curve is not loaded yet
+
+    session = PORTFOLIOS.get(session_id)
+    try:
+        with session.lock:
+            var = historical_var(
+                session.portfolio,
+                rate_data,
+                datetime.fromisoformat(pricing_datetime),
+            )
+    except ValueError as e:
+        return str(e), [], True
+
+    summary = (
+        f"**{var['Confidence']:.0%} 1-day VaR:** ${var['VaR']:,.2f}  \n"
+        f"**Expected shortfall:** ${var['ES']:,.2f}  \n"
+        f"{var['Scenarios']} daily curve changes"
+    )
+    pnl_rows = [
+        {"Date": str(date)[:10], "P&L": float(pnl)}
+        for date, pnl in zip(var["Dates"], var["P&L"])
+    ]
+    return summary, pnl_rows, True
+
+
+# Local endpoint with the recorded callback metrics
+@app.server.route("/metrics")
+def metrics_endpoint():
+    if flask.request.remote_addr not in ("127.0.0.1", "::1"):
+        flask.abort(403)
+    return flask.jsonify(
+        {**metrics.snapshot(), "startup_seconds": STARTUP_SECONDS}
+    )
+
+
+# Callback to show the most recent callback metrics, newest first
+if metrics.ENABLED:
 
-    krd_data = calculate_key_rate_duration(
-        data, rate_data, datetime.fromisoformat(pricing_datetime)
+    @app.callback(
+        [
+            Output("metrics-table", "rowData"),
+            Output("metrics-table", "columnDefs"),
+            Output("offcanvas-metrics", "is_open"),
+        ],
+        Input("metrics-button", "n_clicks"),
+        prevent_initial_call=True,
     )
-    return krd_data, True
+    def show_metrics(_n_clicks):
+        recent = metrics.snapshot()["recent"][::-1]
+        fields = list(dict.fromkeys(key for row in recent for key in row))
+        column_defs = [{"field": field} for field in fields if field != "time"]
+        return recent, column_defs, True
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     app.run_server(debug=True)
@@ -0,0 +1,302 @@
+"""Scaling benchmarks of the pricing and curve paths.
+
+Run from the repository root, curves come from the test fixture:
+    python -m benchmarks.run                  # compare with the baseline
+    python -m benchmarks.run --save-baseline  # record a new baseline
+
+Each case runs on synthetic portfolios of 1 to 100k bonds and reports the
+best wall time of a few repeats, the throughput, and the peak memory
+traced in a separate run.
+"""
+
+import os
+import tempfile
+
+# Serve curves from the local fixture, before src.rates reads the settings
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault(
+    "CURVE_SOURCE", os.path.join(ROOT, "tests", "data", "treasury_rates.csv")
+)
+os.environ.setdefault(
+    "CURVE_STORE_PATH",
+    os.path.join(tempfile.mkdtemp(), "treasury_rates.parquet"),
+)
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from qablet.base.fixed import FixedModel
+from qablet_contracts.timetable import py_to_ts
+
+from src.batch import CASHFLOW_CACHE
+from src.bond import (
+    BOND_CACHE,
+    Portfolio,
+    bond_dict_to_obj,
+    cached_bond_terms,
+)
+from src.price import (
+    RESULT_CACHE,
+    SENSITIVITY_CACHE,
+    calculate_key_rate_duration,
+    price_shocked,
+    update_price,
+)
+from src.rates import (
+    CURVE_CACHE,
+    get_curve_store,
+    get_rates_for_date,
+    rates_table,
+)
+
+SIZES = [1, 10, 100, 1000, 10000, 100000]
+PRICING_DATETIME = datetime(2024, 1, 2)
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def synthetic_portfolio(n_bonds, seed=0, distinct=False):
+    """Return a Portfolio of n_bonds random fixed rate bonds, accruing from
+    the pricing date and maturing at a year end within 30 years.
+
+    The coupons are multiples of 0.25%, so bonds share their terms beyond
+    about 2.3k bonds, unless distinct is set, which gives every bond its
+    own coupon."""
+    rng = np.random.default_rng(seed)
+    years = rng.integers(2026, 2053, n_bonds).astype(str)
+    coupons = rng.integers(4, 33, n_bonds) / 4
+    if distinct:
+        coupons += np.arange(n_bonds) / (4 * n_bonds)
+    return Portfolio(
+        {
+            "Bond": np.array([f"Bond {i + 1}" for i in range(n_bonds)]),
+            "Currency": np.full(n_bonds, "USD"),
+            "Coupon": coupons,
+            "Accrual Start": np.full(n_bonds, "2024-01-02"),
+            "Maturity": np.char.add(years, "-12-31"),
+            "Frequency": rng.choice([1, 2, 4], n_bonds),
+            "Notional": np.full(n_bonds, 100.0),
+        }
+    )
+
+
+def clear_caches():
+    BOND_CACHE.clear()
+    CASHFLOW_CACHE.clear()
+    SENSITIVITY_CACHE.clear()
+    CURVE_CACHE.clear()
+    RESULT_CACHE.clear()
+
+
+def warm(portfolio, rate_data):
+    """Fill the bond and cashflow caches for the bonds of a portfolio, but
+    not the result cache, so that the results are computed."""
+    update_price(portfolio.take(slice(None)), rate_data, PRICING_DATETIME)
+    RESULT_CACHE.clear()
+
+
+# Each benchmark prepares its inputs for n items, untimed, and returns the
+# function to time
+def bench_update_price_cold(n, rate_data):
+    clear_caches()
+    portfolio = synthetic_portfolio(n)
+    return lambda: update_price(portfolio, rate_data, PRICING_DATETIME)
+
+
+def bench_update_price_warm(n, rate_data):
+    portfolio = synthetic_portfolio(n)
+    warm(portfolio, rate_data)
+    return lambda: update_price(portfolio, rate_data, PRICING_DATETIME)
+
+
+def bench_update_price_distinct(n, rate_data):
+    # Bonds with distinct terms, from a cashflow cache sized for half of
+    # them, which must grow to hold them all instead of missing on every
+    # bond of each reprice
+    portfolio = synthetic_portfolio(n, distinct=True)
+    CASHFLOW_CACHE.resize(max(1, n // 2))
+    warm(portfolio, rate_data)
+    return lambda: update_price(portfolio, rate_data, PRICING_DATETIME)
+
+
+def bench_update_price_cached(n, rate_data):
+    portfolio = synthetic_portfolio(n)
+    update_price(portfolio.take(slice(None)), rate_data, PRICING_DATETIME)
+    return lambda: update_price(
+        portfolio.take(slice(None)), rate_data, PRICING_DATETIME
+    )
+
+
+def bench_key_rate_duration(n, rate_data):
+    portfolio = synthetic_portfolio(n)
+    warm(portfolio, rate_data)
+    return lambda: calculate_key_rate_duration(
+        portfolio, rate_data, PRICING_DATETIME
+    )
+
+
+def bench_price_shocked(n, rate_data):
+    portfolio = synthetic_portfolio(n)
+    timetables = [cached_bond_terms(terms)[1] for terms in portfolio.terms()]
+    dataset = {
+        "BASE": "USD",
+        "PRICING_TS": py_to_ts(PRICING_DATETIME).value,
+        "ASSETS": {
+            "USD": (
+                "ZERO_RATES",
+                np.array([[r["Year"], r["Rate"] / 100] for r in rate_data]),
+            )
+        },
+    }
+    model = FixedModel()
+    return lambda: [
+        price_shocked(model, timetable, dataset, 0.01)
+        for timetable in timetables
+    ]
+
+
+def bench_bond_dict_to_obj(n, rate_data):
+    rows = synthetic_portfolio(n).to_rows()
+    return lambda: [bond_dict_to_obj(row) for row in rows]
+
+
+def bench_rates_table(n, rate_data):
+    return lambda: [rates_table(rate_data) for _ in range(n)]
+
+
+def bench_get_rates_for_date(n, rate_data):
+    get_curve_store().frame()
+    rng = np.random.default_rng(0)
+    dates = [
+        datetime(2024, 1, 1 + day).isoformat()
+        for day in rng.integers(0, 12, n)
+    ]
+    return lambda: [get_rates_for_date(date) for date in dates]
+
+
+# Benchmark name: (function, largest size, unit of size)
+BENCHMARKS = {
+    "update_price_cold": (bench_update_price_cold, 100000, "bonds"),
+    "update_price_warm": (bench_update_price_warm, 100000, "bonds"),
+    "update_price_distinct": (bench_update_price_distinct, 10000, "bonds"),
+    "update_price_cached": (bench_update_price_cached, 100000, "bonds"),
+    "key_rate_duration": (bench_key_rate_duration, 100000, "bonds"),
+    "price_shocked": (bench_price_shocked, 1000, "bonds"),
+    "bond_dict_to_obj": (bench_bond_dict_to_obj, 10000, "bonds"),
+    "rates_table": (bench_rates_table, 100, "calls"),
+    "get_rates_for_date": (bench_get_rates_for_date, 1000, "calls"),
+}
+
+
+def measure(bench, n, rate_data, repeat):
+    """Return the best time of a benchmark, and its peak traced memory."""
+    best = float("inf")
+    for _ in range(repeat):
+        run = bench(n, rate_data)
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+
+    run = bench(n, rate_data)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 2**20
+
+
+def run_benchmarks(names, max_size, repeat):
+    rate_data = get_rates_for_date(PRICING_DATETIME)
+    results = {}
+    for name in names:
+        bench, largest, unit = BENCHMARKS[name]
+        for n in SIZES:
+            if n > min(largest, max_size):
+                break
+            seconds, peak_mb = measure(bench, n, rate_data, repeat)
+            results[f"{name}[{n}]"] = {
+                "seconds": seconds,
+                "per_second": n / seconds,
+                "unit": unit,
+                "peak_mb": peak_mb,
+            }
+            print(
+                f"{name + f'[{n}]':<28} {seconds:10.4f} s"
+                f" {n / seconds:12,.0f} {unit}/s {peak_mb:9.2f} MB",
+                flush=True,
+            )
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Return the cases slower than the baseline by more than tolerance.
+
+    Cases faster than min_seconds are too noisy to compare."""
+    regressions = []
+    for case, result in results.items():
+        base = baseline.get(case)
+        if base is None or result["seconds"] < min_seconds:
+            continue
+        ratio = result["seconds"] / base["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append(f"{case}: {ratio:.2f}x the baseline time")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run", description=__doc__.splitlines()[0]
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        choices=[[]] + list(BENCHMARKS),
+        help="benchmarks to run (default: all)",
+    )
+    parser.add_argument("--max-size", type=int, default=max(SIZES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save the results as the baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.5,
+        help="allowed slowdown over the baseline (default: %(default)s)",
+    )
+    parser.add_argument("--min-seconds", type=float, default=0.005)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.names or list(BENCHMARKS), args.max_size, args.repeat
+    )
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, nothing to compare")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print("No regressions against the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
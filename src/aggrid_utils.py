@@ -12,15 +12,25 @@ def select_cell(field, values, width=100):
     }
 
 
-def numeric_cell(field, width=100, editable=True):
-    return {
+def numeric_cell(field, width=100, editable=True, value_format=None):
+    """A numeric column, optionally displayed with a d3 format string such
+    as "$.6f". The formatting is done in the browser, so the row data keeps
+    the raw numbers for sorting and export."""
+    column = {
         "headerName": field,
         "field": field,
         "editable": editable,
         "type": "numericColumn",
         "cellEditor": "agNumberCellEditor",
+        "filter": "agNumberColumnFilter",
         "width": width,
     }
+    if value_format is not None:
+        column["valueFormatter"] = {
+            "function": f"params.value == null ? '' : "
+            f"d3.format('{value_format}')(params.value)"
+        }
+    return column
 
 
 def datestring_cell(field, width=150):
@@ -28,6 +38,8 @@ def datestring_cell(field, width=150):
         "headerName": field,
         "field": field,
         "editable": True,
+        "cellDataType": "dateString",
         "cellEditor": "agDateStringCellEditor",
+        "filter": "agDateColumnFilter",
         "width": width,
     }
@@ -0,0 +1,199 @@
+"""Vectorized pricing of a whole portfolio of bonds."""
+
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pyarrow as pa
+from qablet_contracts.timetable import py_to_ts
+from scipy import sparse
+
+from src.bond import cached_bond_terms
+from src.cache import LRUCache
+from src.curve import CURVE_CURRENCY, MS_IN_YEAR
+from src.metrics import register_cache
+
+# Cashflow arrays of the bond timetables, memoized on the bond terms. An
+# entry takes a few hundred bytes, and the cache grows past
+# CASHFLOW_CACHE_SIZE entries to hold every bond of the largest portfolio
+# priced, since a full reprice of more bonds than it holds would miss on
+# every bond and rebuild every timetable.
+CASHFLOW_CACHE = LRUCache(
+    maxsize=int(os.environ.get("CASHFLOW_CACHE_SIZE", "100000"))
+)
+register_cache("cashflow_cache", CASHFLOW_CACHE)
+
+
+@dataclass
+class CashflowMatrix:
+    """Cashflows of a portfolio, one row per bond, padded with zeros.
+
+    Args:
+        times: cashflow times in years from the pricing date.
+        amounts: cashflow amounts per unit notional.
+        notionals: the notional of each bond.
+    """
+
+    times: np.ndarray
+    amounts: np.ndarray
+    notionals: np.ndarray
+
+
+def timetable_cashflows(timetable):
+    """Return the event timestamps (ms) and amounts of a timetable.
+
+    Amounts in a unit other than CURVE_CURRENCY are NaN, so bonds in
+    another currency are left unpriced rather than discounted on the
+    wrong curve.
+    """
+    events = timetable["events"]
+    times = events.column("time").cast(pa.int64()).to_numpy()
+    amounts = events.column("quantity").to_numpy()
+    units = (
+        events.column("unit").cast(pa.string()).to_numpy(zero_copy_only=False)
+    )
+    return times, np.where(units == CURVE_CURRENCY, amounts, np.nan)
+
+
+def cached_cashflows(terms):
+    """Return the cashflows of a bond from its terms, as in
+    timetable_cashflows, reusing them from CASHFLOW_CACHE."""
+    flows = CASHFLOW_CACHE.get(terms)
+    if flows is None:
+        _, timetable = cached_bond_terms(terms)
+        flows = timetable_cashflows(timetable)
+        CASHFLOW_CACHE.put(terms, flows)
+    return flows
+
+
+def cashflow_matrix(portfolio, pricing_datetime):
+    """Build the cashflow matrix of a Portfolio. The rows of bonds in a
+    currency other than CURVE_CURRENCY are NaN, and so are their prices
+    and risks."""
+    pricing_ts = py_to_ts(pricing_datetime).value
+    CASHFLOW_CACHE.reserve(len(portfolio))
+    flows = [cached_cashflows(terms) for terms in portfolio.terms()]
+
+    # Scatter the concatenated cashflows into the padded rows
+    lengths = np.array([len(ts) for ts, _ in flows], dtype=int)
+    width = lengths.max(initial=0)
+    filled = np.arange(width) < lengths[:, None]
+    times = np.zeros((len(flows), width))
+    amounts = np.zeros((len(flows), width))
+    if flows:
+        ts = np.concatenate([ts for ts, _ in flows])
+        times[filled] = (ts - pricing_ts) / MS_IN_YEAR
+        amounts[filled] = np.concatenate([amts for _, amts in flows])
+
+    return CashflowMatrix(times, amounts, portfolio["Notional"].copy())
+
+
+def price_batch(cashflows, curve):
+    """Price all bonds of a cashflow matrix, per unit notional."""
+    return (cashflows.amounts * curve.discount(cashflows.times)).sum(axis=1)
+
+
+def risk_batch(cashflows, curve):
+    """Price all bonds with duration and convexity in closed form.
+
+    A parallel shift s of the zero rates scales each discount factor by
+    exp(-s * t), so the derivatives of the price with respect to s are
+    the discounted cashflows weighted by -t and t**2.
+
+    Returns:
+        price per unit notional, duration, and convexity per unit notional
+        (the second derivative of the price, as in the bumped version).
+    """
+    pv = cashflows.amounts * curve.discount(cashflows.times)
+    price = pv.sum(axis=1)
+    first = (pv * cashflows.times).sum(axis=1)
+    second = (pv * cashflows.times**2).sum(axis=1)
+    return price, first / price, second
+
+
+def shocked_prices(cashflows, curve, shocks):
+    """Reprice all bonds with additive shocks to the curve's zero rates.
+
+    The discounted cashflows are gathered on the unique cashflow times of
+    the portfolio, and each scenario scales them by exp(-shock @ jacobian),
+    so all scenarios are priced with a single sparse matrix product.
+
+    Args:
+        cashflows: the CashflowMatrix of the portfolio.
+        curve: the base ZeroCurve.
+        shocks: a (scenarios, tenors) array of zero rate shifts.
+
+    Returns:
+        a (bonds, scenarios) array of prices per unit notional.
+    """
+    times, pv_matrix = discounted_cashflows(cashflows, curve)
+    factors = np.exp(-np.atleast_2d(shocks) @ curve.jacobian(times))
+    return pv_matrix @ factors.T
+
+
+def discounted_cashflows(cashflows, curve):
+    """Return the unique cashflow times of the portfolio, and the sparse
+    (bonds, times) matrix of discounted cashflows per unit notional."""
+    n_bonds, width = cashflows.times.shape
+    times, index = np.unique(cashflows.times.ravel(), return_inverse=True)
+    pv = cashflows.amounts * curve.discount(cashflows.times)
+    pv_matrix = sparse.csr_matrix(
+        (pv.ravel(), (np.repeat(np.arange(n_bonds), width), index)),
+        shape=(n_bonds, len(times)),
+    )
+    return times, pv_matrix
+
+
+def taylor_expansion(cashflows, curve):
+    """Return second order expansions of the bonds in the tenor zero rates.
+
+    Each row holds, per unit notional: the price P, the first and second
+    derivatives of P to a parallel shift (-D1 and C), then the gradients
+    of P, D1 and C to the tenor rates, and the diagonal and off-diagonal
+    of the hessian of P. The jacobian rows are hat functions, so the
+    hessian is tridiagonal.
+    """
+    times, pv_matrix = discounted_cashflows(cashflows, curve)
+    jac = curve.jacobian(times)
+    return np.column_stack(
+        [
+            pv_matrix @ np.ones_like(times),
+            pv_matrix @ times,
+            pv_matrix @ times**2,
+            -(pv_matrix @ jac.T),
+            -(pv_matrix @ (jac * times).T),
+            -(pv_matrix @ (jac * times**2).T),
+            pv_matrix @ (jac**2).T,
+            pv_matrix @ (jac[:-1] * jac[1:]).T,
+        ]
+    )
+
+
+def taylor_update(expansion, shift):
+    """Apply tenor rate shifts to expansions from taylor_expansion.
+
+    Args:
+        expansion: the (bonds, 5 * tenors + 2) expansions.
+        shift: the tenor rate shifts, for all bonds or one row per bond.
+
+    Returns:
+        price per unit notional, duration, and convexity per unit notional,
+        with the price to second order and the others to first order.
+    """
+    shift = np.atleast_2d(shift)
+    n = shift.shape[1]
+    price, first, second = expansion[:, 0], expansion[:, 1], expansion[:, 2]
+    delta, delta_first, delta_second, gamma = np.split(
+        expansion[:, 3 : 3 + 4 * n], 4, axis=1
+    )
+    gamma_off = expansion[:, 3 + 4 * n :]
+
+    price = (
+        price
+        + (delta * shift).sum(axis=1)
+        + 0.5 * (gamma * shift**2).sum(axis=1)
+        + (gamma_off * shift[:, :-1] * shift[:, 1:]).sum(axis=1)
+    )
+    first = first + (delta_first * shift).sum(axis=1)
+    second = second + (delta_second * shift).sum(axis=1)
+    return price, first / price, second
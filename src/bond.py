@@ -1,7 +1,19 @@
+import hashlib
+import math
+import os
 from datetime import datetime, timedelta
+from types import MappingProxyType
 
+import numpy as np
 from qablet_contracts.bnd.fixed import FixedBond
 
+from src.cache import LRUCache
+from src.metrics import count, register_cache
+
+# Bonds and timetables memoized on their economic terms
+BOND_CACHE = LRUCache(maxsize=int(os.environ.get("BOND_CACHE_SIZE", "10000")))
+register_cache("bond_cache", BOND_CACHE)
+
 DEFAULT_MENU = [
     {"label": "Delete", "value": 1},
     {"label": "Show Timetable", "value": 2},
@@ -21,6 +33,224 @@ def bond_dict_to_obj(bond):
     return bond_obj, notional
 
 
+def bond_terms(bond):
+    """Return the economic terms of a bond dictionary, as a hashable key."""
+    return (
+        bond["Currency"],
+        float(bond["Coupon"]),
+        bond["Accrual Start"],
+        bond["Maturity"],
+        int(bond["Frequency"]),
+    )
+
+
+def cached_bond(bond):
+    """Return the FixedBond and its timetable for a bond dictionary,
+    reusing them from BOND_CACHE if a bond with the same terms was seen."""
+    return cached_bond_terms(bond_terms(bond))
+
+
+def cached_bond_terms(terms):
+    """Return the FixedBond and its timetable for the terms of a bond, as
+    returned by bond_terms, reusing them from BOND_CACHE."""
+    entry = BOND_CACHE.get(terms)
+    if entry is None:
+        currency, coupon, accrual_start, maturity, frequency = terms
+        bond_obj = FixedBond(
+            currency,
+            coupon / 100,
+            datetime.strptime(accrual_start, "%Y-%m-%d"),
+            datetime.strptime(maturity, "%Y-%m-%d"),
+            f"{frequency}QE",
+        )
+        entry = (bond_obj, bond_obj.timetable())
+        BOND_CACHE.put(terms, entry)
+    return entry
+
+
+def date_strings(dates):
+    """Return ISO strings of datetime64 dates, formatting each distinct
+    date once, since a book has few of them."""
+    unique, inverse = np.unique(dates, return_inverse=True)
+    return np.datetime_as_string(unique).astype(object)[inverse].tolist()
+
+
+class Portfolio:
+    """A portfolio of bonds stored column by column in NumPy arrays.
+
+    The columns are named after the bond table fields. Dates are
+    datetime64[D], and Price, Duration and Convexity are NaN for bonds
+    that are not priced yet. Pricing works on whole columns, and rows are
+    only converted to and from dictionaries for the grid.
+
+    Examples:
+        >>> portfolio = Portfolio.from_rows([create_default_bond(1)])
+        >>> portfolio["Maturity"].dtype
+        dtype('<M8[D]')
+        >>> portfolio.unpriced()
+        array([0])
+    """
+
+    COLUMNS = MappingProxyType(
+        {
+            "id": object,
+            "Bond": object,
+            "Currency": object,
+            "Coupon": float,
+            "Accrual Start": "datetime64[D]",
+            "Maturity": "datetime64[D]",
+            "Frequency": np.int64,
+            "Notional": float,
+            "Price": float,
+            "Duration": float,
+            "Convexity": float,
+        }
+    )
+    RISK_COLUMNS = ("Price", "Duration", "Convexity")
+
+    def __init__(self, columns=None):
+        columns = columns or {}
+        size = max((len(v) for v in columns.values()), default=0)
+        self.columns = {}
+        for field, dtype in self.COLUMNS.items():
+            values = columns.get(field)
+            if values is None:
+                values = np.full(size, np.nan if dtype is float else None)
+            elif dtype is float and np.asarray(values).dtype.kind != "f":
+                values = [np.nan if v is None else v for v in values]
+            self.columns[field] = np.asarray(values, dtype=dtype)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Create a portfolio from bond table rows."""
+        return cls(
+            {
+                field: [row.get(field) for row in rows]
+                for field in cls.COLUMNS
+                if any(field in row for row in rows)
+            }
+        )
+
+    @classmethod
+    def concat(cls, portfolios):
+        """Join portfolios end to end into a new one."""
+        portfolios = list(portfolios)
+        if not portfolios:
+            return cls()
+        return cls(
+            {
+                field: np.concatenate([p[field] for p in portfolios])
+                for field in cls.COLUMNS
+            }
+        )
+
+    def to_rows(self, index=None):
+        """Return bond table rows, for all bonds or the ones at index."""
+        if index is None:
+            index = range(len(self))
+        columns = {
+            field: values[index].tolist()
+            for field, values in self.columns.items()
+        }
+        for field in ["Accrual Start", "Maturity"]:
+            columns[field] = [d.isoformat() for d in columns[field]]
+        for field in self.RISK_COLUMNS:
+            columns[field] = [
+                None if math.isnan(v) else v for v in columns[field]
+            ]
+
+        rows = [
+            dict(zip(columns, values)) for values in zip(*columns.values())
+        ]
+        for row in rows:
+            if row["id"] is None:
+                del row["id"]
+            row["Menu"] = DEFAULT_MENU
+        return rows
+
+    def __len__(self):
+        return len(self.columns["Bond"])
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def take(self, index):
+        """Return a new portfolio with copies of the bonds at index."""
+        count("portfolio.copies")
+        return Portfolio(
+            {
+                field: np.array(values[index])
+                for field, values in self.columns.items()
+            }
+        )
+
+    def append(self, rows):
+        """Add bond table rows at the end of the portfolio."""
+        new = Portfolio.from_rows(rows)
+        for field, values in self.columns.items():
+            self.columns[field] = np.concatenate([values, new[field]])
+
+    def delete(self, index):
+        """Remove the bonds at index."""
+        for field, values in self.columns.items():
+            self.columns[field] = np.delete(values, index)
+
+    def set_value(self, i, field, value):
+        """Set one field of one bond, as edited in the bond table."""
+        dtype = self.COLUMNS[field]
+        if dtype is float and value is None:
+            value = np.nan
+        self.columns[field][i] = np.asarray(value, dtype=dtype)
+
+    def unpriced(self):
+        """Return the positions of the bonds without a price."""
+        return np.flatnonzero(np.isnan(self.columns["Price"]))
+
+    def invalidate(self, index=slice(None)):
+        """Clear the price and risk of the bonds at index."""
+        for field in self.RISK_COLUMNS:
+            self.columns[field][index] = np.nan
+
+    def set_risk(self, index, price, duration, convexity):
+        """Store the price (per notional amount), duration and convexity of
+        the bonds at index."""
+        self.columns["Price"][index] = price
+        self.columns["Duration"][index] = duration
+        self.columns["Convexity"][index] = convexity
+
+    def terms(self):
+        """Return the economic terms of each bond, as in bond_terms."""
+        return list(
+            zip(
+                self.columns["Currency"].tolist(),
+                self.columns["Coupon"].tolist(),
+                date_strings(self.columns["Accrual Start"]),
+                date_strings(self.columns["Maturity"]),
+                self.columns["Frequency"].tolist(),
+            )
+        )
+
+    def maturity_years(self):
+        """Return the maturity of each bond in years from accrual start."""
+        return (
+            self.columns["Maturity"] - self.columns["Accrual Start"]
+        ).astype(float) / 365
+
+    def content_hash(self):
+        """Return a hex digest of the names, terms and notionals of the
+        bonds, which the results of a report depend on."""
+        digest = hashlib.sha256()
+        for field in self.COLUMNS:
+            if field == "id" or field in self.RISK_COLUMNS:
+                continue
+            values = self.columns[field]
+            if values.dtype == object:
+                digest.update(repr(values.tolist()).encode())
+            else:
+                digest.update(values.tobytes())
+        return digest.hexdigest()
+
+
 # Function to create a new bond with default values and pricing datetime
 def create_default_bond(index, pricing_datetime=None):
     if pricing_datetime is None:
@@ -36,6 +266,6 @@ def create_default_bond(index, pricing_datetime=None):
         ),
         "Frequency": 1,
         "Notional": 100,
-        "Price": "",
+        "Price": None,
         "Menu": DEFAULT_MENU,
     }
@@ -0,0 +1,154 @@
+"""A small thread safe LRU cache with hit and miss counts."""
+
+import os
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+_caches = weakref.WeakSet()
+
+
+def _reset_locks():
+    # A forked process, such as a background job, gets a copy of the locks
+    # that other threads of the parent may hold, so it needs new ones
+    for cache in _caches:
+        cache._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks)
+
+
+class LRUCache:
+    """A mapping that evicts the least recently used entry beyond maxsize.
+
+    Examples:
+        >>> cache = LRUCache(maxsize=2)
+        >>> cache.put("a", 1)
+        >>> cache.get("a"), cache.get("b")
+        (1, None)
+        >>> cache.cache_info()
+        CacheInfo(hits=1, misses=1, maxsize=2, currsize=1)
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as recently used."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Insert or replace the value for key, evicting old entries."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._evict()
+
+    def get_many(self, keys):
+        """Return the values for keys, None for the missing ones, under
+        one lock."""
+        values = []
+        with self._lock:
+            for key in keys:
+                value = self._data.get(key)
+                if value is None:
+                    self.misses += 1
+                else:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                values.append(value)
+        return values
+
+    def put_many(self, items):
+        """Insert or replace the (key, value) pairs, under one lock."""
+        with self._lock:
+            for key, value in items:
+                self._data[key] = value
+                self._data.move_to_end(key)
+            self._evict()
+
+    def pop(self, key, default=None):
+        """Remove the entry for key and return its value, or default."""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def resize(self, maxsize):
+        """Change the maximum number of entries, evicting if needed."""
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def reserve(self, size):
+        """Grow the maximum number of entries to at least size."""
+        with self._lock:
+            self.maxsize = max(self.maxsize, size)
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def cache_info(self):
+        """Return the statistics, in the style of functools.lru_cache."""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class BatchCache:
+    """The get_many and put_many of an LRUCache over a plain dict, to load
+    and save many entries at once, such as the results of a background job
+    kept in a disk cache.
+
+    Args:
+        data: the dict of entries, new if None.
+        maxsize: the most entries that save keeps, beyond which only the
+            entries used since the cache was created are kept.
+    """
+
+    def __init__(self, data=None, maxsize=None):
+        self.data = {} if data is None else data
+        self.maxsize = maxsize
+        self.changed = False
+        self._used = set()
+
+    def get_many(self, keys):
+        """Return the values for keys, None for the missing ones."""
+        self._used.update(keys)
+        return [self.data.get(key) for key in keys]
+
+    def put_many(self, items):
+        """Insert or replace the (key, value) pairs."""
+        items = dict(items)
+        self._used.update(items)
+        self.data.update(items)
+        self.changed = True
+
+    def save(self):
+        """Return the entries to keep."""
+        if self.maxsize is None or len(self.data) <= self.maxsize:
+            return self.data
+        return {key: self.data[key] for key in self._used if key in self.data}
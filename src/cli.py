@@ -0,0 +1,230 @@
+"""Price a portfolio file without the web app.
+
+Example:
+    python -m src.cli book.csv --date 2024-01-02 --output prices.parquet
+
+Key rate durations are written too with --krd-output. Treasury curves of
+more years are added to the curve store with --ingest-years or --ingest,
+with or without a portfolio to price:
+    python -m src.cli --ingest-years 2020 2021 2022 2023
+
+The portfolio is read, priced and written one chunk at a time, so the
+memory used does not grow with the size of the book. The output files
+are written under a temporary name and only replace the output paths
+once the whole book is priced.
+"""
+
+import argparse
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from src.parallel import shutdown_pool
+from src.portfolio_io import (
+    BATCH_SIZE,
+    KRD_SCHEMA,
+    file_format,
+    iter_portfolios,
+    krd_batch,
+    open_writer,
+    portfolio_batch,
+)
+from src.price import calculate_key_rate_duration, update_price
+from src.rates import CURVE_SOURCE, CURVE_STORE_PATH, CurveStore
+
+
+class StageTimer:
+    """Accumulate the wall time spent in each stage of the batch."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    def __call__(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.seconds[stage] += time.perf_counter() - start
+        return result
+
+    def report(self, n_bonds, file=None):
+        for stage, seconds in self.seconds.items():
+            print(f"{stage:<8} {seconds:9.3f} s", file=file)
+        total = sum(self.seconds.values())
+        rate = n_bonds / total if total else 0.0
+        print(f"{'total':<8} {total:9.3f} s ({rate:,.0f} bonds/s)", file=file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m src.cli", description=__doc__.splitlines()[0]
+    )
+    parser.add_argument(
+        "portfolio", nargs="?", help="portfolio CSV or Parquet file"
+    )
+    parser.add_argument(
+        "--date",
+        type=datetime.fromisoformat,
+        help="pricing date, as YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "--output",
+        help="CSV or Parquet file for the prices, duration and convexity",
+    )
+    parser.add_argument(
+        "--krd-output", help="CSV or Parquet file for the key rate durations"
+    )
+    parser.add_argument(
+        "--curve-source",
+        default=CURVE_SOURCE,
+        help="Treasury CSV file or URL, used to fill the curve store",
+    )
+    parser.add_argument(
+        "--curve-store",
+        default=CURVE_STORE_PATH,
+        help="Parquet curve store (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--refresh-curves",
+        action="store_true",
+        help="reload the curve store from the curve source first",
+    )
+    parser.add_argument(
+        "--ingest",
+        action="append",
+        default=[],
+        metavar="CSV",
+        help="add the curves of a Treasury CSV file or URL to the store",
+    )
+    parser.add_argument(
+        "--ingest-years",
+        nargs="+",
+        type=int,
+        default=[],
+        metavar="YEAR",
+        help="add the curves of these years from the Treasury site",
+    )
+    parser.add_argument(
+        "--method",
+        default="analytic",
+        choices=["analytic", "taylor", "bump", "model"],
+        help="pricing method of update_price (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="bonds read, priced and written at a time",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="worker processes (default: PRICING_WORKERS)",
+    )
+    args = parser.parse_args(argv)
+    if args.portfolio is None:
+        if not (args.refresh_curves or args.ingest or args.ingest_years):
+            parser.error("a portfolio or curves to ingest are required")
+    elif args.date is None or args.output is None:
+        parser.error("pricing a portfolio requires --date and --output")
+    return args
+
+
+def run(args, file=None):
+    """Update the curve store and price the portfolio of the parsed
+    arguments, if any, and return the number of bonds priced."""
+    timer = StageTimer()
+
+    store = CurveStore(path=args.curve_store, source=args.curve_source)
+    if args.refresh_curves:
+        timer("curves", store.refresh)
+    for source in args.ingest:
+        timer("curves", store.ingest, source)
+    if args.ingest_years:
+        timer("curves", store.ingest_years, args.ingest_years)
+    if args.portfolio is None:
+        df = store.frame()
+        print(
+            f"Stored {len(df)} curves from {df['Date'].iloc[0]:%Y-%m-%d}"
+            f" to {df['Date'].iloc[-1]:%Y-%m-%d}",
+            file=file,
+        )
+        return 0
+
+    rate_data = timer("curves", store.rates_for_date, args.date)
+
+    n_bonds = 0
+    outputs = [args.output] + ([args.krd_output] if args.krd_output else [])
+    price_writer = open_writer(
+        partial_path(args.output), file_format(args.output)
+    )
+    krd_writer = None
+    if args.krd_output:
+        krd_writer = open_writer(
+            partial_path(args.krd_output),
+            file_format(args.krd_output),
+            KRD_SCHEMA,
+        )
+
+    chunks = iter_portfolios(
+        args.portfolio, file_format(args.portfolio), args.chunk_size
+    )
+    priced = False
+    try:
+        while (portfolio := timer("read", next, chunks, None)) is not None:
+            # Prices in the file may be for another curve, so reprice them
+            portfolio.invalidate()
+            timer(
+                "price",
+                update_price,
+                portfolio,
+                rate_data,
+                args.date,
+                method=args.method,
+                workers=args.workers,
+            )
+            timer(
+                "write", price_writer.write_batch, portfolio_batch(portfolio)
+            )
+            if krd_writer is not None:
+                krd_report = timer(
+                    "krd",
+                    calculate_key_rate_duration,
+                    portfolio,
+                    rate_data,
+                    args.date,
+                    workers=args.workers,
+                )
+                timer("write", krd_writer.write_batch, krd_batch(krd_report))
+            n_bonds += len(portfolio)
+        priced = True
+    finally:
+        price_writer.close()
+        if krd_writer is not None:
+            krd_writer.close()
+        # An invalid chunk leaves the outputs of an earlier run in place
+        for path in outputs:
+            if priced:
+                os.replace(partial_path(path), path)
+            else:
+                os.remove(partial_path(path))
+
+    print(f"Priced {n_bonds} bonds on {args.date:%Y-%m-%d}", file=file)
+    timer.report(n_bonds, file=file)
+    return n_bonds
+
+
+def partial_path(path):
+    """Return the temporary path an output is written to before it is
+    renamed to path."""
+    return f"{path}.partial"
+
+
+def main(argv=None):
+    try:
+        run(parse_args(argv))
+    finally:
+        shutdown_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Zero rate curves evaluated directly in NumPy."""
+
+import numpy as np
+
+MS_IN_YEAR = 365 * 24 * 3600 * 1000
+
+# Currency of the zero curves, the only cashflow unit they discount
+CURVE_CURRENCY = "USD"
+
+
+class ZeroCurve:
+    """A zero rate curve with the same conventions as the qablet models.
+
+    Log discounts are interpolated linearly in time, with a (0, 0) node
+    added in front when the first tenor is after time 0.
+    """
+
+    def __init__(self, times, rates):
+        times = np.asarray(times, dtype=float)
+        rates = np.asarray(rates, dtype=float)
+        self.tenors = times
+        self._offset = 0
+        if times[0] > 0.0:
+            self._offset = 1
+            times = np.insert(times, 0, 0.0)
+            rates = np.insert(rates, 0, 0.0)
+        self.times = times
+        self.rates = rates
+        self.log_discounts = -rates * times
+
+    @classmethod
+    def from_rate_data(cls, rate_data):
+        """Create a curve from the rate editor rows (rates in percent)."""
+        return cls(
+            [rate["Year"] for rate in rate_data],
+            [rate["Rate"] / 100 for rate in rate_data],
+        )
+
+    def log_discount(self, t):
+        """Return the log discount factors at times t (in years)."""
+        t = np.asarray(t, dtype=float)
+        if t.size and (t.min() < 0.0 or t.max() > self.times[-1]):
+            raise ValueError(
+                f"Cashflow times must be within [0, {self.times[-1]}] years"
+                f" of the pricing date, got [{t.min()}, {t.max()}]."
+            )
+        return np.interp(t, self.times, self.log_discounts)
+
+    def discount(self, t):
+        """Return the discount factors at times t (in years)."""
+        return np.exp(self.log_discount(t))
+
+    def shifted(self, shift):
+        """Return a view of this curve with the zero rates shifted by a
+        scalar, or by a vector with one shift per tenor."""
+        return ShiftedCurve(self, shift)
+
+    def jacobian(self, t):
+        """Return the sensitivity of -log discount at times t to the zero
+        rate of each tenor, as a (tenors, times) matrix.
+
+        Log discounts are linear in the zero rates, so shifting the rates
+        by dr scales the discount factors by exp(-dr @ jacobian) exactly.
+        """
+        t = np.asarray(t, dtype=float)
+        jac = np.empty((len(self.tenors), t.size))
+        node = np.zeros(len(self.times))
+        for k, tenor in enumerate(self.tenors):
+            node[:] = 0.0
+            node[k + self._offset] = tenor
+            jac[k] = np.interp(t, self.times, node)
+        return jac
+
+
+class ShiftedCurve:
+    """A base ZeroCurve plus an additive shift to its zero rates.
+
+    The view shares the arrays of the base curve, so shocked scenarios
+    cost no copies. The shift is applied to the interpolated log discounts
+    in the same way as shifting the zero rates of the base curve.
+    """
+
+    def __init__(self, base, shift):
+        self.base = base
+        self.shift = shift
+
+    @property
+    def tenors(self):
+        return self.base.tenors
+
+    @property
+    def rates(self):
+        """The shifted zero rates at the tenors."""
+        return self.base.rates[self.base._offset :] + self.shift
+
+    def log_discount(self, t):
+        """Return the log discount factors at times t (in years)."""
+        log_discount = self.base.log_discount(t)
+        if np.ndim(self.shift) == 0:
+            # A parallel shift moves -log discount by shift * t
+            return log_discount - self.shift * np.asarray(t, dtype=float)
+        node_shift = np.zeros(len(self.base.times))
+        node_shift[self.base._offset :] = self.shift
+        return log_discount - np.interp(
+            t, self.base.times, node_shift * self.base.times
+        )
+
+    def discount(self, t):
+        """Return the discount factors at times t (in years)."""
+        return np.exp(self.log_discount(t))
+
+    def shifted(self, shift):
+        """Return a view of the base curve with an additional shift."""
+        return ShiftedCurve(self.base, self.shift + shift)
+
+    def jacobian(self, t):
+        """Return the tenor jacobian, which does not depend on the shift."""
+        return self.base.jacobian(t)
@@ -0,0 +1,143 @@
+"""Per callback instrumentation of the hot paths, off unless METRICS=1.
+
+Callbacks wrapped with instrument record their wall time, the sizes of
+their inputs and outputs as JSON, the counts reported with count() while
+they run (FixedModel prices, portfolio copies, curve fetches) and the hits
+and misses of the registered caches. When disabled, count() is a context
+variable lookup and instrument() adds one flag check per call.
+"""
+
+import functools
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+
+from plotly.io.json import to_json_plotly
+
+ENABLED = os.environ.get("METRICS", "0") == "1"
+
+# Number of recent callback records kept
+HISTORY = int(os.environ.get("METRICS_HISTORY", "200"))
+
+_current = ContextVar("metrics_record", default=None)
+_caches = {}
+_recent = deque(maxlen=HISTORY)
+_totals = {}
+_lock = threading.Lock()
+
+
+def enable(enabled=True):
+    """Turn the instrumentation on or off at runtime."""
+    global ENABLED
+    ENABLED = enabled
+
+
+def register_cache(name, cache):
+    """Report the hits and misses of an LRUCache in each record."""
+    _caches[name] = cache
+
+
+def count(name, n=1):
+    """Add n to a counter of the callback being recorded, if any."""
+    counts = _current.get()
+    if counts is not None:
+        counts[name] += n
+
+
+def payload_size(value):
+    """Return the size in bytes of a value sent as JSON, or None."""
+    try:
+        return len(to_json_plotly(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def instrument(func):
+    """Record the metrics of each call of a Dash callback."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+
+        counts = Counter()
+        token = _current.set(counts)
+        # Cache statistics are process wide, so concurrent callbacks
+        # share them
+        before = {name: cache.cache_info() for name, cache in _caches.items()}
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            _current.reset(token)
+
+        for name, cache in _caches.items():
+            info = cache.cache_info()
+            counts[f"{name}.hits"] += info.hits - before[name].hits
+            counts[f"{name}.misses"] += info.misses - before[name].misses
+        record(
+            func.__name__,
+            seconds,
+            counts,
+            payload_size([args, kwargs]),
+            payload_size(result),
+        )
+        return result
+
+    return wrapper
+
+
+def record(callback, seconds, counts, input_bytes, output_bytes):
+    """Store the metrics of one callback call."""
+    entry = {
+        "callback": callback,
+        "time": time.time(),
+        "seconds": seconds,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        **{name: n for name, n in sorted(counts.items()) if n},
+    }
+    with _lock:
+        _recent.append(entry)
+        totals = _totals.setdefault(
+            callback, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0}
+        )
+        totals["calls"] += 1
+        totals["seconds"] += seconds
+        totals["max_seconds"] = max(totals["max_seconds"], seconds)
+
+
+def cache_stats():
+    """Return the statistics and hit rate of each registered cache, since
+    it was created or last cleared."""
+    stats = {}
+    for name, cache in _caches.items():
+        info = cache.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {
+            **info._asdict(),
+            "hit_rate": info.hits / lookups if lookups else None,
+        }
+    return stats
+
+
+def snapshot():
+    """Return the totals per callback, the recent calls and the cache
+    statistics."""
+    with _lock:
+        return {
+            "enabled": ENABLED,
+            "callbacks": {name: dict(t) for name, t in _totals.items()},
+            "recent": list(_recent),
+            "caches": cache_stats(),
+        }
+
+
+def reset():
+    """Forget all recorded calls."""
+    with _lock:
+        _recent.clear()
+        _totals.clear()
@@ -0,0 +1,70 @@
+"""Process pool execution of pricing over chunks of a portfolio."""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Worker processes used for large portfolios (1 prices in-process)
+PRICING_WORKERS = int(os.environ.get("PRICING_WORKERS", "1"))
+
+# Fewest bonds per worker for which shipping a chunk to another process
+# pays off, below this books are priced with fewer workers or in-process
+PARALLEL_MIN_CHUNK = int(os.environ.get("PARALLEL_MIN_CHUNK", "1000"))
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def parallel_workers(n_bonds, workers=None):
+    """Return the number of worker processes to price n_bonds with, or 1
+    to price them in-process.
+
+    Each worker must get at least PARALLEL_MIN_CHUNK bonds, so small books
+    stay in-process and medium books use part of the pool.
+    """
+    workers = PRICING_WORKERS if workers is None else workers
+    return max(1, min(workers, n_bonds // max(PARALLEL_MIN_CHUNK, 1)))
+
+
+def get_pool(workers):
+    """Return the process wide pool, created or resized for workers.
+
+    The pool is kept between calls, so the bond and cashflow caches of the
+    workers stay warm.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers < workers:
+            if _pool is not None:
+                _pool.shutdown()
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+
+def shutdown_pool():
+    """Stop the worker processes, if any."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = None
+        _pool_workers = 0
+
+
+def map_chunks(func, portfolio, workers, *args):
+    """Call func(chunk, *args) on contiguous chunks of a Portfolio, one
+    chunk per worker, and return the results in portfolio order.
+
+    The arguments, such as the rate data, are sent once with each chunk,
+    so each worker receives them once per call rather than once per bond.
+    """
+    chunks = [
+        portfolio.take(index)
+        for index in np.array_split(np.arange(len(portfolio)), workers)
+    ]
+    repeated = [[arg] * len(chunks) for arg in args]
+    return list(get_pool(workers).map(func, chunks, *repeated))
@@ -0,0 +1,217 @@
+"""Bulk import and export of portfolios in CSV and Parquet, with pyarrow."""
+
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from src.bond import Portfolio
+from src.rates import RATE_TENOR_LABELS
+
+# Columns of a portfolio file, as stored
+PORTFOLIO_SCHEMA = pa.schema(
+    [
+        ("Bond", pa.string()),
+        ("Currency", pa.string()),
+        ("Coupon", pa.float64()),
+        ("Accrual Start", pa.date32()),
+        ("Maturity", pa.date32()),
+        ("Frequency", pa.int64()),
+        ("Notional", pa.float64()),
+        ("Price", pa.float64()),
+        ("Duration", pa.float64()),
+        ("Convexity", pa.float64()),
+    ]
+)
+
+# Columns of a key rate duration report, as stored
+KRD_SCHEMA = pa.schema(
+    [("Bond", pa.string()), ("Maturity (Years)", pa.float64())]
+    + [(label, pa.float64()) for label in RATE_TENOR_LABELS]
+)
+
+# Columns that an uploaded portfolio must have, the others are optional
+REQUIRED_COLUMNS = [
+    "Currency",
+    "Coupon",
+    "Accrual Start",
+    "Maturity",
+    "Frequency",
+    "Notional",
+]
+
+CURRENCIES = ["USD", "EUR"]
+
+# Rows per record batch, when reading and writing
+BATCH_SIZE = int(os.environ.get("PORTFOLIO_BATCH_SIZE", "65536"))
+
+
+def file_format(filename):
+    """Return "csv" or "parquet" from the extension of a file name."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".parquet", ".pq"):
+        return "parquet"
+    raise ValueError(f"Unsupported portfolio file: {filename}")
+
+
+def iter_batches(source, fmt, batch_size=BATCH_SIZE):
+    """Stream the record batches of a CSV or Parquet portfolio file.
+
+    Args:
+        source: a path or a binary file object.
+        fmt: "csv" or "parquet".
+        batch_size: rows per batch for Parquet, and approximate rows per
+            batch for CSV.
+    """
+    if fmt == "csv":
+        reader = pacsv.open_csv(
+            source,
+            # Assume about 100 bytes per CSV row
+            read_options=pacsv.ReadOptions(block_size=100 * batch_size),
+            convert_options=pacsv.ConvertOptions(
+                column_types=PORTFOLIO_SCHEMA,
+                strings_can_be_null=True,
+            ),
+        )
+        yield from reader
+    elif fmt == "parquet":
+        parquet_file = pq.ParquetFile(source)
+        names = set(parquet_file.schema_arrow.names)
+        columns = [name for name in PORTFOLIO_SCHEMA.names if name in names]
+        yield from parquet_file.iter_batches(batch_size, columns=columns)
+    else:
+        raise ValueError(f"Unknown portfolio format: {fmt}")
+
+
+def validate_batch(batch, offset=0):
+    """Check a record batch of a portfolio file, with pyarrow compute.
+
+    Raises:
+        ValueError: naming the first invalid row (counted from 1, after
+            offset rows) of each failed check.
+    """
+    missing = [
+        name for name in REQUIRED_COLUMNS if name not in batch.schema.names
+    ]
+    if missing:
+        raise ValueError(f"Missing portfolio columns: {', '.join(missing)}")
+
+    missing_values = pc.is_null(batch.column(REQUIRED_COLUMNS[0]))
+    for name in REQUIRED_COLUMNS[1:]:
+        missing_values = pc.or_(missing_values, pc.is_null(batch.column(name)))
+
+    checks = {
+        "missing values": missing_values,
+        "a currency other than " + "/".join(CURRENCIES): pc.invert(
+            pc.is_in(batch.column("Currency"), pa.array(CURRENCIES))
+        ),
+        "a maturity before the accrual start": pc.less_equal(
+            batch.column("Maturity"), batch.column("Accrual Start")
+        ),
+        "a frequency below 1 quarter": pc.less(batch.column("Frequency"), 1),
+        "a notional below 0": pc.less(batch.column("Notional"), 0),
+    }
+
+    errors = []
+    for problem, failed in checks.items():
+        failed = pc.fill_null(failed, False)
+        if pc.any(failed).as_py():
+            row = offset + pc.index(failed, True).as_py() + 1
+            errors.append(f"row {row} has {problem}")
+    if errors:
+        raise ValueError("Invalid portfolio: " + "; ".join(errors))
+
+
+def batch_to_portfolio(batch, offset=0):
+    """Convert a validated record batch to a Portfolio."""
+    columns = {
+        name: batch.column(name).to_numpy(zero_copy_only=False)
+        for name in batch.schema.names
+        if name in Portfolio.COLUMNS
+    }
+    if "Bond" not in columns:
+        columns["Bond"] = np.array(
+            [f"Bond {i + 1}" for i in range(offset, offset + len(batch))],
+            dtype=object,
+        )
+    # Pricing writes the risk columns, which must not be read only views of
+    # the Arrow buffers
+    for field in Portfolio.RISK_COLUMNS:
+        if field in columns:
+            columns[field] = columns[field].astype(float)
+    return Portfolio(columns)
+
+
+def iter_portfolios(source, fmt, batch_size=BATCH_SIZE):
+    """Stream a CSV or Parquet portfolio file as a Portfolio per record
+    batch, validating each batch before it is converted."""
+    offset = 0
+    for batch in iter_batches(source, fmt, batch_size):
+        validate_batch(batch, offset)
+        yield batch_to_portfolio(batch, offset)
+        offset += len(batch)
+
+
+def read_portfolio(source, fmt, batch_size=BATCH_SIZE):
+    """Read a CSV or Parquet portfolio file into a Portfolio."""
+    return Portfolio.concat(iter_portfolios(source, fmt, batch_size))
+
+
+def portfolio_batches(portfolio, batch_size=BATCH_SIZE):
+    """Yield the bonds and results of a Portfolio as record batches."""
+    for start in range(0, len(portfolio), batch_size):
+        yield portfolio_batch(portfolio.take(slice(start, start + batch_size)))
+
+
+def portfolio_batch(portfolio):
+    """Return the bonds and results of a Portfolio as one record batch."""
+    return pa.record_batch(
+        [
+            pa.array(
+                portfolio[field.name],
+                type=field.type,
+                from_pandas=True,  # NaN prices are written as nulls
+            )
+            for field in PORTFOLIO_SCHEMA
+        ],
+        schema=PORTFOLIO_SCHEMA,
+    )
+
+
+def krd_batch(krd_report):
+    """Return the rows of a key rate duration report as a record batch."""
+    return pa.RecordBatch.from_pylist(krd_report, schema=KRD_SCHEMA)
+
+
+def write_portfolio(portfolio, sink, fmt, batch_size=BATCH_SIZE):
+    """Write a Portfolio with its results to a CSV or Parquet file, one
+    record batch at a time.
+
+    Args:
+        sink: a path or a binary file object.
+        fmt: "csv" or "parquet".
+    """
+    write_batches(portfolio_batches(portfolio, batch_size), sink, fmt)
+
+
+def write_batches(batches, sink, fmt):
+    """Write portfolio record batches to a CSV or Parquet file as they
+    come, so a large book is never held as a single table."""
+    with open_writer(sink, fmt) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+
+def open_writer(sink, fmt, schema=PORTFOLIO_SCHEMA):
+    """Open a CSV or Parquet writer of record batches, to use as a context
+    manager."""
+    if fmt == "csv":
+        return pacsv.CSVWriter(sink, schema)
+    if fmt == "parquet":
+        return pq.ParquetWriter(sink, schema, compression="zstd")
+    raise ValueError(f"Unknown portfolio format: {fmt}")
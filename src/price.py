@@ -1,135 +1,495 @@
-import copy
+import os
 
 import numpy as np
 from qablet.base.fixed import FixedModel
 from qablet_contracts.timetable import py_to_ts
 
-from src.bond import bond_dict_to_obj
-from src.rates import RATE_TENOR_MAP
+from src.batch import (
+    cashflow_matrix,
+    price_batch,
+    risk_batch,
+    shocked_prices,
+    taylor_expansion,
+    taylor_update,
+)
+from src.bond import cached_bond_terms
+from src.cache import LRUCache
+from src.curve import CURVE_CURRENCY
+from src.metrics import count, register_cache
+from src.parallel import map_chunks, parallel_workers
+from src.rates import RATE_TENOR_MAP, compiled_curve, curve_hash
+
+# Expansions of bonds around the curve they were last fully priced on
+SENSITIVITY_CACHE = LRUCache(
+    maxsize=int(os.environ.get("SENSITIVITY_CACHE_SIZE", "100000"))
+)
+register_cache("sensitivity_cache", SENSITIVITY_CACHE)
+
+# Largest tenor rate move (25bp) repriced from the expansions
+TAYLOR_THRESHOLD = 0.0025
+
+# Results per unit notional of each bond, by method, bond terms, curve and
+# pricing date, capped at about RESULT_CACHE_MB megabytes
+RESULT_ENTRY_BYTES = 400
+RESULT_CACHE = LRUCache(
+    maxsize=int(
+        float(os.environ.get("RESULT_CACHE_MB", "64"))
+        * 2**20
+        // RESULT_ENTRY_BYTES
+    )
+)
+register_cache("result_cache", RESULT_CACHE)
+
+# Bonds per step of iter_key_rate_duration
+KRD_CHUNK_SIZE = int(os.environ.get("KRD_CHUNK_SIZE", "1000"))
+
+
+def shocked_dataset(dataset, shock):
+    """Return a dataset with the zero rates shifted by shock (a scalar or
+    one shift per rate point), sharing everything else with dataset."""
+    data_type, zero_rates = dataset["ASSETS"][CURVE_CURRENCY]
+    shocked_rates = np.column_stack(
+        [zero_rates[:, 0], zero_rates[:, 1] + shock]
+    )
+    return {
+        **dataset,
+        "ASSETS": {
+            **dataset["ASSETS"],
+            CURVE_CURRENCY: (data_type, shocked_rates),
+        },
+    }
 
 
 def price_shocked(model, timetable, dataset_orig, shock):
-    dataset = copy.deepcopy(dataset_orig)
-    zero_rates = dataset["ASSETS"]["USD"][1]
-    zero_rates[:, 1] = zero_rates[:, 1] + shock
-    dataset["ASSETS"]["USD"] = ("ZERO_RATES", zero_rates)
+    dataset = shocked_dataset(dataset_orig, shock)
     price, _ = model.price(timetable, dataset)
+    count("model.price")
     return price
 
 
-def update_price(data, rate_data, pricing_datetime):
-    """Update missing prices and calculate duration/convexity for all bonds in the table, in place."""
+def bumped_risk(price, price_up, price_down, shock):
+    """Return duration and convexity from prices with parallel shocks."""
+    dv = (price_up - price_down) / (2 * shock)
+    duration = -dv / price
+    convexity = (price_up + price_down - 2 * price) / (shock**2)
+    return duration, convexity
 
-    # Check if all bonds already have valid prices
-    if all([item["Price"] for item in data]):
-        return  # All prices are valid
 
-    # Initial discount data based on the current rates
-    discount_data = (
-        "ZERO_RATES",
-        np.array([[rate["Year"], rate["Rate"] / 100] for rate in rate_data]),
-    )
-    dataset = {
-        "BASE": "USD",
-        "PRICING_TS": py_to_ts(pricing_datetime).value,
-        "ASSETS": {"USD": discount_data},
-    }
+def update_price(
+    portfolio,
+    rate_data,
+    pricing_datetime,
+    method="analytic",
+    threshold=TAYLOR_THRESHOLD,
+    workers=None,
+    index=None,
+):
+    """Update missing prices and calculate duration/convexity for all bonds in a Portfolio, in place.
+
+    Methods:
+        analytic: closed form duration and convexity from one vectorized
+            pass over the discounted cashflows.
+        taylor: second order update from stored tenor sensitivities, for
+            bonds whose tenor rates moved at most threshold since they were
+            last fully priced, and analytic pricing for the others.
+        bump: vectorized repricing with +/-1% parallel shocks.
+        model: FixedModel repricing with +/-1% parallel shocks, one bond
+            at a time, to validate the other methods.
+
+    Large portfolios are priced in chunks on a pool of worker processes,
+    see src.parallel (workers defaults to PRICING_WORKERS). Pass the
+    positions of some bonds as index to price only those.
+
+    Returns:
+        the positions of the bonds that were priced.
+    """
+
+    # Bonds still to be priced have a NaN price
+    if index is None:
+        index = portfolio.unpriced()
+    else:
+        index = np.asarray(index, dtype=int)
+        index = index[np.isnan(portfolio["Price"][index])]
+    if not len(index):
+        return index  # All prices are valid
+
+    bonds = portfolio.take(index)
+    if method == "taylor":
+        # Taylor results depend on the stored expansions as well as on the
+        # curve, so they are not cached
+        risk = price_risk_taylor(
+            bonds, rate_data, pricing_datetime, threshold, workers
+        )
+    else:
+        risk = cached_results(
+            ("risk", method),
+            bonds,
+            rate_data,
+            pricing_datetime,
+            price_risk_workers,
+            method,
+            threshold,
+            workers,
+        )
+
+    price, duration, convexity = risk
+    portfolio.set_risk(index, price * bonds["Notional"], duration, convexity)
+    return index
+
+
+def cached_results(
+    kind, bonds, rate_data, pricing_datetime, compute, *args, cache=None
+):
+    """Return the results of each bond of a Portfolio from a cache,
+    computing only the cache misses.
+
+    Args:
+        kind: the kind of results and the method, part of the key.
+        compute: called with a Portfolio of the misses, rate_data,
+            pricing_datetime and args, returns their (fields, bonds)
+            results per unit notional.
+        cache: an LRUCache or BatchCache, RESULT_CACHE by default.
+
+    Returns:
+        a (fields, bonds) array of results.
+    """
+    curve, pricing_ts = curve_hash(rate_data), py_to_ts(pricing_datetime).value
+    keys = [(kind, terms, curve, pricing_ts) for terms in bonds.terms()]
+    cache = RESULT_CACHE if cache is None else cache
+    results = cache.get_many(keys)
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        computed = compute(
+            bonds.take(misses), rate_data, pricing_datetime, *args
+        )
+        # Entries are the bytes of the float results of a bond, which are
+        # compact and not tracked by the garbage collector
+        rows = np.ascontiguousarray(computed.T, dtype=float)
+        computed = [row.tobytes() for row in rows]
+        cache.put_many(zip([keys[i] for i in misses], computed))
+        for i, result in zip(misses, computed):
+            results[i] = result
+    return np.frombuffer(b"".join(results)).reshape(len(bonds), -1).T
+
+
+def price_risk_workers(
+    bonds, rate_data, pricing_datetime, method, threshold, workers
+):
+    """Return price_risk, split across worker processes if large. Taylor
+    updates are priced in this process, see price_risk_taylor."""
+    if method == "taylor":
+        return price_risk_taylor(
+            bonds, rate_data, pricing_datetime, threshold, workers
+        )
+
+    n_workers = parallel_workers(len(bonds), workers)
+    if n_workers > 1:
+        return np.concatenate(
+            map_chunks(
+                price_risk,
+                bonds,
+                n_workers,
+                rate_data,
+                pricing_datetime,
+                method,
+                threshold,
+            ),
+            axis=1,
+        )
+    return price_risk(bonds, rate_data, pricing_datetime, method, threshold)
+
+
+def price_risk(bonds, rate_data, pricing_datetime, method, threshold):
+    """Return price per unit notional, duration and convexity of a
+    Portfolio, as a (3, bonds) array, with one of the update_price
+    methods."""
+    if method == "analytic":
+        risk = price_risk_analytic(bonds, rate_data, pricing_datetime)
+    elif method == "taylor":
+        risk = price_risk_taylor(bonds, rate_data, pricing_datetime, threshold)
+    elif method == "bump":
+        risk = price_risk_bump(bonds, rate_data, pricing_datetime)
+    elif method == "model":
+        risk = price_risk_model(bonds, rate_data, pricing_datetime)
+    else:
+        raise ValueError(f"Unknown pricing method: {method}")
+    return np.asarray(risk)
+
+
+def price_risk_analytic(bonds, rate_data, pricing_datetime):
+    """Return price per unit notional, duration and convexity of a
+    Portfolio, with closed form sensitivities."""
+    cashflows = cashflow_matrix(bonds, pricing_datetime)
+    curve = compiled_curve(rate_data).curve
+    return risk_batch(cashflows, curve)
+
+
+def price_risk_taylor(
+    bonds, rate_data, pricing_datetime, threshold, workers=1
+):
+    """Return price per unit notional, duration and convexity of a
+    Portfolio, from the expansions of the bonds around the curve they
+    were last fully priced on. Bonds without an expansion, or with a tenor
+    rate move above threshold, are fully priced and expanded.
+
+    The expansions are stored in this process only, so the same curves
+    always give the same results. Worker processes only compute the
+    expansions of the bonds that are fully priced.
+    """
+    compiled = compiled_curve(rate_data)
+    curve, rates = compiled.curve, compiled.rates
+    pricing_ts = py_to_ts(pricing_datetime).value
+    keys = [
+        (terms, pricing_ts, tuple(curve.tenors)) for terms in bonds.terms()
+    ]
+
+    fast, base_rates, expansions, full = [], [], [], []
+    for i, key in enumerate(keys):
+        entry = SENSITIVITY_CACHE.get(key)
+        if entry is not None and np.abs(rates - entry[0]).max() <= threshold:
+            fast.append(i)
+            base_rates.append(entry[0])
+            expansions.append(entry[1])
+        else:
+            full.append(i)
+
+    risk = np.empty((3, len(bonds)))
+    if fast:
+        risk[:, fast] = taylor_update(
+            np.array(expansions), rates - np.array(base_rates)
+        )
+
+    if full:
+        expansion = bond_expansions_workers(
+            bonds.take(full), rate_data, pricing_datetime, workers
+        )
+        risk[:, full] = taylor_update(expansion, rates * 0)
+        for j, i in enumerate(full):
+            SENSITIVITY_CACHE.put(keys[i], (rates, expansion[j].copy()))
+
+    return risk
+
+
+def bond_expansions_workers(bonds, rate_data, pricing_datetime, workers):
+    """Return bond_expansions, split across worker processes if large."""
+    n_workers = parallel_workers(len(bonds), workers)
+    if n_workers > 1:
+        return np.concatenate(
+            map_chunks(
+                bond_expansions,
+                bonds,
+                n_workers,
+                rate_data,
+                pricing_datetime,
+            )
+        )
+    return bond_expansions(bonds, rate_data, pricing_datetime)
+
+
+def bond_expansions(bonds, rate_data, pricing_datetime):
+    """Return the taylor_expansion of each bond of a Portfolio around the
+    curve of rate_data."""
+    cashflows = cashflow_matrix(bonds, pricing_datetime)
+    return taylor_expansion(cashflows, compiled_curve(rate_data).curve)
+
+
+def price_risk_bump(bonds, rate_data, pricing_datetime):
+    """Return price per unit notional, duration and convexity of a
+    Portfolio, by vectorized bump and reprice."""
+    shock_size = 0.01  # 1% rate shock
+
+    cashflows = cashflow_matrix(bonds, pricing_datetime)
+    curve = compiled_curve(rate_data).curve
+
+    price = price_batch(cashflows, curve)
+    price_up = price_batch(cashflows, curve.shifted(shock_size))
+    price_down = price_batch(cashflows, curve.shifted(-shock_size))
+    duration, convexity = bumped_risk(price, price_up, price_down, shock_size)
+    return price, duration, convexity
+
+
+def price_risk_model(bonds, rate_data, pricing_datetime):
+    """Return price per unit notional, duration and convexity of a
+    Portfolio, one FixedModel call at a time."""
+
+    # Initial dataset based on the current rates
+    dataset = compiled_curve(rate_data, pricing_datetime).dataset
 
     model = FixedModel()
     shock_size = 0.01  # 1% rate shock
 
     # Recalculate prices, durations, and convexities for all bonds
-    for bond in data:
-        if bond["Price"]:
-            continue  # Skip bonds with existing prices
-
-        # Convert bond dictionary to bond object and retrieve notional
-        bond_obj, notional = bond_dict_to_obj(bond)
-        timetable = bond_obj.timetable()
+    risk = np.empty((3, len(bonds)))
+    for i, terms in enumerate(bonds.terms()):
+        _, timetable = cached_bond_terms(terms)
 
         # 1. Calculate initial price
         price, _ = model.price(timetable, dataset)
-        bond["Price"] = f"${price * notional:.6f}"
+        count("model.price")
 
         # 2. Calculate price with shocks
         price_up = price_shocked(model, timetable, dataset, shock=shock_size)
         price_down = price_shocked(
             model, timetable, dataset, shock=-shock_size
         )
-        dv = (price_up - price_down) / (2 * shock_size)
-
-        # Calculate duration
-        bond["Duration"] = f"{-dv / price:.6f}"
-
-        # Calculate convexity
-        convexity = (price_up + price_down - 2 * price) / (shock_size**2)
-        bond["Convexity"] = f"{convexity:.6f}"
+        duration, convexity = bumped_risk(
+            price, price_up, price_down, shock_size
+        )
+        risk[:, i] = price, duration, convexity
+    return risk
 
 
-def calculate_key_rate_duration(data, rate_data, pricing_datetime):
+def calculate_key_rate_duration(
+    portfolio,
+    rate_data,
+    pricing_datetime,
+    method="jacobian",
+    workers=None,
+    cache=None,
+):
     """
-    Calculate Key Rate Duration (KRD) for each bond in the data.
+    Calculate Key Rate Duration (KRD) for each bond in a Portfolio.
     Shocks each maturity rate in RATE_TENOR_MAP by 1%.
+
+    The "jacobian" method reprices all bonds under all shocks at once from
+    the curve's tenor jacobian, the "model" method reprices each bond with
+    the FixedModel once per shock, to validate it. Bonds found in the
+    cache (RESULT_CACHE by default, or a BatchCache to keep the results
+    of a background job) are not repriced, and large portfolios are split
+    across worker processes, as in update_price.
     """
-    model = FixedModel()
-    krd_report = []
+    if method not in ("jacobian", "model"):
+        raise ValueError(f"Unknown KRD method: {method}")
+    if not len(portfolio):
+        return []
 
-    for bond in data:
-        bond_obj, notional = bond_dict_to_obj(bond)
-        timetable = bond_obj.timetable()
+    krd_values = (
+        cached_results(
+            ("krd", method),
+            portfolio,
+            rate_data,
+            pricing_datetime,
+            key_rate_durations,
+            method,
+            workers,
+            cache=cache,
+        )
+        * portfolio["Notional"]
+    )
+
+    # Bond maturity in years from accrual start to maturity date
+    maturity_years = portfolio.maturity_years()
 
-        # Calculate the bond's maturity in years from accrual start to maturity date
-        maturity_years = (
-            bond_obj.maturity - bond_obj.accrual_start
-        ).days / 365
+    # Bonds that cannot be priced on the curve have no KRD
+    included = krd_included(maturity_years) & ~np.isnan(krd_values.T)
+
+    krd_report = []
+    for i, name in enumerate(portfolio["Bond"]):
         bond_krd = {
-            "Bond": bond["Bond"],
-            "Maturity (Years)": round(maturity_years, 2),
+            "Bond": name,
+            "Maturity (Years)": round(float(maturity_years[i]), 2),
         }
+        for k, rate in enumerate(RATE_TENOR_MAP):
+            bond_krd[rate["Label"]] = (
+                round(float(krd_values[k, i]), 6) if included[i, k] else None
+            )
+        krd_report.append(bond_krd)
 
-        # Initial dataset and price calculation
-        initial_dataset = {
-            "BASE": "USD",
-            "PRICING_TS": py_to_ts(pricing_datetime).value,
-            "ASSETS": {
-                "USD": (
-                    "ZERO_RATES",
-                    np.array(
-                        [
-                            [rate["Year"], rate["Rate"] / 100]
-                            for rate in rate_data
-                        ]
-                    ),
-                ),
-            },
-        }
-        initial_price, _ = model.price(timetable, initial_dataset)
+    return krd_report
 
-        # Calculate KRD by shocking each rate point
-        additional_point_included = False
-        for rate in RATE_TENOR_MAP:
-            rate_year = rate["Year"]
-            rate_label = rate["Label"]
-
-            # Include one additional rate point if it is the next maturity beyond bond maturity
-            if rate_year > maturity_years:
-                if not additional_point_included:
-                    additional_point_included = True
-                else:
-                    bond_krd[rate_label] = None
-                    continue
-
-            # Shock the rate
-            shocked_dataset = copy.deepcopy(initial_dataset)
-            for i, r in enumerate(shocked_dataset["ASSETS"]["USD"][1]):
-                if r[0] == rate_year:
-                    shocked_dataset["ASSETS"]["USD"][1][i][1] += 0.01
-
-            # Calculate shocked price and KRD
-            shocked_price, _ = model.price(timetable, shocked_dataset)
-            krd_value = (shocked_price - initial_price) * notional
-            bond_krd[rate_label] = round(krd_value, 6)
 
-        krd_report.append(bond_krd)
+def krd_included(maturity_years):
+    """Return a (bonds, tenors) mask of the KRD tenors reported for bonds
+    of the given maturities."""
+    tenor_years = np.array([rate["Year"] for rate in RATE_TENOR_MAP])
 
-    return krd_report
+    # Include one additional rate point if it is the next maturity beyond bond maturity
+    beyond = tenor_years[None, :] > np.asarray(maturity_years)[:, None]
+    return ~beyond | (np.cumsum(beyond, axis=1) == 1)
+
+
+def key_rate_durations(
+    portfolio, rate_data, pricing_datetime, method, workers
+):
+    """Return the KRD of each bond of a Portfolio per unit notional, as a
+    (tenors, bonds) array."""
+    n_workers = parallel_workers(len(portfolio), workers)
+    if n_workers > 1:
+        chunks = map_chunks(
+            key_rate_durations,
+            portfolio,
+            n_workers,
+            rate_data,
+            pricing_datetime,
+            method,
+            1,
+        )
+        return np.concatenate(chunks, axis=1)
+
+    if method == "model":
+        return key_rate_durations_model(portfolio, rate_data, pricing_datetime)
+
+    cashflows = cashflow_matrix(portfolio, pricing_datetime)
+    curve = compiled_curve(rate_data).curve
+
+    # Shock every rate point whose year matches the tenor by 1%
+    rate_years = np.array([rate["Year"] for rate in rate_data])
+    tenor_years = np.array([rate["Year"] for rate in RATE_TENOR_MAP])
+    shocks = 0.01 * (tenor_years[:, None] == rate_years[None, :])
+
+    initial_price = price_batch(cashflows, curve)
+    shocked_price = shocked_prices(cashflows, curve, shocks)
+    return (shocked_price - initial_price[:, None]).T
+
+
+def iter_key_rate_duration(
+    portfolio,
+    rate_data,
+    pricing_datetime,
+    chunk_size=KRD_CHUNK_SIZE,
+    method="jacobian",
+    workers=None,
+    cache=None,
+):
+    """Calculate the KRD report of a Portfolio one chunk of bonds at a
+    time, yielding the number of bonds done and the report rows of each
+    chunk, so a long report can show progress."""
+    for start in range(0, len(portfolio), chunk_size):
+        chunk = portfolio.take(slice(start, start + chunk_size))
+        yield (
+            start + len(chunk),
+            calculate_key_rate_duration(
+                chunk, rate_data, pricing_datetime, method, workers, cache
+            ),
+        )
+
+
+def key_rate_durations_model(portfolio, rate_data, pricing_datetime):
+    """Return the KRD of each bond per unit notional by repricing it with
+    the FixedModel, as a (tenors, bonds) array with NaN for the tenors
+    that are not reported."""
+    model = FixedModel()
+    compiled = compiled_curve(rate_data, pricing_datetime)
+    rate_years = compiled.zero_rates[:, 0]
+    included = krd_included(portfolio.maturity_years())
+
+    krd_values = np.full((len(RATE_TENOR_MAP), len(portfolio)), np.nan)
+    for i, terms in enumerate(portfolio.terms()):
+        _, timetable = cached_bond_terms(terms)
+
+        # Initial price, on the dataset shared by all bonds
+        initial_dataset = compiled.dataset
+        initial_price, _ = model.price(timetable, initial_dataset)
+        count("model.price")
+
+        # Calculate KRD by shocking each reported rate point
+        for k, rate in enumerate(RATE_TENOR_MAP):
+            if not included[i, k]:
+                continue
+            shock = 0.01 * (rate_years == rate["Year"])
+            shocked_price = price_shocked(
+                model, timetable, initial_dataset, shock
+            )
+            krd_values[k, i] = shocked_price - initial_price
+
+    return krd_values
@@ -1,12 +1,48 @@
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-from qablet.base.utils import Discounter
+from qablet_contracts.timetable import py_to_ts
 
-# CSV URL for fetching Treasury rates
-CSV_URL = "https://home.treasury.gov/resource-center/data-chart-center/interest-rates/daily-treasury-rates.csv/2024/all?type=daily_treasury_yield_curve&field_tdr_date_value=2024&page&_format=csv"
+from src.cache import LRUCache
+from src.curve import CURVE_CURRENCY, ZeroCurve
+from src.metrics import count, register_cache
+
+# CSV URL for fetching Treasury rates of a given year
+CSV_URL_TEMPLATE = "https://home.treasury.gov/resource-center/data-chart-center/interest-rates/daily-treasury-rates.csv/{year}/all?type=daily_treasury_yield_curve&field_tdr_date_value={year}&page&_format=csv"
+
+
+def treasury_csv_url(year):
+    return CSV_URL_TEMPLATE.format(year=year)
+
+
+CSV_URL = treasury_csv_url(2024)
+
+# Local Parquet store of Treasury curves, and the CSV (URL or file) it is refreshed from
+CURVE_STORE_PATH = os.environ.get(
+    "CURVE_STORE_PATH", os.path.join("data", "treasury_rates.parquet")
+)
+CURVE_SOURCE = os.environ.get("CURVE_SOURCE", CSV_URL)
+
+logger = logging.getLogger(__name__)
+
+# Days between a pricing date and the nearest stored curve, above which the
+# curve is reported as stale
+CURVE_MAX_GAP_DAYS = int(os.environ.get("CURVE_MAX_GAP_DAYS", "7"))
+
+# Compiled curves of recent rate editor rows and pricing dates
+CURVE_CACHE = LRUCache(maxsize=int(os.environ.get("CURVE_CACHE_SIZE", "256")))
+register_cache("curve_cache", CURVE_CACHE)
+
+# Intervals of the time grid of the rate graph
+RATE_GRAPH_STEPS = int(os.environ.get("RATE_GRAPH_STEPS", "20"))
 
 # Define the set of time points for Key Rate Duration (KRD) calculation (Months and Years)
 RATE_TENOR_MAP = [
@@ -28,77 +64,338 @@ RATE_TENOR_MAP = [
 RATE_TENOR_LABELS = [x["Label"] for x in RATE_TENOR_MAP]
 
 
-# Function to fetch Treasury rates from the Treasury website
-def fetch_treasury_rates():
-    df = pd.read_csv(CSV_URL)
+# Function to fetch Treasury rates from the Treasury website, a stand-in server or a local CSV file
+def fetch_treasury_rates(source=CSV_URL):
+    df = pd.read_csv(source)
     df["Date"] = pd.to_datetime(df["Date"])
     return df
 
 
+class CurveStore:
+    """An archive of Treasury curves persisted in a local Parquet file.
+
+    The curves are loaded once per process and lookups are served from
+    memory, by binary search on the sorted curve dates. If the file does
+    not exist yet, it is created from the source, or from the curves of
+    the first ingest. More years or days are added with ingest, which
+    appends only the dates not stored yet, and reload picks up the curves
+    that other processes or a changed source file added since.
+
+    Args:
+        path: the Parquet file of the store.
+        source: the URL or CSV file used to refresh the store.
+    """
+
+    def __init__(self, path=CURVE_STORE_PATH, source=CURVE_SOURCE):
+        self.path = path
+        self.source = source
+        self._df = None
+        self._dates = None
+        self._mtime = None
+        self._source_mtime = None
+        self._lock = threading.Lock()
+
+    def frame(self):
+        """Return the curves as a dataframe, loading them on first use."""
+        if self._df is None:
+            with self._lock:
+                if self._df is None:
+                    start = time.perf_counter()
+                    count("curve.loads")
+                    if os.path.exists(self.path):
+                        self._set_frame(pd.read_parquet(self.path))
+                    else:
+                        self._refresh(self.source)
+                    logger.info(
+                        "Loaded %d curves in %.1f ms",
+                        len(self._df),
+                        1000 * (time.perf_counter() - start),
+                    )
+        return self._df
+
+    def refresh(self, source=None):
+        """Replace the stored curves with the ones in a Treasury CSV, from a
+        dropped file or a URL (defaults to the store's source)."""
+        with self._lock:
+            return self._refresh(source or self.source)
+
+    def _refresh(self, source):
+        df = fetch_treasury_rates(source).drop_duplicates("Date")
+        df = df.sort_values("Date", ignore_index=True)
+        self._write(df)
+        return df
+
+    def ingest(self, source):
+        """Add the curves of a yearly or daily Treasury CSV (a file or a URL)
+        for dates that are not in the store yet. A new store is created
+        from these curves alone, without reading the store's source.
+
+        Returns:
+            the number of curves added.
+        """
+        new = fetch_treasury_rates(source).drop_duplicates("Date")
+        with self._lock:
+            if self._df is None and os.path.exists(self.path):
+                self._set_frame(pd.read_parquet(self.path))
+            if self._df is not None:
+                new = new[~new["Date"].isin(self._df["Date"])]
+            if not new.empty:
+                df = pd.concat([self._df, new], ignore_index=True)
+                self._write(df.sort_values("Date", ignore_index=True))
+        logger.info("Ingested %d new curves from %s", len(new), source)
+        return len(new)
+
+    def reload(self):
+        """Pick up the curves stored since they were loaded: read the
+        Parquet file again if another process, such as an ingest from the
+        command line, wrote it, and ingest the source if it is a local CSV
+        file that changed since. Does nothing before the first load.
+
+        Returns:
+            True if the curves changed.
+        """
+        if self._df is None:
+            return False
+        changed = False
+        with self._lock:
+            if file_mtime(self.path) not in (None, self._mtime):
+                self._set_frame(pd.read_parquet(self.path))
+                changed = True
+        source_mtime = file_mtime(self.source)
+        if source_mtime is not None and source_mtime > self._source_mtime:
+            self._source_mtime = source_mtime
+            changed = self.ingest(self.source) > 0 or changed
+        if changed:
+            logger.info("Reloaded %d curves", len(self._df))
+        return changed
+
+    def ingest_years(self, years):
+        """Add the Treasury curves of several years from the Treasury site."""
+        return sum(self.ingest(treasury_csv_url(year)) for year in years)
+
+    def _write(self, df):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        df.to_parquet(self.path, index=False, compression="zstd")
+        self._set_frame(df)
+
+    def _set_frame(self, df):
+        # The Parquet file was just read or written. A source file older
+        # than the first load is already in the store
+        self._mtime = file_mtime(self.path)
+        if self._source_mtime is None:
+            self._source_mtime = self._mtime
+        # The date index is set first, as frame() checks only the dataframe
+        self._dates = df["Date"].to_numpy(dtype="datetime64[ns]")
+        self._df = df
+
+    def lookup(self, dates, how="nearest"):
+        """Return the row positions of the curves for an array of dates.
+
+        Args:
+            dates: the dates to look up.
+            how: "nearest" (ties go to the earlier curve), "previous" (the
+                last curve on or before the date) or "next" (the first curve
+                on or after the date).
+        """
+        self.frame()
+        curve_dates = self._dates
+        dates = np.asarray(dates, dtype="datetime64[ns]")
+
+        if how == "previous":
+            pos = np.searchsorted(curve_dates, dates, side="right") - 1
+        elif how == "next":
+            pos = np.searchsorted(curve_dates, dates, side="left")
+        elif how == "nearest":
+            if len(curve_dates) == 1:
+                return np.zeros(dates.shape, dtype=int)
+            right = np.searchsorted(curve_dates, dates, side="left")
+            right = right.clip(1, len(curve_dates) - 1)
+            left = right - 1
+            pos = np.where(
+                dates - curve_dates[left] <= curve_dates[right] - dates,
+                left,
+                right,
+            )
+        else:
+            raise ValueError(f"Unknown lookup method: {how}")
+
+        if np.any((pos < 0) | (pos >= len(curve_dates))):
+            raise KeyError(f"No {how} curve for some of the dates")
+        return pos
+
+    def curves_for_dates(self, dates, how="nearest"):
+        """Return the curves for an array of dates, one row per date."""
+        count("curve.fetches")
+        pos = self.lookup(dates, how)
+        return self.frame().iloc[pos].reset_index(drop=True)
+
+    def rates_for_date(self, pricing_datetime, how="nearest"):
+        """Return the rate data of the curve closest to pricing_datetime,
+        with a warning if that curve is stale."""
+        count("curve.fetches")
+        pos = self.lookup([pricing_datetime], how)
+        curve_date = self.stale_curve_date(pricing_datetime, how)
+        if curve_date is not None:
+            logger.warning(
+                "No curve within %d days of %s, using the curve of %s",
+                CURVE_MAX_GAP_DAYS,
+                f"{pricing_datetime:%Y-%m-%d}",
+                f"{curve_date:%Y-%m-%d}",
+            )
+        return treasury_rates_to_rate_data(self.frame().iloc[pos])
+
+    def stale_curve_date(self, pricing_datetime, how="nearest"):
+        """Return the date of the curve used for pricing_datetime if it is
+        more than CURVE_MAX_GAP_DAYS away, or None."""
+        pos = self.lookup([pricing_datetime], how)[0]
+        curve_date = pd.Timestamp(self._dates[pos])
+        gap = abs(curve_date - pd.Timestamp(pricing_datetime))
+        if gap > pd.Timedelta(days=CURVE_MAX_GAP_DAYS):
+            return curve_date
+        return None
+
+
+def file_mtime(path):
+    """Return the modification time of a local file in ns, or None for a
+    URL or a missing file."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+_curve_store = None
+
+
+def get_curve_store():
+    """Return the process wide curve store."""
+    global _curve_store
+    if _curve_store is None:
+        _curve_store = CurveStore()
+    return _curve_store
+
+
 # Function to get rates for a specific pricing date
 def get_rates_for_date(pricing_datetime):
     # Convert pricing_datetime to datetime if it's a string
     if isinstance(pricing_datetime, str):
         pricing_datetime = datetime.fromisoformat(pricing_datetime)
 
-    df = fetch_treasury_rates()
-    # Find the row with the closest date to the provided pricing_datetime
-    closest_date_row = df.iloc[
-        (df["Date"] - pricing_datetime).abs().argsort()[:1]
-    ]
-    return treasury_rates_to_rate_data(closest_date_row)
+    return get_curve_store().rates_for_date(pricing_datetime)
 
 
-# Function to format Treasury yield curve data for the app's rate editor
+# Function to format Treasury yield curve data for the app's rate editor,
+# skipping tenors that were not published on that date
 def treasury_rates_to_rate_data(df_row):
     return [
         {"Year": x["Year"], "Rate": df_row[x["Label"]].values[0]}
         for x in RATE_TENOR_MAP
+        if x["Label"] in df_row and not np.isnan(df_row[x["Label"]].values[0])
     ]
 
 
-# Function to process rates for calculations in pricing and plotting
-def rates_table(rate_data):
-    discount_data = (
-        "ZERO_RATES",
-        np.array([[rate["Year"], rate["Rate"] / 100] for rate in rate_data]),
+class CompiledCurve:
+    """The curve objects of a set of rate editor rows, built once.
+
+    Attributes:
+        zero_rates: a read only (tenors, 2) array of years and zero rates
+            (as decimals), the ZERO_RATES data of the qablet models.
+        curve: the ZeroCurve, with its interpolation nodes.
+        dataset: the FixedModel dataset at the pricing date, or None
+            without a pricing date.
+    """
+
+    def __init__(self, rate_data, pricing_datetime=None):
+        self.zero_rates = np.array(
+            [[rate["Year"], rate["Rate"] / 100] for rate in rate_data],
+            dtype=float,
+        )
+        self.zero_rates.setflags(write=False)
+        self.curve = ZeroCurve(self.zero_rates[:, 0], self.zero_rates[:, 1])
+        self.dataset = None
+        if pricing_datetime is not None:
+            self.dataset = {
+                "BASE": CURVE_CURRENCY,
+                "PRICING_TS": py_to_ts(pricing_datetime).value,
+                "ASSETS": {CURVE_CURRENCY: ("ZERO_RATES", self.zero_rates)},
+            }
+
+    @property
+    def rates(self):
+        """The zero rates at the tenors, as decimals."""
+        return self.zero_rates[:, 1]
+
+
+def curve_key(rate_data, pricing_datetime=None):
+    """Return a key of the content of rate editor rows and a pricing
+    date, equal for equal rates whatever the other fields of the rows."""
+    rates = tuple(
+        (float(rate["Year"]), float(rate["Rate"])) for rate in rate_data
     )
-    discounter = Discounter(discount_data)
+    if pricing_datetime is None:
+        return rates, None
+    return rates, py_to_ts(pricing_datetime).value
+
+
+def curve_hash(rate_data):
+    """Return a digest of the rates of rate editor rows, as bytes, which
+    cache their own hash."""
+    rates = np.array(curve_key(rate_data)[0], dtype=float)
+    return hashlib.blake2b(rates.tobytes(), digest_size=16).digest()
+
 
-    max_t = rate_data[-1]["Year"]
-    times = np.linspace(0, max_t, 21)
-    starts = times[:-1]
+def compiled_curve(rate_data, pricing_datetime=None):
+    """Return the CompiledCurve of rate editor rows and a pricing date,
+    from CURVE_CACHE when the same rates were compiled recently."""
+    key = curve_key(rate_data, pricing_datetime)
+    compiled = CURVE_CACHE.get(key)
+    if compiled is None:
+        compiled = CompiledCurve(rate_data, pricing_datetime)
+        CURVE_CACHE.put(key, compiled)
+    return compiled
+
+
+# Function to process rates for calculations in pricing and plotting, on a
+# grid of steps intervals up to the last tenor
+def rates_table(rate_data, steps=RATE_GRAPH_STEPS):
+    curve = compiled_curve(rate_data).curve
+
+    # One interpolation of the log discounts gives all the term and
+    # forward rates, however dense the grid
+    times = np.linspace(0, rate_data[-1]["Year"], steps + 1)
+    log_discounts = curve.log_discount(times)
     ends = times[1:]
-    term_rates = discounter.rate(ends, ends * 0)  # rate from 0 to t
-    fwd_rates = discounter.rate(ends, starts)  # rate from t to t+1
+    term_rates = -log_discounts[1:] / ends  # rate from 0 to t
+    fwd_rates = -np.diff(log_discounts) / np.diff(times)  # rate from t to t+1
 
     return pd.DataFrame(
         {"Time": ends, "Term Rate": term_rates, "Fwd Rate": fwd_rates}
     )
 
 
-# Function to plot the rates using Plotly
-def plot_rates(rates_df):
-    # Create traces for term rate and forward rate
-    term_rate_trace = go.Scatter(
-        x=rates_df["Time"],
-        y=rates_df["Term Rate"],
-        mode="lines",
-        name="Term Rate",
-        line=dict(shape="linear"),
-    )
-
-    fwd_rate_trace = go.Scatter(
-        x=rates_df["Time"],
-        y=rates_df["Fwd Rate"],
-        mode="lines",
-        name="Fwd Rate",
-        line=dict(shape="vh", dash="dot"),
+# Function to build the rate graph without data, built once and shared by
+# every page, since only the data and axis ranges change
+@functools.cache
+def rate_figure():
+    fig = go.Figure(
+        data=[
+            go.Scatter(
+                x=[],
+                y=[],
+                mode="lines",
+                name="Term Rate",
+                line=dict(shape="linear"),
+            ),
+            go.Scatter(
+                x=[],
+                y=[],
+                mode="lines",
+                name="Fwd Rate",
+                line=dict(shape="vh", dash="dot"),
+            ),
+        ]
     )
 
-    # Create the figure with a custom layout
-    fig = go.Figure(data=[term_rate_trace, fwd_rate_trace])
-
     fig.update_layout(
         legend=dict(
             orientation="h",
@@ -108,17 +405,26 @@ def plot_rates(rates_df):
             x=0.99,
             bgcolor="rgba(255,255,255,0.5)",
         ),
-        xaxis=dict(range=[0, rates_df["Time"].max()]),
-        yaxis=dict(
-            range=[
-                0,
-                1.1
-                * max(rates_df["Term Rate"].max(), rates_df["Fwd Rate"].max()),
-            ],
-            tickformat=".1%",
-        ),
+        yaxis=dict(tickformat=".1%"),
         height=200,
         margin=dict(t=0, b=30),  # Reduce top/bottom margins
     )
+    return fig.to_plotly_json()
+
+
+# Function to return the axis ranges of the rate graph
+def rate_ranges(rates_df):
+    max_rate = max(rates_df["Term Rate"].max(), rates_df["Fwd Rate"].max())
+    return [0, rates_df["Time"].max()], [0, 1.1 * max_rate]
+
+
+# Function to plot the rates using Plotly
+def plot_rates(rates_df):
+    fig = go.Figure(rate_figure())
+    for trace, column in zip(fig.data, ["Term Rate", "Fwd Rate"]):
+        trace.x = rates_df["Time"]
+        trace.y = rates_df[column]
 
+    x_range, y_range = rate_ranges(rates_df)
+    fig.update_layout(xaxis=dict(range=x_range), yaxis=dict(range=y_range))
     return fig
@@ -0,0 +1,158 @@
+"""Server side sorting, filtering and paging of a Portfolio, for the AG
+Grid infinite row model.
+
+The grid sends the sort and filter models of its columns with each block
+request, and the block is cut from the positions that query returns.
+"""
+
+import operator
+
+import numpy as np
+
+from src.bond import Portfolio
+
+# Comparisons of the number and date filters
+NUMBER_FILTERS = {
+    "equals": operator.eq,
+    "notEqual": operator.ne,
+    "lessThan": operator.lt,
+    "lessThanOrEqual": operator.le,
+    "greaterThan": operator.gt,
+    "greaterThanOrEqual": operator.ge,
+}
+
+# Case insensitive comparisons of the text filters
+TEXT_FILTERS = {
+    "contains": lambda strings, text: np.char.find(strings, text) >= 0,
+    "notContains": lambda strings, text: np.char.find(strings, text) < 0,
+    "equals": operator.eq,
+    "notEqual": operator.ne,
+    "startsWith": np.char.startswith,
+    "endsWith": np.char.endswith,
+}
+
+
+def query(portfolio, sort_model=None, filter_model=None):
+    """Return the positions of the bonds of a Portfolio that pass the
+    filter model, in the order of the sort model.
+
+    Args:
+        sort_model: a list of {"colId", "sort"} dictionaries, the first
+            column sorting first.
+        filter_model: a dictionary of AG Grid column filters by column.
+    """
+    index = np.flatnonzero(filter_mask(portfolio, filter_model or {}))
+    return sort_order(portfolio, sort_model or [], index)
+
+
+def query_columns(sort_model=None, filter_model=None):
+    """Return the columns that a sort and a filter model use."""
+    return {sort["colId"] for sort in sort_model or []} | set(
+        filter_model or {}
+    )
+
+
+def sort_order(portfolio, sort_model, index):
+    """Sort positions of a Portfolio by the columns of a sort model, with
+    missing values last when ascending. Ties keep their order."""
+    keys = []
+    for sort in sort_model:
+        values = column_values(portfolio, sort["colId"])[index]
+        if values.dtype == object:
+            values = values.astype(str)
+        # Ranks sort any column type, and are negated to sort descending
+        ranks = np.unique(values, return_inverse=True)[1].ravel()
+        keys.append(-ranks if sort.get("sort") == "desc" else ranks)
+    if not keys:
+        return index
+    return index[np.lexsort(keys[::-1])]
+
+
+def filter_mask(portfolio, filter_model):
+    """Return a boolean mask of the bonds that pass every column filter."""
+    mask = np.ones(len(portfolio), dtype=bool)
+    for field, column_filter in filter_model.items():
+        mask &= column_mask(column_values(portfolio, field), column_filter)
+    return mask
+
+
+def column_values(portfolio, field):
+    if field not in Portfolio.COLUMNS or field == "id":
+        raise ValueError(f"Cannot sort or filter on {field}")
+    return portfolio[field]
+
+
+def column_mask(values, column_filter):
+    """Return the mask of one column filter, which may combine conditions
+    with an AND or OR operator."""
+    conditions = column_filter.get("conditions")
+    if conditions is None:
+        return condition_mask(values, column_filter)
+
+    masks = [
+        condition_mask(
+            values, {"filterType": column_filter["filterType"], **c}
+        )
+        for c in conditions
+    ]
+    if column_filter.get("operator") == "OR":
+        return np.logical_or.reduce(masks)
+    return np.logical_and.reduce(masks)
+
+
+def condition_mask(values, condition):
+    """Return the mask of one text, number or date filter condition."""
+    filter_type = condition.get("filterType")
+    kind = condition.get("type")
+    if filter_type == "text":
+        return text_mask(values, kind, condition.get("filter"))
+    if filter_type == "number":
+        return number_mask(
+            values, kind, condition.get("filter"), condition.get("filterTo")
+        )
+    if filter_type == "date":
+        return number_mask(
+            values,
+            kind,
+            filter_date(condition.get("dateFrom")),
+            filter_date(condition.get("dateTo")),
+        )
+    raise ValueError(f"Unsupported {filter_type} filter")
+
+
+def filter_date(value):
+    # Date filters send "YYYY-MM-DD hh:mm:ss"
+    return None if value is None else np.datetime64(value[:10], "D")
+
+
+def blank(values):
+    if values.dtype == object:
+        return np.array([value is None for value in values], dtype=bool)
+    if values.dtype.kind == "M":
+        return np.isnat(values)
+    return np.isnan(values.astype(float))
+
+
+def number_mask(values, kind, value, value_to=None):
+    """Return the mask of a number or date condition."""
+    if kind == "blank":
+        return blank(values)
+    if kind == "notBlank":
+        return ~blank(values)
+    if kind == "inRange":
+        return (values >= value) & (values <= value_to)
+    if kind not in NUMBER_FILTERS:
+        raise ValueError(f"Unsupported number filter: {kind}")
+    return NUMBER_FILTERS[kind](values, value)
+
+
+def text_mask(values, kind, text):
+    """Return the mask of a case insensitive text condition."""
+    if kind == "blank":
+        return blank(values)
+    if kind == "notBlank":
+        return ~blank(values)
+    if kind not in TEXT_FILTERS:
+        raise ValueError(f"Unsupported text filter: {kind}")
+    strings = np.char.lower(values.astype(str))
+    return TEXT_FILTERS[kind](strings, str(text).lower())
@@ -0,0 +1,206 @@
+"""Full revaluation of a portfolio under many zero rate scenarios at once.
+
+A scenario is a vector of additive shifts to the zero rates of the curve
+tenors, and a set of scenarios is a (scenarios, tenors) matrix. The
+builders below return such matrices for the usual curve moves.
+"""
+
+import numpy as np
+
+from src.batch import cashflow_matrix, price_batch, shocked_prices
+from src.parallel import map_chunks, parallel_workers
+from src.rates import RATE_TENOR_MAP, compiled_curve, get_curve_store
+
+# Daily curve changes in a historical VaR, about one year
+VAR_LOOKBACK = 250
+
+
+def check_pivot(tenors, pivot):
+    tenors = np.asarray(tenors, dtype=float)
+    if not tenors[0] < pivot < tenors[-1]:
+        raise ValueError(
+            f"The pivot {pivot} must be between the first and last tenors"
+        )
+    return tenors
+
+
+def parallel_shifts(tenors, sizes):
+    """Return one parallel shift of all tenors per size."""
+    return np.outer(sizes, np.ones(len(tenors)))
+
+
+def twist(tenors, size, pivot=5.0):
+    """Return a steepener, rotating the curve around the pivot tenor:
+    -size at the first tenor, 0 at the pivot and +size at the last
+    (a negative size flattens the curve)."""
+    tenors = check_pivot(tenors, pivot)
+    return size * np.where(
+        tenors < pivot,
+        (tenors - pivot) / (pivot - tenors[0]),
+        (tenors - pivot) / (tenors[-1] - pivot),
+    )
+
+
+def butterfly(tenors, size, belly=5.0):
+    """Return a butterfly: +size at both wings and -size at the belly
+    tenor, linear in between (a negative size humps the curve)."""
+    tenors = check_pivot(tenors, belly)
+    return size * np.where(
+        tenors < belly,
+        1 - 2 * (tenors - tenors[0]) / (belly - tenors[0]),
+        1 - 2 * (tenors[-1] - tenors) / (tenors[-1] - belly),
+    )
+
+
+def standard_scenarios(tenors):
+    """Return the names and the shift matrix of a standard scenario set."""
+    scenarios = {
+        "Parallel +100bp": parallel_shifts(tenors, [0.01])[0],
+        "Parallel -100bp": parallel_shifts(tenors, [-0.01])[0],
+        "Parallel +25bp": parallel_shifts(tenors, [0.0025])[0],
+        "Parallel -25bp": parallel_shifts(tenors, [-0.0025])[0],
+        "Steepener 50bp": twist(tenors, 0.005),
+        "Flattener 50bp": twist(tenors, -0.005),
+        "Butterfly +25bp": butterfly(tenors, 0.0025),
+        "Butterfly -25bp": butterfly(tenors, -0.0025),
+    }
+    return list(scenarios), np.array(list(scenarios.values()))
+
+
+def scenario_prices(
+    portfolio, rate_data, pricing_datetime, shifts, workers=None
+):
+    """Price a Portfolio under each scenario of a shift matrix.
+
+    All scenarios are priced in one sparse matrix product, see
+    shocked_prices, and large portfolios are split across worker
+    processes as in update_price.
+
+    Args:
+        portfolio: the Portfolio to price.
+        rate_data: the rate editor rows of the base curve.
+        pricing_datetime: the pricing date.
+        shifts: a (scenarios, tenors) array of zero rate shifts, one
+            column per row of rate_data.
+
+    Returns:
+        the base prices of the bonds, and a (scenarios, bonds) array of
+        scenario prices, both in notional amounts and NaN for bonds in a
+        currency other than the curve's.
+    """
+    shifts = np.atleast_2d(shifts)
+    if shifts.shape[1] != len(rate_data):
+        raise ValueError(
+            f"Expected {len(rate_data)} tenor shifts per scenario,"
+            f" got {shifts.shape[1]}"
+        )
+
+    n_workers = parallel_workers(len(portfolio), workers)
+    if n_workers > 1:
+        chunks = map_chunks(
+            scenario_prices,
+            portfolio,
+            n_workers,
+            rate_data,
+            pricing_datetime,
+            shifts,
+            1,
+        )
+        return (
+            np.concatenate([base for base, _ in chunks]),
+            np.concatenate([prices for _, prices in chunks], axis=1),
+        )
+
+    cashflows = cashflow_matrix(portfolio, pricing_datetime)
+    curve = compiled_curve(rate_data).curve
+    base = price_batch(cashflows, curve) * cashflows.notionals
+    prices = shocked_prices(cashflows, curve, shifts).T * cashflows.notionals
+    return base, prices
+
+
+def scenario_report(names, base, prices):
+    """Return one report row per scenario, with the value and P&L of the
+    portfolio. Bonds without a price (NaN) are left out."""
+    value = np.nansum(base)
+    report = []
+    for name, scenario_value in zip(names, np.nansum(prices, axis=1)):
+        pnl = scenario_value - value
+        report.append(
+            {
+                "Scenario": name,
+                "Value": round(float(scenario_value), 6),
+                "P&L": round(float(pnl), 6),
+                "P&L %": round(float(100 * pnl / value), 6) if value else None,
+            }
+        )
+    return report
+
+
+def historical_shifts(
+    rate_data, pricing_datetime, lookback=VAR_LOOKBACK, store=None
+):
+    """Return the daily zero rate changes of the stored curves, over the
+    lookback days up to the pricing date, as scenarios for the tenors of
+    rate_data.
+
+    Tenors that were not published on a day do not move that day.
+
+    Returns:
+        the dates at the end of each change, and a (changes, tenors)
+        array of shifts.
+    """
+    store = store or get_curve_store()
+    labels = {rate["Year"]: rate["Label"] for rate in RATE_TENOR_MAP}
+    try:
+        columns = [labels[rate["Year"]] for rate in rate_data]
+    except KeyError as e:
+        raise ValueError(f"No stored history for the tenor {e}") from None
+
+    try:
+        last = store.lookup([pricing_datetime], how="previous")[0]
+    except KeyError:
+        raise ValueError(
+            f"No stored curve on or before {pricing_datetime:%Y-%m-%d}"
+        ) from None
+    window = store.frame().iloc[max(0, last - lookback) : last + 1]
+    if len(window) < 2:
+        raise ValueError("Not enough stored curves for a historical VaR")
+
+    rates = window[columns].to_numpy(dtype=float) / 100
+    shifts = np.nan_to_num(np.diff(rates, axis=0))
+    return window["Date"].to_numpy()[1:], shifts
+
+
+def historical_var(
+    portfolio,
+    rate_data,
+    pricing_datetime,
+    lookback=VAR_LOOKBACK,
+    confidence=0.99,
+    workers=None,
+):
+    """Return the historical simulation VaR and expected shortfall of a
+    Portfolio, applying each daily curve change of the lookback window to
+    the curve of rate_data, all in one scenario_prices pass.
+
+    Bonds that cannot be priced on the curve (NaN) are left out.
+
+    Returns:
+        a dictionary with the VaR and ES (as positive losses), the number
+        of scenarios, and the dates and P&L of each scenario.
+    """
+    dates, shifts = historical_shifts(rate_data, pricing_datetime, lookback)
+    base, prices = scenario_prices(
+        portfolio, rate_data, pricing_datetime, shifts, workers
+    )
+    pnl = np.nansum(prices, axis=1) - np.nansum(base)
+
+    var = -np.quantile(pnl, 1 - confidence, method="lower")
+    return {
+        "VaR": float(var),
+        "ES": float(-pnl[pnl <= -var].mean()),
+        "Confidence": confidence,
+        "Scenarios": len(pnl),
+        "Dates": dates,
+        "P&L": pnl,
+    }
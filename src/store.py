@@ -0,0 +1,124 @@
+"""Server side portfolios, one per browser session."""
+
+import os
+import threading
+
+import numpy as np
+
+from src.bond import Portfolio
+from src.cache import LRUCache
+
+
+class SessionExpiredError(KeyError):
+    """The session is not in the store, because it was evicted or was
+    never created in this process."""
+
+
+class SessionPortfolio:
+    """The columnar Portfolio of one session, with a unique "id" per bond
+    for the grid.
+
+    Callbacks hold the lock while they change or price the portfolio.
+    """
+
+    def __init__(self, rows=()):
+        self.portfolio = Portfolio.from_rows([])
+        self.lock = threading.RLock()
+        self._next_id = 1
+        self.add(rows)
+
+    def __len__(self):
+        return len(self.portfolio)
+
+    def add(self, rows):
+        """Append bond table rows, giving each a new id, and return them."""
+        rows = [
+            {**row, "id": str(self._next_id + i)} for i, row in enumerate(rows)
+        ]
+        self._next_id += len(rows)
+        self.portfolio.append(rows)
+        return self.rows(np.arange(len(self) - len(rows), len(self)))
+
+    def load(self, portfolio):
+        """Replace the bonds with a Portfolio, giving each a new id."""
+        ids = np.arange(self._next_id, self._next_id + len(portfolio))
+        self._next_id += len(portfolio)
+        portfolio["id"][:] = ids.astype(str)
+        self.portfolio = portfolio
+
+    def index(self, row_id):
+        """Return the position of the bond with the given id."""
+        index = np.flatnonzero(self.portfolio["id"] == row_id)
+        if not len(index):
+            raise KeyError(f"No row with id {row_id}")
+        return index[0]
+
+    def rows(self, index=None):
+        """Return the bond table rows, for all bonds or the ones at index."""
+        return self.portfolio.to_rows(index)
+
+    def row(self, row_id):
+        """Return the bond table row with the given id."""
+        return self.rows([self.index(row_id)])[0]
+
+    def remove(self, row_id):
+        """Remove the bond with the given id."""
+        self.portfolio.delete(self.index(row_id))
+
+    def edit(self, row_id, field, value):
+        """Set a field of the bond with the given id, and clear its price.
+
+        Returns:
+            the position of the bond.
+        """
+        i = self.index(row_id)
+        self.portfolio.set_value(i, field, value)
+        self.portfolio.invalidate(i)
+        return i
+
+
+class PortfolioStore:
+    """Portfolios kept in this process, keyed by session id.
+
+    A session is new when its page is loaded, and becomes active once its
+    user changes the bonds. New and active sessions are evicted least
+    recently used first, each beyond its own maxsize, so page loads never
+    evict a portfolio that a user has changed. The store is not shared
+    between processes, so multi-process servers need sticky sessions.
+    """
+
+    def __init__(self, maxsize=1000, new_maxsize=1000):
+        self._sessions = LRUCache(maxsize=maxsize)
+        self._new = LRUCache(maxsize=new_maxsize)
+        self._lock = threading.Lock()
+
+    def create(self, session_id, rows=()):
+        """Start a new session with the given rows and return its
+        portfolio."""
+        portfolio = SessionPortfolio(rows)
+        self._new.put(session_id, portfolio)
+        return portfolio
+
+    def get(self, session_id, activate=False):
+        """Return the portfolio of a session, and make the session active
+        with activate, before its bonds are changed.
+
+        Raises:
+            SessionExpiredError: if the session is not known.
+        """
+        with self._lock:
+            portfolio = self._sessions.get(session_id)
+            if portfolio is None:
+                portfolio = self._new.get(session_id)
+                if portfolio is None:
+                    raise SessionExpiredError(session_id)
+                if activate:
+                    self._new.pop(session_id)
+                    self._sessions.put(session_id, portfolio)
+            return portfolio
+
+
+PORTFOLIOS = PortfolioStore(
+    maxsize=int(os.environ.get("PORTFOLIO_SESSIONS", "1000")),
+    new_maxsize=int(os.environ.get("PORTFOLIO_NEW_SESSIONS", "1000")),
+)
@@ -0,0 +1,16 @@
+"""
+Serve Treasury curves from a local fixture, so tests do not need a network.
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault(
+    "CURVE_SOURCE",
+    os.path.join(os.path.dirname(__file__), "data", "treasury_rates.csv"),
+)
+os.environ.setdefault(
+    "CURVE_STORE_PATH",
+    os.path.join(tempfile.mkdtemp(), "treasury_rates.parquet"),
+)
+os.environ.setdefault("JOB_CACHE_DIR", tempfile.mkdtemp())
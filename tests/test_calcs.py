@@ -1,8 +1,27 @@
+import copy
 from datetime import datetime
 
+import numpy as np
 import pytest
 
-from src.price import calculate_key_rate_duration
+from src import parallel
+from src.batch import CASHFLOW_CACHE, cashflow_matrix
+from src.bond import BOND_CACHE, Portfolio, bond_terms, cached_bond
+from src.curve import ZeroCurve
+from src.price import (
+    RESULT_CACHE,
+    SENSITIVITY_CACHE,
+    calculate_key_rate_duration,
+    update_price,
+)
+from src.row_model import query
+from src.scenarios import (
+    historical_shifts,
+    historical_var,
+    scenario_prices,
+    scenario_report,
+    standard_scenarios,
+)
 
 
 # Sample bond data and rate data
@@ -46,7 +65,9 @@ def test_calculate_key_rate_duration(bond_data_example, rate_data_example):
 
     # Call the calculate_key_rate_duration function
     krd_result = calculate_key_rate_duration(
-        bond_data_example, rate_data_example, pricing_datetime
+        Portfolio.from_rows(bond_data_example),
+        rate_data_example,
+        pricing_datetime,
     )
 
     # Check that the result is not empty and contains the expected structure
@@ -59,3 +80,426 @@ def test_calculate_key_rate_duration(bond_data_example, rate_data_example):
 
     # Optionally print the result for review
     print("KRD Result:", krd_result)
+
+
+@pytest.fixture
+def bond_portfolio_example():
+    return [
+        {
+            "Bond": f"Bond {i}",
+            "Currency": "USD",
+            "Coupon": coupon,
+            "Accrual Start": "2024-01-02",
+            "Maturity": maturity,
+            "Frequency": frequency,
+            "Notional": 100,
+            "Price": None,
+        }
+        for i, (coupon, maturity, frequency) in enumerate(
+            [
+                (2.5, "2025-01-02", 1),
+                (5.0, "2029-06-30", 2),
+                (4.0, "2053-12-31", 4),
+            ]
+        )
+    ]
+
+
+def risk_values(portfolio):
+    return np.array([portfolio[field] for field in Portfolio.RISK_COLUMNS])
+
+
+def test_update_price_bump_matches_model(
+    bond_portfolio_example, rate_data_example
+):
+    pricing_datetime = datetime(2024, 1, 2)
+    bonds = Portfolio.from_rows(bond_portfolio_example)
+    batch_bonds = Portfolio.from_rows(bond_portfolio_example)
+
+    update_price(bonds, rate_data_example, pricing_datetime, method="model")
+    update_price(batch_bonds, rate_data_example, pricing_datetime, "bump")
+
+    assert risk_values(batch_bonds) == pytest.approx(
+        risk_values(bonds), rel=1e-9
+    )
+
+
+def test_update_price_analytic_matches_bump(
+    bond_portfolio_example, rate_data_example
+):
+    pricing_datetime = datetime(2024, 1, 2)
+    bonds = Portfolio.from_rows(bond_portfolio_example)
+    analytic_bonds = Portfolio.from_rows(bond_portfolio_example)
+
+    update_price(bonds, rate_data_example, pricing_datetime, method="bump")
+    update_price(analytic_bonds, rate_data_example, pricing_datetime)
+
+    price, duration, convexity = risk_values(bonds)
+    a_price, a_duration, a_convexity = risk_values(analytic_bonds)
+    assert a_price == pytest.approx(price, rel=1e-12)
+    # The +/-1% bumps differ from the derivatives by O(shock**2 * t**2)
+    assert a_duration == pytest.approx(duration, rel=2e-2)
+    assert a_convexity == pytest.approx(convexity, rel=5e-2)
+
+
+def test_other_currency_is_not_priced(
+    bond_portfolio_example, rate_data_example
+):
+    pricing_datetime = datetime(2024, 1, 2)
+    rows = copy.deepcopy(bond_portfolio_example)
+    rows[0]["Currency"] = "EUR"
+
+    # The USD curve cannot discount EUR cashflows, so the bond is left
+    # unpriced by every method, as the FixedModel refuses to price it
+    for method in ["analytic", "taylor", "bump"]:
+        portfolio = Portfolio.from_rows(rows)
+        update_price(portfolio, rate_data_example, pricing_datetime, method)
+        assert np.isnan(portfolio["Price"][0])
+        assert not np.isnan(portfolio["Price"][1:]).any()
+        assert portfolio.unpriced().tolist() == [0]
+
+    krd = calculate_key_rate_duration(
+        portfolio, rate_data_example, pricing_datetime
+    )
+    assert all(krd[0][rate] is None for rate in ["1 Mo", "1 Yr"])
+    assert krd[1]["1 Mo"] is not None
+
+    names, shifts = standard_scenarios(
+        [rate["Year"] for rate in rate_data_example]
+    )
+    base, prices = scenario_prices(
+        portfolio, rate_data_example, pricing_datetime, shifts
+    )
+    assert np.isnan(base[0]) and np.isnan(prices[:, 0]).all()
+    report = scenario_report(names, base, prices)
+    assert report[0]["Value"] == pytest.approx(np.nansum(prices[0]))
+
+
+def test_key_rate_duration_jacobian_matches_model(
+    bond_portfolio_example, rate_data_example
+):
+    pricing_datetime = datetime(2024, 1, 2)
+
+    portfolio = Portfolio.from_rows(bond_portfolio_example)
+    krd_model = calculate_key_rate_duration(
+        portfolio, rate_data_example, pricing_datetime, "model"
+    )
+    krd_jacobian = calculate_key_rate_duration(
+        portfolio, rate_data_example, pricing_datetime
+    )
+
+    assert len(krd_jacobian) == len(krd_model)
+    for row, expected in zip(krd_jacobian, krd_model):
+        assert row.keys() == expected.keys()
+        for key, value in expected.items():
+            if value is None or isinstance(value, str):
+                assert row[key] == value
+            else:
+                assert row[key] == pytest.approx(value, abs=2e-6)
+
+
+def test_shifted_curve_matches_shifted_rates(rate_data_example):
+    curve = ZeroCurve.from_rate_data(rate_data_example)
+    base_rates = curve.rates.copy()
+    times = np.linspace(0, 30, 61)
+    shift = np.linspace(-0.01, 0.02, len(rate_data_example))
+
+    for s in [0.01, shift]:
+        expected = ZeroCurve(curve.tenors, curve.rates[1:] + s)
+        assert curve.shifted(s).discount(times) == pytest.approx(
+            expected.discount(times), rel=1e-12
+        )
+    assert np.array_equal(curve.rates, base_rates)
+
+
+def test_cached_bond(bond_data_example):
+    BOND_CACHE.clear()
+    maxsize = BOND_CACHE.maxsize
+    bond = bond_data_example[0]
+    same_terms = {**bond, "Bond": "Bond 2", "Notional": 5}
+
+    bond_obj, timetable = cached_bond(bond)
+    assert cached_bond(same_terms) == (bond_obj, timetable)
+    assert BOND_CACHE.cache_info().hits == 1
+    assert BOND_CACHE.cache_info().misses == 1
+
+    cached_bond({**bond, "Coupon": 4.0})
+    BOND_CACHE.resize(1)
+    assert BOND_CACHE.cache_info().currsize == 1
+    assert cached_bond(bond)[0] is not bond_obj
+    BOND_CACHE.resize(maxsize)
+
+
+def test_cashflow_cache_holds_portfolio(bond_portfolio_example):
+    pricing_datetime = datetime(2024, 1, 2)
+    CASHFLOW_CACHE.clear()
+    maxsize = CASHFLOW_CACHE.maxsize
+    CASHFLOW_CACHE.resize(2)
+    bonds = Portfolio.from_rows(bond_portfolio_example)
+
+    # A portfolio larger than the cache grows it, so repricing it finds
+    # every bond
+    cashflow_matrix(bonds, pricing_datetime)
+    cashflow_matrix(bonds, pricing_datetime)
+    info = CASHFLOW_CACHE.cache_info()
+    assert info.maxsize == len(bonds)
+    assert (info.hits, info.misses) == (len(bonds), len(bonds))
+    CASHFLOW_CACHE.resize(maxsize)
+
+
+def test_result_cache(bond_portfolio_example, rate_data_example):
+    pricing_datetime = datetime(2024, 1, 2)
+    RESULT_CACHE.clear()
+
+    bonds = Portfolio.from_rows(bond_portfolio_example)
+    update_price(bonds, rate_data_example, pricing_datetime)
+    krd_report = calculate_key_rate_duration(
+        bonds, rate_data_example, pricing_datetime
+    )
+    assert RESULT_CACHE.cache_info().misses == 2 * len(bonds)
+
+    # The same bonds with other notionals and one new bond only compute
+    # the new bond, and scale the cached results by the notionals
+    rows = [
+        {**row, "Notional": 2 * row["Notional"]}
+        for row in bond_portfolio_example
+    ]
+    more = Portfolio.from_rows(rows + [{**rows[0], "Coupon": 1.25}])
+    update_price(more, rate_data_example, pricing_datetime)
+    more_report = calculate_key_rate_duration(
+        more, rate_data_example, pricing_datetime
+    )
+    info = RESULT_CACHE.cache_info()
+    assert info.hits == 2 * len(bonds)
+    assert info.misses == 2 * len(bonds) + 2
+    np.testing.assert_allclose(
+        more["Price"][: len(bonds)], 2 * bonds["Price"], rtol=1e-12
+    )
+    assert more_report[0]["Bond"] == krd_report[0]["Bond"]
+    assert more_report[0]["1 Yr"] == pytest.approx(
+        2 * krd_report[0]["1 Yr"], rel=1e-6
+    )
+
+    # Another curve is a miss, and the cache is bounded
+    moved = [
+        {**rate, "Rate": rate["Rate"] + 0.1} for rate in rate_data_example
+    ]
+    bonds.invalidate()
+    update_price(bonds, moved, pricing_datetime)
+    assert RESULT_CACHE.cache_info().misses == 3 * len(bonds) + 2
+    maxsize = RESULT_CACHE.maxsize
+    RESULT_CACHE.resize(2)
+    assert len(RESULT_CACHE) == 2
+    RESULT_CACHE.resize(maxsize)
+
+
+def test_update_price_taylor(bond_portfolio_example, rate_data_example):
+    pricing_datetime = datetime(2024, 1, 2)
+    SENSITIVITY_CACHE.clear()
+
+    def priced(rate_data, method):
+        bonds = Portfolio.from_rows(bond_portfolio_example)
+        update_price(bonds, rate_data, pricing_datetime, method=method)
+        return risk_values(bonds)
+
+    # The first pass prices fully, and stores the expansions
+    assert priced(rate_data_example, "taylor") == pytest.approx(
+        priced(rate_data_example, "analytic"), rel=1e-12
+    )
+    assert SENSITIVITY_CACHE.cache_info().currsize == 3
+
+    # A small edit of one rate is repriced from the expansions
+    edited = copy.deepcopy(rate_data_example)
+    edited[8]["Rate"] += 0.05
+    hits = SENSITIVITY_CACHE.cache_info().hits
+    # Price is second order, duration and convexity first order
+    assert priced(edited, "taylor") == pytest.approx(
+        priced(edited, "analytic"), rel=1e-5
+    )
+    assert SENSITIVITY_CACHE.cache_info().hits == hits + 3
+
+    # A move beyond the threshold is fully repriced
+    edited[8]["Rate"] += 0.5
+    assert priced(edited, "taylor") == pytest.approx(
+        priced(edited, "analytic"), rel=1e-12
+    )
+
+
+def test_portfolio_round_trip(bond_portfolio_example):
+    portfolio = Portfolio.from_rows(bond_portfolio_example)
+    assert portfolio["Maturity"].dtype == np.dtype("datetime64[D]")
+    assert list(portfolio.unpriced()) == [0, 1, 2]
+
+    rows = portfolio.take([2, 0]).to_rows()
+    assert [row["Bond"] for row in rows] == ["Bond 2", "Bond 0"]
+    assert rows[0]["Maturity"] == "2053-12-31"
+    assert rows[0]["Price"] is None
+    assert portfolio.terms()[0] == bond_terms(bond_portfolio_example[0])
+
+    # Taken bonds are copies, even for a slice, so pricing them leaves the
+    # original portfolio unchanged
+    taken = portfolio.take(slice(0, 2))
+    taken["Price"][:] = 100.0
+    assert list(portfolio.unpriced()) == [0, 1, 2]
+
+
+def test_parallel_matches_in_process(
+    bond_portfolio_example, rate_data_example, monkeypatch
+):
+    pricing_datetime = datetime(2024, 1, 2)
+    monkeypatch.setattr(parallel, "PARALLEL_MIN_CHUNK", 1)
+    assert parallel.parallel_workers(3, workers=2) == 2
+
+    try:
+        bonds = Portfolio.from_rows(bond_portfolio_example)
+        pooled = Portfolio.from_rows(bond_portfolio_example)
+        update_price(bonds, rate_data_example, pricing_datetime)
+        krd_report = calculate_key_rate_duration(
+            bonds, rate_data_example, pricing_datetime
+        )
+
+        # Price again in the pool, not from the result cache
+        RESULT_CACHE.clear()
+        update_price(pooled, rate_data_example, pricing_datetime, workers=2)
+        assert np.array_equal(risk_values(pooled), risk_values(bonds))
+        assert (
+            calculate_key_rate_duration(
+                pooled, rate_data_example, pricing_datetime, workers=2
+            )
+            == krd_report
+        )
+    finally:
+        parallel.shutdown_pool()
+
+
+def test_parallel_taylor_is_deterministic(
+    bond_portfolio_example, rate_data_example, monkeypatch
+):
+    pricing_datetime = datetime(2024, 1, 2)
+    monkeypatch.setattr(parallel, "PARALLEL_MIN_CHUNK", 1)
+    edited = copy.deepcopy(rate_data_example)
+    edited[8]["Rate"] += 0.05
+
+    def priced(workers):
+        SENSITIVITY_CACHE.clear()
+        results = []
+        for rate_data in [rate_data_example, edited]:
+            bonds = Portfolio.from_rows(bond_portfolio_example * 3)
+            update_price(
+                bonds,
+                rate_data,
+                pricing_datetime,
+                method="taylor",
+                workers=workers,
+            )
+            results.append(risk_values(bonds))
+        return results
+
+    # The expansions stay in this process, so the workers that priced the
+    # first curve do not change the update to the second
+    try:
+        expected = priced(1)
+        for _ in range(4):
+            pooled = priced(4)
+            assert all(map(np.array_equal, pooled, expected))
+    finally:
+        parallel.shutdown_pool()
+
+
+def test_scenario_prices_match_shifted_curves(
+    bond_portfolio_example, rate_data_example
+):
+    pricing_datetime = datetime(2024, 1, 2)
+    portfolio = Portfolio.from_rows(bond_portfolio_example)
+    tenors = [rate["Year"] for rate in rate_data_example]
+    names, shifts = standard_scenarios(tenors)
+    assert shifts.shape == (len(names), len(tenors))
+
+    base, prices = scenario_prices(
+        portfolio, rate_data_example, pricing_datetime, shifts
+    )
+    assert prices.shape == (len(names), len(portfolio))
+
+    # Each scenario matches repricing on a curve with shifted zero rates
+    for shift, scenario in zip(shifts, prices):
+        shifted = [
+            {**rate, "Rate": rate["Rate"] + 100 * s}
+            for rate, s in zip(rate_data_example, shift)
+        ]
+        repriced = Portfolio.from_rows(bond_portfolio_example)
+        update_price(repriced, shifted, pricing_datetime)
+        assert scenario == pytest.approx(repriced["Price"], rel=1e-12)
+
+    report = scenario_report(names, base, prices)
+    assert report[0]["Scenario"] == "Parallel +100bp"
+    assert report[0]["P&L"] < 0 < report[1]["P&L"]
+
+
+def test_historical_var(bond_portfolio_example, rate_data_example):
+    pricing_datetime = datetime(2024, 1, 10)
+    portfolio = Portfolio.from_rows(bond_portfolio_example)
+
+    dates, shifts = historical_shifts(rate_data_example, pricing_datetime, 5)
+    assert len(dates) == 5
+    assert str(dates[-1])[:10] == "2024-01-10"
+    assert shifts.shape == (5, len(rate_data_example))
+
+    # No curves are stored before the pricing date
+    with pytest.raises(ValueError):
+        historical_shifts(rate_data_example, datetime(2023, 6, 1), 5)
+
+    var = historical_var(
+        portfolio, rate_data_example, pricing_datetime, lookback=5
+    )
+    # With 5 scenarios the 99% VaR and ES are the worst loss
+    assert var["Scenarios"] == 5
+    assert var["VaR"] == pytest.approx(-var["P&L"].min())
+    assert var["ES"] == pytest.approx(var["VaR"])
+
+
+def test_query(bond_portfolio_example):
+    portfolio = Portfolio.from_rows(bond_portfolio_example)
+
+    # Descending coupons
+    order = query(portfolio, [{"colId": "Coupon", "sort": "desc"}])
+    assert list(order) == [1, 2, 0]
+
+    # Bonds maturing after 2026 with a coupon over 4, or a Bond 0
+    order = query(
+        portfolio,
+        [{"colId": "Maturity", "sort": "asc"}],
+        {
+            "Maturity": {
+                "filterType": "date",
+                "type": "greaterThan",
+                "dateFrom": "2026-01-01 00:00:00",
+            },
+            "Coupon": {
+                "filterType": "number",
+                "operator": "OR",
+                "conditions": [
+                    {"type": "greaterThan", "filter": 4.5},
+                    {"type": "lessThan", "filter": 3},
+                ],
+            },
+        },
+    )
+    assert list(order) == [1]
+
+    order = query(
+        portfolio,
+        filter_model={
+            "Bond": {"filterType": "text", "type": "endsWith", "filter": "2"}
+        },
+    )
+    assert list(order) == [2]
+
+    # Prices are all missing before pricing
+    order = query(
+        portfolio,
+        filter_model={"Price": {"filterType": "number", "type": "blank"}},
+    )
+    assert len(order) == 3
+
+    with pytest.raises(ValueError):
+        query(portfolio, [{"colId": "id", "sort": "asc"}])
@@ -2,221 +2,587 @@
 Test callbacks.
 """
 
+import base64
+import os
+import subprocess
+import sys
 from contextvars import copy_context
 
+import numpy as np
+import pytest
+from dash import no_update
 from dash._callback_context import context_value
 from dash._utils import AttributeDict
 
 from app import (
+    app,
+    column_defs,
+    get_bond_rows,
+    show_krd_report,
+    show_scenario_report,
     show_timetable,
+    start_krd_report,
     update_bond_data,
     update_rate_graph,
-    update_table,
+    upload_portfolio,
 )
+from src import metrics, price
 from src.bond import DEFAULT_MENU
+from src.price import RESULT_CACHE
+from src.store import PORTFOLIOS, PortfolioStore, SessionExpiredError
 
 
-def test_update_bond_data():
-    # Simulate an "add bond" click event
-    initial_data = [
-        {
-            "Bond": "Bond 1",
-            "Currency": "USD",
-            "Coupon": 2.5,
-            "Accrual Start": "2023-12-31",
-            "Maturity": "2024-12-31",
-            "Frequency": 1,
-            "Notional": 1000000,
-            "Price": None,
-            "Menu": DEFAULT_MENU,
-        }
-    ]
-    pricing_datetime = "2023-12-31"  # Updated pricing date
-
-    # Correctly passing the required data argument, including pricing_datetime
+# Function to run a callback as if triggered by the given input
+def run_triggered(prop_id, callback, *args):
     def run_callback():
         context_value.set(
-            AttributeDict(
-                **{
-                    "triggered_inputs": [
-                        {"prop_id": "add-bond-button.n_clicks"}
-                    ]
-                }
-            )
-        )
-        return update_bond_data(
-            1, None, None, None, pricing_datetime, initial_data
+            AttributeDict(**{"triggered_inputs": [{"prop_id": prop_id}]})
         )
+        return callback(*args)
 
     ctx = copy_context()
-    updated_data = ctx.run(run_callback)
+    return ctx.run(run_callback)
+
 
-    # Check if a new bond was added
-    assert len(updated_data) == 2
-    assert updated_data[1]["Bond"] == "Bond 2"
+def test_update_bond_data():
+    # Simulate an "add bond" click event
+    PORTFOLIOS.create(
+        "test-add",
+        [
+            {
+                "Bond": "Bond 1",
+                "Currency": "USD",
+                "Coupon": 2.5,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2024-12-31",
+                "Frequency": 1,
+                "Notional": 1000000,
+                "Price": None,
+                "Menu": DEFAULT_MENU,
+            }
+        ],
+    )
+    pricing_datetime = "2023-12-31"  # Updated pricing date
+
+    transaction, _ = run_triggered(
+        "add-bond-button.n_clicks",
+        update_bond_data,
+        1,
+        None,
+        None,
+        None,
+        None,
+        pricing_datetime,
+        "test-add",
+    )
+
+    # Check if a new bond was added, and only the new row is sent
+    rows = PORTFOLIOS.get("test-add").rows()
+    assert len(rows) == 2
+    assert rows[1]["Bond"] == "Bond 2"
+    assert transaction["add"] == [rows[1]]
+    assert rows[0]["id"] != rows[1]["id"]
 
 
 def test_rate_update():
     # Mock rate update event with necessary bond fields
-    initial_data = [
-        {
-            "Bond": "Bond 1",
-            "Currency": "USD",
-            "Coupon": 5.0,
-            "Accrual Start": "2023-12-31",
-            "Maturity": "2024-12-31",
-            "Frequency": 1,
-            "Notional": 1000000,
-            "Price": None,
-            "Menu": DEFAULT_MENU,
-        }
-    ]
+    PORTFOLIOS.create(
+        "test-rates",
+        [
+            {
+                "Bond": "Bond 1",
+                "Currency": "USD",
+                "Coupon": 5.0,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2024-12-31",
+                "Frequency": 1,
+                "Notional": 1000000,
+                "Price": 100.0,
+                "Menu": DEFAULT_MENU,
+            }
+        ],
+    )
     pricing_datetime = "2023-12-31"  # Updated pricing date
     mock_rate_data = [{"Year": 1.0, "Rate": 5.5}, {"Year": 2.0, "Rate": 4.7}]
 
-    # Correctly passing the required rate_data argument, including pricing_datetime
-    def run_callback():
-        context_value.set(
-            AttributeDict(
-                **{
-                    "triggered_inputs": [
-                        {"prop_id": "rate-editor.cellValueChanged"}
-                    ]
-                }
-            )
-        )
-        return update_table(initial_data, pricing_datetime, mock_rate_data)
-
-    ctx = copy_context()
-    updated_data = ctx.run(run_callback)
+    transaction, _ = run_triggered(
+        "rate-editor.cellValueChanged",
+        update_bond_data,
+        None,
+        None,
+        None,
+        [{"colId": "Rate"}],
+        mock_rate_data,
+        pricing_datetime,
+        "test-rates",
+    )
 
     # Check if bond prices were updated after rate change
-    assert updated_data[0]["Price"] is not None
+    assert transaction["update"][0]["Price"] not in (None, 100.0)
 
 
 def test_price_recalculation():
-    # Initial bond data with missing prices and necessary bond fields
-    bond_data = [
-        {
-            "Bond": "Bond 1",
-            "Currency": "USD",
-            "Coupon": 5.0,
-            "Accrual Start": "2023-12-31",
-            "Maturity": "2024-12-31",
-            "Frequency": 1,
-            "Notional": 1000000,
-            "Price": None,
-            "Menu": DEFAULT_MENU,
-        }
-    ]
+    # Initial bond data with a stale price and necessary bond fields
+    PORTFOLIOS.create(
+        "test-edit",
+        [
+            {
+                "Bond": "Bond 1",
+                "Currency": "USD",
+                "Coupon": 5.0,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2024-12-31",
+                "Frequency": 1,
+                "Notional": 1000000,
+                "Price": 100.0,
+                "Menu": DEFAULT_MENU,
+            }
+        ],
+    )
+    row_id = PORTFOLIOS.get("test-edit").rows()[0]["id"]
 
     # Mock rate data
     rate_data = [{"Year": 1.0, "Rate": 5.0}, {"Year": 2.0, "Rate": 4.5}]
     pricing_datetime = "2023-12-31"  # Updated pricing date
 
-    # Correctly passing both bond_data, rate_data, and pricing_datetime arguments
-    def run_callback():
-        return update_table(bond_data, pricing_datetime, rate_data)
-
-    ctx = copy_context()
-    updated_bond_data = ctx.run(run_callback)
+    # Edit the coupon of the bond
+    transaction, _ = run_triggered(
+        "bond-table.cellValueChanged",
+        update_bond_data,
+        None,
+        [{"rowId": row_id, "colId": "Coupon", "value": 4.0}],
+        None,
+        None,
+        rate_data,
+        pricing_datetime,
+        "test-edit",
+    )
 
     # Check that price and duration are updated
-    assert updated_bond_data[0]["Price"] is not None
-    assert updated_bond_data[0]["Duration"] is not None
+    (row,) = transaction["update"]
+    assert row["Coupon"] == 4.0
+    assert row["Price"] not in (None, 100.0)
+    assert row["Duration"] is not None
 
 
 def test_delete_bond():
     # Initial bond data with two bonds
-    initial_data = [
-        {
-            "Bond": "Bond 1",
-            "Currency": "USD",
-            "Coupon": 5.0,
-            "Accrual Start": "2023-12-31",
-            "Maturity": "2024-12-31",
-            "Frequency": 1,
-            "Notional": 1000000,
-            "Price": None,
-            "Menu": DEFAULT_MENU,
-        },
-        {
-            "Bond": "Bond 2",
-            "Currency": "USD",
-            "Coupon": 3.5,
-            "Accrual Start": "2023-12-31",
-            "Maturity": "2025-12-31",
-            "Frequency": 1,
-            "Notional": 500000,
-            "Price": None,
-            "Menu": DEFAULT_MENU,
-        },
-    ]
+    PORTFOLIOS.create(
+        "test-delete",
+        [
+            {
+                "Bond": "Bond 1",
+                "Currency": "USD",
+                "Coupon": 5.0,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2024-12-31",
+                "Frequency": 1,
+                "Notional": 1000000,
+                "Price": None,
+                "Menu": DEFAULT_MENU,
+            },
+            {
+                "Bond": "Bond 2",
+                "Currency": "USD",
+                "Coupon": 3.5,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2025-12-31",
+                "Frequency": 1,
+                "Notional": 500000,
+                "Price": None,
+                "Menu": DEFAULT_MENU,
+            },
+        ],
+    )
     pricing_datetime = "2023-12-31"  # Pricing date
+    row_id = PORTFOLIOS.get("test-delete").rows()[0]["id"]
 
     # Simulate deleting the first bond
-    def run_callback():
-        context_value.set(
-            AttributeDict(
-                **{
-                    "triggered_inputs": [
-                        {"prop_id": "bond-table.cellRendererData"}
-                    ]
-                }
-            )
-        )
-        return update_bond_data(
-            None,
-            None,
-            {"value": 1, "rowIndex": 0},
-            None,
-            pricing_datetime,
-            initial_data,
-        )
-
-    ctx = copy_context()
-    updated_data = ctx.run(run_callback)
+    transaction, _ = run_triggered(
+        "bond-table.cellRendererData",
+        update_bond_data,
+        None,
+        None,
+        {"value": 1, "rowIndex": 0, "rowId": row_id},
+        None,
+        None,
+        pricing_datetime,
+        "test-delete",
+    )
 
     # Check that only one bond remains after deletion
-    assert len(updated_data) == 1
-    assert updated_data[0]["Bond"] == "Bond 2"
+    rows = PORTFOLIOS.get("test-delete").rows()
+    assert transaction["remove"] == [{"id": row_id}]
+    assert len(rows) == 1
+    assert rows[0]["Bond"] == "Bond 2"
+
+
+def test_session_eviction():
+    store = PortfolioStore(maxsize=1, new_maxsize=2)
+    store.create("active")
+    store.get("active", activate=True)
+    for session_id in ["new 1", "new 2", "new 3"]:
+        store.create(session_id)
+
+    # Page loads evict only the sessions that nobody has changed
+    assert len(store.get("active")) == 0
+    assert store.get("new 3") is not None
+    with pytest.raises(SessionExpiredError):
+        store.get("new 1")
+
+
+def test_session_expired():
+    # Callbacks of an unknown session ask for a reload
+    response = app.server.test_client().post(
+        "/_dash-update-component",
+        json={
+            "output": "..bond-table.rowTransaction...bond-table-refresh.data..",
+            "outputs": [
+                {"id": "bond-table", "property": "rowTransaction"},
+                {"id": "bond-table-refresh", "property": "data"},
+            ],
+            "inputs": [
+                {"id": "add-bond-button", "property": "n_clicks", "value": 1},
+                {"id": "bond-table", "property": "cellValueChanged"},
+                {"id": "bond-table", "property": "cellRendererData"},
+                {"id": "rate-editor", "property": "cellValueChanged"},
+                {"id": "rate-editor", "property": "rowData"},
+                {
+                    "id": "pricing-datetime-picker",
+                    "property": "date",
+                    "value": "2024-01-02",
+                },
+            ],
+            "state": [
+                {"id": "session-id", "property": "data", "value": "unknown"}
+            ],
+            "changedPropIds": ["add-bond-button.n_clicks"],
+        },
+    )
+    assert response.status_code == 200
+    status = response.get_json()["sideUpdate"]["session-status"]
+    assert status["is_open"]
+    assert "reload" in status["children"]
+
+    # And edits of unknown bonds are ignored
+    PORTFOLIOS.create("test-unknown-bond")
+    transaction, _ = run_triggered(
+        "bond-table.cellValueChanged",
+        update_bond_data,
+        None,
+        [{"rowId": "missing", "colId": "Coupon", "value": 1.0}],
+        None,
+        None,
+        None,
+        "2024-01-02",
+        "test-unknown-bond",
+    )
+    assert transaction is no_update
 
 
 def test_show_timetable():
     # Initial bond data with one bond
-    initial_data = [
+    PORTFOLIOS.create(
+        "test-timetable",
+        [
+            {
+                "Bond": "Bond 1",
+                "Currency": "USD",
+                "Coupon": 5.0,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2024-12-31",
+                "Frequency": 1,
+                "Notional": 1000000,
+                "Price": None,
+                "Menu": DEFAULT_MENU,
+            }
+        ],
+    )
+
+    # Simulate showing the timetable for the first bond
+    timetable_data, is_open = run_triggered(
+        "bond-table.cellRendererData",
+        show_timetable,
+        {"value": 2, "rowIndex": 0},
+        "test-timetable",
+    )
+
+    # Check that the timetable is returned and offcanvas is opened
+    assert timetable_data != ""
+    assert is_open is True
+
+
+def test_show_krd_report():
+    PORTFOLIOS.create(
+        "test-krd",
+        [
+            {
+                "Bond": f"Bond {i}",
+                "Currency": "USD",
+                "Coupon": 5.0,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2024-12-31",
+                "Frequency": 1,
+                "Notional": 100 * i,
+            }
+            for i in range(1, 4)
+        ],
+    )
+    rate_data = [{"Year": 1.0, "Rate": 5.0}, {"Year": 2.0, "Rate": 4.5}]
+
+    # The job reads a snapshot of the portfolio from the job cache, not
+    # the session store, and streams the report rows with its progress
+    krd_job = start_krd_report(1, "test-krd", rate_data)
+    PORTFOLIOS.get("test-krd").edit("2", "Notional", 1)
+    progress = []
+    rows, status = show_krd_report(
+        progress.append, krd_job, rate_data, "2023-12-31"
+    )
+    assert [row["Bond"] for row in rows] == ["Bond 1", "Bond 2", "Bond 3"]
+    assert progress[-1] == (3, 3, rows)
+    assert status == "3 bonds"
+
+    # The same portfolio and curve are served from the result cache
+    progress = []
+    cached_rows, _ = show_krd_report(
+        progress.append, krd_job, rate_data, "2023-12-31"
+    )
+    assert cached_rows == rows
+    assert progress == [(3, 3, rows)]
+
+    # An edit changes the snapshot and the cache key
+    PORTFOLIOS.get("test-krd").edit("1", "Notional", 1000)
+    edited_job = start_krd_report(2, "test-krd", rate_data)
+    assert edited_job["portfolio"] != krd_job["portfolio"]
+    edited_rows, _ = show_krd_report(
+        progress.append, edited_job, rate_data, "2023-12-31"
+    )
+    assert edited_rows != rows
+
+    # Nothing is started before the curve is loaded
+    assert start_krd_report(3, "test-krd", []) is no_update
+
+
+def test_krd_report_keeps_bond_results(monkeypatch):
+    bonds = [
         {
-            "Bond": "Bond 1",
+            "Bond": f"Bond {i}",
             "Currency": "USD",
-            "Coupon": 5.0,
+            "Coupon": 4.0 + i / 8,
             "Accrual Start": "2023-12-31",
-            "Maturity": "2024-12-31",
-            "Frequency": 1,
-            "Notional": 1000000,
-            "Price": None,
-            "Menu": DEFAULT_MENU,
+            "Maturity": "2027-12-31",
+            "Frequency": 2,
+            "Notional": 100,
         }
+        for i in range(1, 5)
+    ]
+    PORTFOLIOS.create("test-krd-three", bonds[:3])
+    PORTFOLIOS.create("test-krd-four", bonds)
+    rate_data = [{"Year": 1.0, "Rate": 5.1}, {"Year": 5.0, "Rate": 4.6}]
+    computed = []
+    compute = price.key_rate_durations
+
+    def key_rate_durations(bonds, *args):
+        computed.append(len(bonds))
+        return compute(bonds, *args)
+
+    monkeypatch.setattr("src.price.key_rate_durations", key_rate_durations)
+    krd_job = start_krd_report(1, "test-krd-three", rate_data)
+    show_krd_report(lambda _: None, krd_job, rate_data, "2023-12-31")
+    assert computed == [3]
+
+    # The next job, which may run in another process, computes only the
+    # new bond
+    RESULT_CACHE.clear()
+    krd_job = start_krd_report(1, "test-krd-four", rate_data)
+    rows, status = show_krd_report(
+        lambda _: None, krd_job, rate_data, "2023-12-31"
+    )
+    assert computed == [3, 1]
+    assert {row["Bond"] for row in rows} >= {"Bond 1", "Bond 4"}
+    assert status == "4 bonds"
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_job_can_use_caches():
+    # A job forked while another thread holds a cache lock gets a new lock
+    with RESULT_CACHE._lock:
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if RESULT_CACHE._lock.acquire(timeout=5) else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_show_scenario_report():
+    PORTFOLIOS.create(
+        "test-scenarios",
+        [
+            {
+                "Bond": "Bond 1",
+                "Currency": "USD",
+                "Coupon": 5.0,
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2026-12-31",
+                "Frequency": 1,
+                "Notional": 100,
+            }
+        ],
+    )
+    rate_data = [
+        {"Year": 1.0, "Rate": 5.0},
+        {"Year": 5.0, "Rate": 4.5},
+        {"Year": 10.0, "Rate": 4.0},
     ]
 
-    # Simulate showing the timetable for the first bond
-    def run_callback():
-        context_value.set(
-            AttributeDict(
-                **{
-                    "triggered_inputs": [
-                        {"prop_id": "bond-table.cellRendererData"}
-                    ]
-                }
-            )
+    # Nothing to report before the rate editor is filled in
+    assert show_scenario_report(1, "test-scenarios", [], "2023-12-31") == (
+        no_update,
+        no_update,
+    )
+
+    report, is_open = show_scenario_report(
+        1, "test-scenarios", rate_data, "2023-12-31"
+    )
+    assert is_open
+    assert report[0]["Scenario"] == "Parallel +100bp"
+
+
+def test_upload_portfolio():
+    csv = (
+        "Bond,Currency,Coupon,Accrual Start,Maturity,Frequency,Notional\n"
+        "Bond A,USD,5.0,2023-12-31,2024-12-31,1,100\n"
+        "Bond B,EUR,3.5,2023-12-31,2025-06-30,2,200\n"
+    )
+    contents = "data:text/csv;base64," + base64.b64encode(csv.encode()).decode(
+        "ascii"
+    )
+    rate_data = [{"Year": 1.0, "Rate": 5.0}, {"Year": 2.0, "Rate": 4.5}]
+
+    PORTFOLIOS.create("test-upload")
+    rows, status, _ = upload_portfolio(
+        contents, "book.csv", rate_data, "2023-12-31", "test-upload"
+    )
+
+    # The uploaded bonds replace the portfolio, and are priced, except the
+    # EUR bond, which the USD curve cannot discount
+    assert [row["Bond"] for row in rows] == ["Bond A", "Bond B"]
+    assert [row["Price"] is not None for row in rows] == [True, False]
+    assert len(PORTFOLIOS.get("test-upload")) == 2
+    assert status == "Loaded 2 bonds from book.csv"
+
+    # A bond with cashflows before the pricing date cannot be priced, and
+    # the portfolio keeps its bonds
+    seasoned = "Bond C,USD,4.0,2020-01-02,2026-01-02,2,100\n"
+    contents = "data:text/csv;base64," + base64.b64encode(
+        (csv + seasoned).encode()
+    ).decode("ascii")
+    rows, status, _ = upload_portfolio(
+        contents, "seasoned.csv", rate_data, "2023-12-31", "test-upload"
+    )
+    assert rows is no_update
+    assert status.startswith("Cannot price seasoned.csv: Cashflow times")
+    assert len(PORTFOLIOS.get("test-upload")) == 2
+
+
+def test_get_bond_rows():
+    PORTFOLIOS.create(
+        "test-rows",
+        [
+            {
+                "Bond": f"Bond {i}",
+                "Currency": "USD",
+                "Coupon": float(i),
+                "Accrual Start": "2023-12-31",
+                "Maturity": "2026-12-31",
+                "Frequency": 1,
+                "Notional": 100,
+                "Price": None,
+            }
+            for i in range(10)
+        ],
+    )
+    rate_data = [{"Year": 1.0, "Rate": 5.0}, {"Year": 5.0, "Rate": 4.5}]
+    request = {
+        "startRow": 0,
+        "endRow": 3,
+        "sortModel": [{"colId": "Coupon", "sort": "desc"}],
+        "filterModel": {
+            "Coupon": {"filterType": "number", "type": "lessThan", "filter": 8}
+        },
+    }
+
+    response = get_bond_rows(request, rate_data, "2023-12-31", "test-rows")
+
+    # The first block of the sorted and filtered bonds, and only its bonds
+    # are priced
+    assert response["rowCount"] == 8
+    assert [row["Bond"] for row in response["rowData"]] == [
+        "Bond 7",
+        "Bond 6",
+        "Bond 5",
+    ]
+    assert all(row["Price"] is not None for row in response["rowData"])
+    prices = PORTFOLIOS.get("test-rows").portfolio["Price"]
+    assert np.isnan(prices).sum() == 7
+
+    # Sorting on a risk column prices the whole portfolio first
+    request = {
+        "startRow": 0,
+        "endRow": 3,
+        "sortModel": [{"colId": "Price", "sort": "asc"}],
+        "filterModel": {},
+    }
+    response = get_bond_rows(request, rate_data, "2023-12-31", "test-rows")
+    assert response["rowCount"] == 10
+    assert response["rowData"][0]["Bond"] == "Bond 0"
+    assert not np.isnan(PORTFOLIOS.get("test-rows").portfolio["Price"]).any()
+
+    # Unknown columns return an empty block
+    request["sortModel"] = [{"colId": "Unknown", "sort": "asc"}]
+    response = get_bond_rows(request, rate_data, "2023-12-31", "test-rows")
+    assert response == {"rowData": [], "rowCount": 0}
+
+    # so the grid cannot sort or filter on the row menu
+    (menu,) = [column for column in column_defs if column["field"] == "Menu"]
+    assert menu["sortable"] is False
+    assert menu["filter"] is False
+
+
+def test_callback_metrics():
+    PORTFOLIOS.create("test-metrics", [])
+    rate_data = [{"Year": 1.0, "Rate": 5.0}, {"Year": 2.0, "Rate": 4.5}]
+    metrics.reset()
+    metrics.enable()
+    try:
+        run_triggered(
+            "add-bond-button.n_clicks",
+            update_bond_data,
+            1,
+            None,
+            None,
+            None,
+            rate_data,
+            "2023-12-31",
+            "test-metrics",
         )
-        return show_timetable({"value": 2, "rowIndex": 0}, initial_data)
+    finally:
+        metrics.enable(False)
 
-    ctx = copy_context()
-    timetable_data, is_open = ctx.run(run_callback)
+    # The endpoint reports the wall time, counts and payload sizes
+    response = app.server.test_client().get("/metrics")
+    (entry,) = response.get_json()["recent"]
+    assert entry["callback"] == "update_bond_data"
+    assert entry["seconds"] > 0
+    assert entry["output_bytes"] > entry["input_bytes"] > 0
+    assert entry["bond_cache.misses"] + entry.get("bond_cache.hits", 0) == 1
+    assert response.get_json()["callbacks"]["update_bond_data"]["calls"] == 1
+    assert response.get_json()["startup_seconds"] > 0
 
-    # Check that the timetable is returned and offcanvas is opened
-    assert timetable_data != ""
-    assert is_open is True
+    # And the hit rates of the caches, to size them
+    result_cache = response.get_json()["caches"]["result_cache"]
+    assert result_cache["misses"] > 0
+    assert 0 <= result_cache["hit_rate"] <= 1
 
 
 def test_rate_graph_update():
@@ -227,15 +593,43 @@ def test_rate_graph_update():
         {"Year": 5.0, "Rate": 4.0},
     ]
 
-    def run_callback():
-        return update_rate_graph(None, rate_data)
+    # A new curve patches the times and rates of both traces
+    patch = run_triggered(
+        "rate-editor.rowData", update_rate_graph, None, rate_data
+    ).to_plotly_json()
+    values = {
+        tuple(op["location"]): op["params"]["value"]
+        for op in patch["operations"]
+    }
+    assert len(values["data", 0, "x"]) == len(values["data", 0, "y"])
+    assert len(values["data", 1, "x"]) == len(values["data", 1, "y"])
+    assert values["layout", "xaxis", "range"] == [0, 5.0]
+
+    # A rate edit only sends the new rates
+    rate_data[0]["Rate"] = 5.5
+    patch = run_triggered(
+        "rate-editor.cellValueChanged", update_rate_graph, [{}], rate_data
+    ).to_plotly_json()
+    locations = [tuple(op["location"]) for op in patch["operations"]]
+    assert sorted(locations) == [
+        ("data", 0, "y"),
+        ("data", 1, "y"),
+        ("layout", "yaxis", "range"),
+    ]
 
-    ctx = copy_context()
-    figure = ctx.run(run_callback)
-
-    # Ensure the rate graph figure is correctly generated
-    assert figure is not None
-    assert len(figure["data"]) > 0
-    assert len(figure["data"][0]["x"]) == len(
-        figure["data"][0]["y"]
-    )  # X and Y data must match in length
+
+def test_app_import_does_not_load_curves(tmp_path):
+    # Importing the app must not touch the curve store or the network
+    env = {
+        **os.environ,
+        "CURVE_SOURCE": "http://localhost:1/unreachable.csv",
+        "CURVE_STORE_PATH": str(tmp_path / "missing.parquet"),
+    }
+    subprocess.run(
+        [sys.executable, "-c", "import app"],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        env=env,
+        check=True,
+        timeout=60,
+    )
+    assert not (tmp_path / "missing.parquet").exists()
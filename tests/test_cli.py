@@ -0,0 +1,121 @@
+import pyarrow.parquet as pq
+import pytest
+
+from src.cli import main
+from src.rates import CURVE_SOURCE
+
+
+def test_cli_prices_portfolio_in_chunks(tmp_path, capsys):
+    book = tmp_path / "book.csv"
+    book.write_text(
+        "Bond,Currency,Coupon,Accrual Start,Maturity,Frequency,Notional\n"
+        "Bond A,USD,5.0,2024-01-02,2025-01-02,1,100\n"
+        "Bond B,USD,2.5,2024-01-02,2029-06-30,2,100\n"
+        "Bond C,USD,4.0,2024-01-02,2053-12-31,4,100\n"
+    )
+    output = tmp_path / "prices.parquet"
+    krd_output = tmp_path / "krd.csv"
+
+    main(
+        [
+            str(book),
+            "--date=2024-01-02",
+            f"--output={output}",
+            f"--krd-output={krd_output}",
+            f"--curve-source={CURVE_SOURCE}",
+            f"--curve-store={tmp_path / 'rates.parquet'}",
+            "--chunk-size=2",
+        ]
+    )
+
+    prices = pq.read_table(output).to_pydict()
+    assert prices["Bond"] == ["Bond A", "Bond B", "Bond C"]
+    assert all(price > 0 for price in prices["Price"])
+    assert len(krd_output.read_text().splitlines()) == 4
+    assert "Priced 3 bonds on 2024-01-02" in capsys.readouterr().out
+
+
+def test_cli_reprices_priced_portfolio(tmp_path, capsys):
+    # A file with results, such as a download from the app, is repriced
+    book = tmp_path / "book.csv"
+    book.write_text(
+        "Bond,Currency,Coupon,Accrual Start,Maturity,Frequency,Notional,"
+        "Price,Duration,Convexity\n"
+        "Bond A,USD,5.0,2024-01-02,2025-01-02,1,100,1.0,1.0,1.0\n"
+        "Bond B,USD,2.5,2024-01-02,2029-06-30,2,100,1.0,1.0,1.0\n"
+    )
+    output = tmp_path / "prices.parquet"
+
+    main(
+        [
+            str(book),
+            "--date=2024-01-02",
+            f"--output={output}",
+            f"--curve-source={CURVE_SOURCE}",
+            f"--curve-store={tmp_path / 'rates.parquet'}",
+        ]
+    )
+
+    prices = pq.read_table(output).to_pydict()
+    assert all(price > 90 for price in prices["Price"])
+    assert all(duration > 0.9 for duration in prices["Duration"])
+    assert all(convexity != 1.0 for convexity in prices["Convexity"])
+    assert "Priced 2 bonds on 2024-01-02" in capsys.readouterr().out
+
+
+def test_cli_ingests_curves(tmp_path, capsys):
+    older = tmp_path / "1990.csv"
+    older.write_text(
+        "Date,3 Mo,6 Mo,1 Yr,2 Yr,3 Yr,5 Yr,7 Yr,10 Yr,30 Yr\n"
+        "01/03/1990,7.89,7.94,7.85,7.94,7.96,7.92,8.04,7.99,8.04\n"
+        "01/02/1990,7.83,7.89,7.81,7.87,7.90,7.87,7.98,7.94,8.00\n"
+    )
+
+    # Without a portfolio, the curves are only added to the store, and a
+    # new store does not read the curve source
+    main(
+        [
+            f"--ingest={older}",
+            "--curve-source=http://localhost:1/unreachable.csv",
+            f"--curve-store={tmp_path / 'rates.parquet'}",
+        ]
+    )
+
+    assert "Stored 2 curves from 1990-01-02 to 1990-01-03" in (
+        capsys.readouterr().out
+    )
+
+
+def test_cli_keeps_outputs_of_invalid_portfolio(tmp_path):
+    book = tmp_path / "book.csv"
+    book.write_text(
+        "Bond,Currency,Coupon,Accrual Start,Maturity,Frequency,Notional\n"
+        "Bond A,USD,5.0,2024-01-02,2025-01-02,1,100\n"
+        "Bond B,USD,2.5,2024-01-02,2029-06-30,2,100\n"
+        "Bond C,GBP,4.0,2024-01-02,2053-12-31,4,100\n"
+    )
+    output = tmp_path / "prices.csv"
+    output.write_text("earlier run\n")
+    krd_output = tmp_path / "krd.csv"
+
+    # The invalid third bond fails the second chunk, after the first one
+    # was written
+    with pytest.raises(ValueError, match="row 3 has a currency"):
+        main(
+            [
+                str(book),
+                "--date=2024-01-02",
+                f"--output={output}",
+                f"--krd-output={krd_output}",
+                f"--curve-source={CURVE_SOURCE}",
+                f"--curve-store={tmp_path / 'rates.parquet'}",
+                "--chunk-size=2",
+            ]
+        )
+
+    assert output.read_text() == "earlier run\n"
+    assert not krd_output.exists()
+    assert sorted(path.name for path in tmp_path.glob("*.csv")) == [
+        "book.csv",
+        "prices.csv",
+    ]
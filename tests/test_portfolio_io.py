@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import pytest
+
+from src.bond import Portfolio, create_default_bond
+from src.portfolio_io import file_format, read_portfolio, write_portfolio
+
+
+@pytest.fixture
+def portfolio():
+    portfolio = Portfolio.from_rows(
+        [
+            create_default_bond(index=i, pricing_datetime=datetime(2024, 1, 2))
+            for i in range(1, 6)
+        ]
+    )
+    portfolio.set_risk([0], 99.5, 1.0, 2.0)
+    return portfolio
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+def test_portfolio_round_trip(portfolio, tmp_path, fmt):
+    path = tmp_path / f"portfolio.{fmt}"
+    write_portfolio(portfolio, str(path), fmt, batch_size=2)
+
+    loaded = read_portfolio(str(path), file_format(path.name), batch_size=2)
+    assert loaded.to_rows() == portfolio.to_rows()
+    assert list(loaded.unpriced()) == [1, 2, 3, 4]
+
+
+def test_read_portfolio_validates(tmp_path):
+    path = tmp_path / "portfolio.csv"
+    path.write_text(
+        "Currency,Coupon,Accrual Start,Maturity,Frequency,Notional\n"
+        "USD,2.5,2024-01-02,2025-01-02,1,100\n"
+        "GBP,2.5,2024-01-02,2023-01-02,1,100\n"
+    )
+    with pytest.raises(ValueError, match="row 2 has a currency"):
+        read_portfolio(str(path), "csv")
+
+    path.write_text("Currency,Coupon\nUSD,2.5\n")
+    with pytest.raises(ValueError, match="Missing portfolio columns"):
+        read_portfolio(str(path), "csv")
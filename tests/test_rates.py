@@ -0,0 +1,211 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from qablet.base.utils import Discounter
+
+from src.rates import (
+    CURVE_CACHE,
+    CURVE_SOURCE,
+    CurveStore,
+    compiled_curve,
+    plot_rates,
+    rate_figure,
+    rates_table,
+)
+
+
+@pytest.fixture
+def curve_store(tmp_path):
+    return CurveStore(
+        path=str(tmp_path / "rates.parquet"), source=CURVE_SOURCE
+    )
+
+
+def test_curve_store_persists_curves(curve_store):
+    rate_data = curve_store.rates_for_date(datetime(2024, 1, 2))
+    assert rate_data[0] == {"Year": 1 / 12, "Rate": 5.55}
+
+    # A new store on the same file does not need the source any more
+    reloaded = CurveStore(path=curve_store.path, source="missing.csv")
+    assert reloaded.rates_for_date(datetime(2024, 1, 2)) == rate_data
+
+
+def test_curve_store_refresh_from_file(curve_store, tmp_path):
+    curve_store.frame()
+    dropped = tmp_path / "drop.csv"
+    with open(CURVE_SOURCE) as f:
+        lines = f.readlines()
+    dropped.write_text(lines[0] + lines[-2].replace("5.55", "5.65"))
+
+    curve_store.refresh(str(dropped))
+
+    assert len(curve_store.frame()) == 1
+    rate_data = curve_store.rates_for_date(datetime(2024, 1, 2))
+    assert rate_data[0]["Rate"] == 5.65
+
+
+def test_curve_store_lookup(curve_store):
+    df = curve_store.frame()
+    dates = pd.date_range("2023-12-29", "2024-01-12", freq="6h")
+
+    # Nearest matches a brute force search, with ties going to the earlier curve
+    expected = [
+        min(range(len(df)), key=lambda i: (abs(df["Date"][i] - d), i))
+        for d in dates
+    ]
+    assert list(curve_store.lookup(dates)) == expected
+
+    saturday = datetime(2024, 1, 6)
+    friday, monday = datetime(2024, 1, 5), datetime(2024, 1, 8)
+    assert df["Date"][curve_store.lookup([saturday], "previous")[0]] == friday
+    assert df["Date"][curve_store.lookup([saturday], "next")[0]] == monday
+    with pytest.raises(KeyError):
+        curve_store.lookup([datetime(2023, 1, 1)], "previous")
+
+    curves = curve_store.curves_for_dates(dates)
+    assert len(curves) == len(dates)
+    assert list(curves["Date"]) == list(df["Date"][expected])
+
+
+def test_curve_store_ingest(curve_store, tmp_path):
+    n_curves = len(curve_store.frame())
+    older = tmp_path / "1990.csv"
+    older.write_text(
+        "Date,3 Mo,6 Mo,1 Yr,2 Yr,3 Yr,5 Yr,7 Yr,10 Yr,30 Yr\n"
+        "01/03/1990,7.89,7.94,7.85,7.94,7.96,7.92,8.04,7.99,8.04\n"
+        "01/02/1990,7.83,7.89,7.81,7.87,7.90,7.87,7.98,7.94,8.00\n"
+    )
+
+    assert curve_store.ingest(str(older)) == 2
+    assert curve_store.ingest(str(older)) == 0  # already stored
+    assert curve_store.ingest(CURVE_SOURCE) == 0
+
+    df = curve_store.frame()
+    assert len(df) == n_curves + 2
+    assert df["Date"].is_monotonic_increasing
+
+    # Tenors that were not published are left out of the rate data
+    rate_data = curve_store.rates_for_date(datetime(1990, 1, 2))
+    assert [rate["Year"] for rate in rate_data] == [
+        0.25,
+        0.5,
+        1,
+        2,
+        3,
+        5,
+        7,
+        10,
+        30,
+    ]
+    assert curve_store.rates_for_date(datetime(2024, 1, 2))[0]["Rate"] == 5.55
+
+    # The archive is persisted
+    reloaded = CurveStore(path=curve_store.path, source="missing.csv")
+    assert len(reloaded.frame()) == n_curves + 2
+
+
+def test_curve_store_ingest_seeds_new_store(tmp_path):
+    # A new store is created from the ingested file, without the source
+    store = CurveStore(
+        path=str(tmp_path / "rates.parquet"),
+        source="http://localhost:1/unreachable.csv",
+    )
+    assert store.ingest(CURVE_SOURCE) == len(pd.read_csv(CURVE_SOURCE))
+    assert store.rates_for_date(datetime(2024, 1, 2))[0]["Rate"] == 5.55
+
+
+def test_curve_store_reload(tmp_path):
+    source = tmp_path / "daily.csv"
+    with open(CURVE_SOURCE) as f:
+        lines = f.readlines()
+    source.write_text("".join(lines[:-1]))
+    store = CurveStore(path=str(tmp_path / "rates.parquet"), source=source)
+    n_curves = len(store.frame())
+    assert not store.reload()
+
+    # Curves ingested by another process, such as the command line
+    other = CurveStore(path=store.path, source=CURVE_SOURCE)
+    assert other.ingest(CURVE_SOURCE) == 1
+    assert store.reload()
+    assert len(store.frame()) == n_curves + 1
+
+    # and a new day dropped in the source file
+    source.write_text(lines[0] + lines[1].replace("01/12/2024", "01/16/2024"))
+    later = time.time_ns() + 10**9
+    os.utime(source, ns=(later, later))
+    assert store.reload()
+    assert len(store.frame()) == n_curves + 2
+    assert store.frame()["Date"].iloc[-1] == pd.Timestamp("2024-01-16")
+    assert not store.reload()
+
+
+def test_curve_store_stale_curve_date(curve_store):
+    assert curve_store.stale_curve_date(datetime(2024, 1, 6)) is None
+
+    # A date far from the stored curves uses the nearest one, flagged stale
+    curve_date = curve_store.stale_curve_date(datetime(2020, 5, 1))
+    assert curve_date == curve_store.frame()["Date"].iloc[0]
+
+
+def test_compiled_curve_cache():
+    CURVE_CACHE.clear()
+    rate_data = [{"Year": 1.0, "Rate": 5.0}, {"Year": 2.0, "Rate": 4.5}]
+    pricing_datetime = datetime(2024, 1, 2)
+
+    # Equal rates share one compiled curve, whatever the other fields
+    compiled = compiled_curve(rate_data, pricing_datetime)
+    same_rates = [{**rate, "id": i} for i, rate in enumerate(rate_data)]
+    assert compiled_curve(same_rates, pricing_datetime) is compiled
+    assert compiled.dataset["ASSETS"]["USD"][1] is compiled.zero_rates
+    np.testing.assert_allclose(compiled.rates, [0.05, 0.045])
+
+    # A rate edit or another pricing date compiles a new curve
+    edited = [rate_data[0], {"Year": 2.0, "Rate": 4.6}]
+    assert compiled_curve(edited, pricing_datetime) is not compiled
+    assert compiled_curve(rate_data, datetime(2024, 1, 3)) is not compiled
+
+    # The rate graph reuses the curve compiled without a pricing date
+    rates_table(rate_data)
+    rates_table(rate_data)
+    info = CURVE_CACHE.cache_info()
+    assert info.currsize == 4
+    assert info.hits == 2
+
+
+def test_rates_table_matches_discounter():
+    rate_data = [
+        {"Year": 0.5, "Rate": 5.2},
+        {"Year": 1.0, "Rate": 5.0},
+        {"Year": 2.0, "Rate": 4.5},
+        {"Year": 5.0, "Rate": 4.0},
+    ]
+    discounter = Discounter(
+        (
+            "ZERO_RATES",
+            np.array([[r["Year"], r["Rate"] / 100] for r in rate_data]),
+        )
+    )
+
+    # Denser grids agree with the qablet Discounter at every point
+    for steps in [20, 500]:
+        rates_df = rates_table(rate_data, steps=steps)
+        ends = rates_df["Time"].to_numpy()
+        starts = np.concatenate([[0.0], ends[:-1]])
+        assert len(rates_df) == steps
+        np.testing.assert_allclose(
+            rates_df["Term Rate"], discounter.rate(ends, ends * 0)
+        )
+        np.testing.assert_allclose(
+            rates_df["Fwd Rate"], discounter.rate(ends, starts)
+        )
+
+    # The figure is built from the shared skeleton, which is left as is
+    fig = plot_rates(rates_df)
+    assert [trace.name for trace in fig.data] == ["Term Rate", "Fwd Rate"]
+    assert list(fig.layout.xaxis.range) == [0, 5.0]
+    assert len(fig.data[0].x) == 500
+    assert not rate_figure()["data"][0]["x"]